@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import argparse
+import platform
+import tempfile
+import subprocess
+import Commands
+
+_VSFS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "VSFS.py")
+# Version of the format of the saved results
+_RESULTS_VERSION = 1
+# Bytes of contents on every content record of a generated file
+_LINE_SIZE = 64
+# Names of the file and dir created by the copyin and mkdir operations
+_NEW_FILE = "new_note"
+_NEW_DIRECTORY = "new_dir"
+# Slowdown of an operation, compared to the results of another
+# version, that is reported as a regression
+_THRESHOLD = 1.25
+
+
+# Parses a number of files like "10000", "10k" or "1m"
+def parse_count(text):
+    number = text.lower()
+    scale = 1
+    if (number.endswith("k")):
+        scale = 1000
+        number = number[:-1]
+    elif (number.endswith("m")):
+        scale = 1000 * 1000
+        number = number[:-1]
+    try:
+        return int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid count: '" + text + "'")
+
+
+# Parameters of a generated FS and of the operations run on it
+class Parameters:
+
+    def __init__(self, files, depth, fanout, content_size, tombstone_ratio,
+                 version = "V1.0", batch_size = 100, seed = 0):
+        # Number of live files, spread over the dirs of a tree with
+        # the given depth and number of sub dirs in every dir
+        self.files = files
+        self.depth = depth
+        self.fanout = fanout
+        # Bytes of contents of every file
+        self.content_size = content_size
+        # Fraction of the file records of the FS that are deleted
+        self.tombstone_ratio = tombstone_ratio
+        # Format of the FS, "V1.0" or "V2.0"
+        self.version = version
+        # Number of copyins in the script of the batch operation
+        self.batch_size = batch_size
+        self.seed = seed
+
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+# Returns the paths of the dirs of a tree with a depth and a fanout,
+# parents first, eg. "d0", "d1", "d0/d0", ...
+def get_directories(depth, fanout):
+    directories = []
+    level = [""]
+    for i in range(depth):
+        next_level = []
+        for parent in level:
+            for j in range(fanout):
+                if (parent == ""):
+                    next_level.append("d" + str(j))
+                else:
+                    next_level.append(parent + "/d" + str(j))
+        directories.extend(next_level)
+        level = next_level
+    return directories
+
+
+# Checks if a generated file record is deleted, spreading
+# the deleted records evenly over the FS
+def is_deleted(number, total, deleted):
+    return ((number + 1) * deleted // total != number * deleted // total)
+
+
+# Writes a text FS with the dirs and live files of the parameters and
+# deleted files spread between the live ones, and returns the paths
+# of the dirs and of the live files, and a word of the contents of
+# the last live file for the search operation (None if it has none)
+def generate(file_system, parameters):
+    rng = random.Random(parameters.seed)
+    words = [b"notes", b"record", b"entry", b"error", b"request", b"data",
+             b"value", b"server", b"client", b"update", b"delete", b"the"]
+    # Lines the contents are made of, so that they compress like text
+    pool = []
+    for i in range(256):
+        line = b" ".join([rng.choice(words) for j in range(20)])
+        pool.append(line[:_LINE_SIZE])
+
+    directories = get_directories(parameters.depth, parameters.fanout)
+    parents = [""] + directories
+    # Deleted files making up the ratio of the file records
+    deleted = 0
+    ratio = parameters.tombstone_ratio
+    if (ratio > 0 and ratio < 1):
+        deleted = int(round(parameters.files * ratio / (1 - ratio)))
+    total = parameters.files + deleted
+
+    files = []
+    pattern = None
+    with open(file_system, "wb") as f:
+        f.write(b"NOTES V1.0\n")
+        for directory in directories:
+            f.write(b"=" + directory.encode() + b"/\n")
+        for number in range(total):
+            parent = parents[number % len(parents)]
+            name = "f" + str(number)
+            if (parent != ""):
+                name = parent + "/" + name
+            # Every new-line character but the last one, which ends the
+            # last content record, is part of the contents
+            size = parameters.content_size
+            lines = []
+            while (size > 0):
+                if (size <= _LINE_SIZE):
+                    line = rng.choice(pool)[:size]
+                else:
+                    line = rng.choice(pool)[:_LINE_SIZE - 1]
+                lines.append(line + b"\n")
+                size = size - len(line) - 1
+            if (is_deleted(number, total, deleted) == True):
+                marker = b"#"
+                f.write(b"#@" + name.encode() + b"\n")
+            else:
+                marker = b" "
+                f.write(b"@" + name.encode() + b"\n")
+                files.append(name)
+                pattern = None
+                if (len(lines) != 0 and len(lines[0].split()) != 0):
+                    pattern = lines[0].split()[0].decode()
+            for line in lines:
+                f.write(marker + line)
+    return directories, files, pattern
+
+
+# Runs a command of VSFS.py and returns the seconds it took and the
+# peak resident memory of its process in KB, raising an error if it fails
+def run_command(arguments):
+    with tempfile.TemporaryFile() as errors:
+        with open(os.devnull, "wb") as null:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, _VSFS] + arguments,
+                                       stdin = subprocess.DEVNULL,
+                                       stdout = null, stderr = errors)
+            pid, status, usage = os.wait4(process.pid, 0)
+            seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if (process.returncode != 0):
+            errors.seek(0)
+            raise RuntimeError(" ".join(arguments) + ": "
+                               + errors.read().decode(errors = "replace").strip())
+    return seconds, usage.ru_maxrss
+
+
+# Times the operations of VSFS.py on copies of a generated FS
+class Benchmark:
+
+    def __init__(self, parameters, directory):
+        self.parameters = parameters
+        self.directory = directory
+        # Generated FS and the copy every operation is run on
+        self.base = os.path.join(directory, "base.notes")
+        self.work = os.path.join(directory, "work.notes")
+        self.external_file = os.path.join(directory, "external")
+        self.script = os.path.join(directory, "script")
+        self.output = os.path.join(directory, "output")
+        self.directories = []
+        self.files = []
+        # Word searched for by the search operation
+        self.pattern = None
+        self.records = 0
+        self.size = 0
+
+
+    # Generates the FS, its index and the external files
+    def prepare(self):
+        self.directories, self.files, self.pattern = generate(self.base, self.parameters)
+        if (self.parameters.version != "V1.0"):
+            run_command(["convert", self.base, self.parameters.version])
+        # Saving the index once, which is copied with the FS
+        run_command(["index", self.base])
+        self.records = len(self.directories) + len(self.files)
+        self.size = os.path.getsize(self.base)
+
+        with open(self.external_file, "wb") as f:
+            f.write(b" ".join([b"line"] * (self.parameters.content_size // 5 + 1))
+                    [:self.parameters.content_size])
+        # copyout only replaces an external file that exists
+        with open(self.output, "wb") as f:
+            pass
+        with open(self.script, "w") as f:
+            for number in range(self.parameters.batch_size):
+                f.write("copyin " + self.external_file + " "
+                        + self.get_new_path("batch_" + str(number)) + "\n")
+
+
+    # Returns a path under the first dir of the FS
+    def get_new_path(self, name):
+        if (len(self.directories) == 0):
+            return name
+        return self.directories[0] + "/" + name
+
+
+    # Replaces the copy of the FS with the generated FS and its index,
+    # keeping their modification times so that the index is fresh
+    def copy_base(self):
+        for name in os.listdir(self.directory):
+            if (name.startswith(os.path.basename(self.work))):
+                os.unlink(os.path.join(self.directory, name))
+        shutil.copy2(self.base, self.work)
+        if (os.path.exists(self.base + ".idx")):
+            shutil.copy2(self.base + ".idx", self.work + ".idx")
+
+
+    # Returns the arguments of VSFS.py for an operation on the copy
+    # of the FS, or None if the FS has nothing to run it on
+    def get_arguments(self, operation):
+        middle = None
+        if (len(self.files) != 0):
+            middle = self.files[len(self.files) // 2]
+        other_version = "V2.0"
+        if (self.parameters.version == "V2.0"):
+            other_version = "V1.0"
+        arguments = {
+            "list": [],
+            "copyin": [self.external_file, self.get_new_path(_NEW_FILE)],
+            "copyout": [middle, self.output],
+            "mkdir": [_NEW_DIRECTORY],
+            "rm": [middle],
+            "rmdir": self.directories[:1],
+            "defrag": [],
+            "index": [],
+            "batch": [self.script],
+            "convert": [other_version],
+            "search": [self.pattern],
+        }.get(operation)
+        if (arguments == None or None in arguments
+            or (operation == "rmdir" and len(arguments) == 0)
+        ):
+            return None
+        return [operation, self.work] + arguments
+
+
+    # Runs an operation once on a fresh copy of the FS and returns
+    # its seconds and peak memory, or None if it cannot be run
+    def run_once(self, operation):
+        self.copy_base()
+        if (operation == "serve"):
+            return self.run_serve()
+        arguments = self.get_arguments(operation)
+        if (arguments == None):
+            return None
+        seconds, peak = run_command(arguments)
+        return {"seconds": seconds, "peak_rss_kb": peak}
+
+
+    # Starts a server on the copy of the FS and times how long it takes
+    # to load the FS and then to run a list through it, before stopping it
+    def run_serve(self):
+        socket_path = self.work + ".sock"
+        with tempfile.TemporaryFile() as errors:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, _VSFS, "serve", self.work,
+                                        socket_path],
+                                       stdin = subprocess.DEVNULL,
+                                       stdout = subprocess.PIPE, stderr = errors)
+            # The server prints a line once it accepts clients
+            ready = process.stdout.readline()
+            seconds = time.perf_counter() - start
+            try:
+                if (len(ready) == 0):
+                    errors.seek(0)
+                    raise RuntimeError("serve: " + errors.read().decode(errors = "replace"))
+                client_seconds = run_command(["list", self.work])[0]
+            finally:
+                process.send_signal(signal.SIGINT)
+                pid, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                process.stdout.close()
+        return {"seconds": seconds, "peak_rss_kb": usage.ru_maxrss,
+                "client_seconds": client_seconds}
+
+
+    # Runs an operation a number of times and returns its fastest
+    # run with the throughput, and the highest peak memory
+    def run(self, operation, repeat):
+        best = None
+        for i in range(repeat):
+            result = self.run_once(operation)
+            if (result == None):
+                return {"skipped": True}
+            if (best == None or result["seconds"] < best["seconds"]):
+                peak = result["peak_rss_kb"]
+                if (best != None):
+                    peak = max(peak, best["peak_rss_kb"])
+                best = result
+                best["peak_rss_kb"] = peak
+            else:
+                best["peak_rss_kb"] = max(best["peak_rss_kb"], result["peak_rss_kb"])
+        seconds = max(best["seconds"], 1e-9)
+        best["records_per_second"] = self.records / seconds
+        best["bytes_per_second"] = self.size / seconds
+        return best
+
+
+# Returns the results of every operation in a form that
+# can be saved and compared with another version
+def make_report(benchmark, results):
+    return {
+        "version": _RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": benchmark.parameters.to_dict(),
+        "records": benchmark.records,
+        "size": benchmark.size,
+        "results": results,
+    }
+
+
+# Returns the operations that got slower than the threshold compared
+# to a previous report as [operation, old seconds, new seconds]
+def compare(previous, report, threshold = _THRESHOLD):
+    regressions = []
+    for operation, result in report["results"].items():
+        old = previous["results"].get(operation)
+        if (old == None or "seconds" not in old or "seconds" not in result):
+            continue
+        if (result["seconds"] > old["seconds"] * threshold):
+            regressions.append([operation, old["seconds"], result["seconds"]])
+    return regressions
+
+
+# Prints a line for every operation of a report
+def print_report(report, previous = None):
+    print("VSFS Benchmark: " + str(report["records"]) + " Records ("
+          + str(report["size"]) + " Bytes)")
+    print("%-10s %12s %16s %14s %10s" % ("operation", "seconds", "records/s",
+                                         "peak KB", "change"))
+    for operation, result in report["results"].items():
+        if (result.get("skipped") == True):
+            print("%-10s %12s" % (operation, "skipped"))
+            continue
+        change = ""
+        if (previous != None):
+            old = previous["results"].get(operation, {})
+            if (old.get("seconds", 0) > 0):
+                change = "%+.1f%%" % ((result["seconds"] / old["seconds"] - 1) * 100)
+        print("%-10s %12.4f %16.1f %14d %10s" % (operation, result["seconds"],
+                                                 result["records_per_second"],
+                                                 result["peak_rss_kb"], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Times every VSFS operation on a generated notes file")
+    parser.add_argument("--files", type = parse_count, default = 10000,
+                        help = "live files, eg. 10k, 100k or 1m (default 10k)")
+    parser.add_argument("--depth", type = int, default = 2,
+                        help = "depth of the dir tree (default 2)")
+    parser.add_argument("--fanout", type = int, default = 10,
+                        help = "sub dirs of every dir (default 10)")
+    parser.add_argument("--content-size", type = int, default = 256,
+                        help = "bytes of contents of every file (default 256)")
+    parser.add_argument("--tombstone-ratio", type = float, default = 0.1,
+                        help = "fraction of deleted file records (default 0.1)")
+    parser.add_argument("--format", default = "V1.0", choices = ["V1.0", "V2.0"],
+                        help = "format of the notes file (default V1.0)")
+    parser.add_argument("--batch-size", type = int, default = 100,
+                        help = "copyins of the batch operation (default 100)")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--operations", default = ",".join(Commands._OPERATIONS),
+                        help = "comma separated operations (default all)")
+    parser.add_argument("--repeat", type = int, default = 1,
+                        help = "runs of every operation, the fastest is kept")
+    parser.add_argument("--output", default = "benchmark.json",
+                        help = "file the results are saved to as JSON")
+    parser.add_argument("--compare", default = None,
+                        help = "results of another version to compare with")
+    parser.add_argument("--threshold", type = float, default = _THRESHOLD,
+                        help = "slowdown reported as a regression (default 1.25)")
+    parser.add_argument("--directory", default = None,
+                        help = "dir for the generated files (default a temporary one)")
+    parser.add_argument("--keep", action = "store_true",
+                        help = "keep the generated files")
+    options = parser.parse_args()
+
+    operations = [operation for operation in options.operations.split(",")
+                  if (operation != "")]
+    for operation in operations:
+        if (operation not in Commands._OPERATIONS):
+            parser.error("unknown operation: '" + operation + "'")
+    previous = None
+    if (options.compare != None):
+        with open(options.compare, "r") as f:
+            previous = json.load(f)
+
+    parameters = Parameters(options.files, options.depth, options.fanout,
+                            options.content_size, options.tombstone_ratio,
+                            options.format, options.batch_size, options.seed)
+    directory = options.directory
+    if (directory == None):
+        directory = tempfile.mkdtemp(prefix = "vsfs-benchmark-")
+    else:
+        os.makedirs(directory, exist_ok = True)
+    try:
+        benchmark = Benchmark(parameters, directory)
+        benchmark.prepare()
+        results = {}
+        for operation in operations:
+            results[operation] = benchmark.run(operation, max(options.repeat, 1))
+    finally:
+        if (options.keep == False):
+            shutil.rmtree(directory, ignore_errors = True)
+
+    report = make_report(benchmark, results)
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print_report(report, previous)
+
+    if (previous != None):
+        if (previous.get("parameters") != report["parameters"]):
+            print("Warning: the results were not generated with the same parameters")
+        regressions = compare(previous, report, options.threshold)
+        for operation, old, new in regressions:
+            print("Regression: " + operation + " took " + "%.4f" % new
+                  + "s instead of " + "%.4f" % old + "s")
+        if (len(regressions) != 0):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
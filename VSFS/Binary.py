@@ -0,0 +1,839 @@
+#!/usr/bin/python3
+import io
+import os
+import mmap
+import stat
+import zlib
+import shutil
+import struct
+import tempfile
+import contextlib
+import Notes
+import Compression
+import Stats
+
+# First line of a binary notes file
+HEADER = b"NOTES V2.0\n"
+# Two slots follow the first line, each with a sequence number, the
+# offset and length of a table block and a checksum. The valid slot
+# with the highest sequence number points to the table of the FS, and
+# a change is committed by writing the other slot, so that a slot
+# torn by a crash leaves the FS as it was before the change
+_SLOT = struct.Struct(">QQQI4x")
+_SLOTS_OFFSET = len(HEADER)
+_DATA_OFFSET = _SLOTS_OFFSET + 2 * _SLOT.size
+# The rest of the FS is a sequence of blocks, each with a kind, the
+# length of its name, the length of its contents, its name and its
+# contents. The name of a file is followed by its attributes after a
+# tab like in a text FS. The contents of a file are stored as they are
+# (or compressed), those of a table are the entries of the live blocks
+# sorted by their keys. Blobs with the contents shared by several
+# files have the kind "$" and are in the table like files.
+# Deleted blocks have the kind "#", while every table the slots do not
+# lead to is an old table
+_BLOCK = struct.Struct(">cIQ")
+_OFFSET = struct.Struct(">Q")
+_FILE = b"@"
+_DIRECTORY = b"="
+_BLOB = b"$"
+_DELETED = b"#"
+_TABLE = b"T"
+# A change is written as a delta table with the offset of the table
+# before it and the entries of the blocks it added or deleted, sorted
+# by their keys, so that the slots lead to a full table through a few
+# deltas
+_DELTA = b"D"
+# Every entry is the offset of a block with the kind of its key in the
+# high byte, since a deleted block loses its kind, and the top bit set
+# if the block was deleted by a delta
+_KIND_SHIFT = 56
+_OFFSET_MASK = (1 << _KIND_SHIFT) - 1
+_DELETED_ENTRY = 1 << 63
+_CHUNK_SIZE = 64 * 1024
+_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+# File or dir block of a binary FS. The offset is the start of the
+# block and the contents are between header_end and content_end
+class Extent(Notes.Record):
+
+    def __init__(self, key, offset, length, live, attributes = None):
+        if (attributes == None):
+            attributes = {}
+        end = offset + _BLOCK.size + len(Notes.join_header(key, attributes)[1:].encode())
+        super().__init__(key, offset, offset, end, live)
+        self.content_end = end + length
+        self.length = length
+        self.attributes = attributes
+
+
+    # Blocks are not lines, so they never end with a new-line character
+    def has_newline(self):
+        return False
+
+
+# Checks if the first line of a FS is "NOTES V2.0"
+def is_binary(file_system):
+    with open(file_system, "rb") as f:
+        return (f.read(len(HEADER)) == HEADER)
+
+
+def pack_slot(sequence, offset, length):
+    fields = struct.pack(">QQQ", sequence, offset, length)
+    return _SLOT.pack(sequence, offset, length, zlib.crc32(fields))
+
+
+# Returns the valid slot with the highest sequence number of a mapped
+# FS as [slot number, sequence, table offset, table length]
+def read_slot(notes):
+    best = None
+    for number in range(2):
+        start = _SLOTS_OFFSET + number * _SLOT.size
+        if (len(notes) < start + _SLOT.size):
+            break
+        sequence, offset, length, checksum = _SLOT.unpack_from(notes, start)
+        if (zlib.crc32(notes[start:start + 24]) != checksum
+            or offset + length > len(notes)
+        ):
+            continue
+        if (best == None or sequence > best[1]):
+            best = [number, sequence, offset, length]
+    if (best == None):
+        raise ValueError("No Valid Table")
+    return best
+
+
+# Returns the kind, key, content length and attributes of the block
+# at an offset of a mapped FS
+def read_block(notes, offset):
+    kind, name_length, length = _BLOCK.unpack_from(notes, offset)
+    start = offset + _BLOCK.size
+    name = bytes(notes[start:start + name_length]).decode()
+    key, attributes = Notes.split_header(kind.decode() + name)
+    return kind, key, length, attributes
+
+
+# Returns the table entry of the block of a key
+def pack_entry(key, offset, deleted = False):
+    entry = offset | ord(key[0]) << _KIND_SHIFT
+    if (deleted == True):
+        entry = entry | _DELETED_ENTRY
+    return entry
+
+
+# Returns the key, content length, attributes and deleted state
+# of the block of a table entry in a mapped FS
+def read_entry(notes, entry):
+    kind, key, length, attributes = read_block(notes, entry & _OFFSET_MASK)
+    key = chr((entry >> _KIND_SHIFT) & 0x7f) + key[1:]
+    return key, length, attributes, (entry & _DELETED_ENTRY != 0)
+
+
+# Returns the full table and the deltas a slot leads to, oldest first,
+# as [offset, block length, offset of the entries, number of entries]
+def read_chain(notes, slot):
+    tables = []
+    offset = slot[2]
+    while True:
+        kind, name_length, length = _BLOCK.unpack_from(notes, offset)
+        start = offset + _BLOCK.size
+        if (kind == _TABLE):
+            tables.append([offset, _BLOCK.size + length, start, length // _OFFSET.size])
+            break
+        previous = _OFFSET.unpack_from(notes, start)[0]
+        if (kind != _DELTA or previous >= offset):
+            raise ValueError("No Valid Table")
+        tables.append([offset, _BLOCK.size + length, start + _OFFSET.size,
+                       length // _OFFSET.size - 1])
+        offset = previous
+    tables.reverse()
+    return tables
+
+
+# Returns the entries of a table of read_chain
+def read_entries(notes, table):
+    return [_OFFSET.unpack_from(notes, table[2] + i * _OFFSET.size)[0]
+            for i in range(table[3])]
+
+
+# Yields the offset, kind, key, content length and attributes of every
+# complete block of a mapped FS in order, stopping at a block torn
+# by a crash
+def scan_blocks(notes):
+    offset = _DATA_OFFSET
+    while (offset + _BLOCK.size <= len(notes)):
+        kind, name_length, length = _BLOCK.unpack_from(notes, offset)
+        end = offset + _BLOCK.size + name_length + length
+        if (kind not in [_FILE, _DIRECTORY, _BLOB, _DELETED, _TABLE, _DELTA]
+            or end > len(notes)
+        ):
+            break
+        start = offset + _BLOCK.size
+        try:
+            name = bytes(notes[start:start + name_length]).decode()
+        except UnicodeDecodeError:
+            break
+        key, attributes = Notes.split_header(kind.decode() + name)
+        yield offset, kind, key, length, attributes
+        offset = end
+
+
+# Returns the header of a block
+def pack_block(kind, key, length, attributes = {}):
+    name = Notes.join_header(key, attributes)[1:].encode()
+    return _BLOCK.pack(kind, len(name), length) + name
+
+
+# Parsed image of a binary FS. The table of the FS is the index, so
+# nothing is stored next to it, and the dir tree is shared with the
+# text FS. Changes are appended as blocks followed by a new table,
+# which the other slot then points to
+class BinaryImage(Notes.NotesImage):
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.records = {}
+        self.root = Notes.Directory("", None)
+        self.references = {}
+        self.policy = Notes.policy_from_environment()
+        self.staging = None
+        self.staged_from = 0
+        self.pending = []
+        self.discarded = False
+        # End of the FS, bytes of blocks that are not live anymore,
+        # active slot as [slot number, sequence, table offset, table
+        # length] and size and modification time of the FS
+        self.size = 0
+        self.dead_bytes = 0
+        self.slot = None
+        self.signature = None
+        # Full table and deltas the slot leads to as [offset, block
+        # length, entries by key], with None as the entries of the full
+        # table, and entries by key changed since the last table, or
+        # None if the next table must be a full one
+        self.tables = []
+        self.changed = {}
+
+
+    # Loads the live blocks from the full table the slots lead to
+    # and applies the deltas that follow it
+    def load(self):
+        with open(self.file_system, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as notes:
+                self.slot = read_slot(notes)
+                self.records = {}
+                self.tables = []
+                live = _DATA_OFFSET
+                for table in read_chain(notes, self.slot):
+                    changes = ({} if (len(self.tables) > 0) else None)
+                    for entry in read_entries(notes, table):
+                        key, length, attributes, deleted = read_entry(notes, entry)
+                        if (changes != None):
+                            changes[key] = entry
+                        if (deleted == True):
+                            self.records.pop(key, None)
+                        else:
+                            self.records[key] = Extent(key, entry & _OFFSET_MASK, length,
+                                                       True, attributes)
+                    self.tables.append([table[0], table[1], changes])
+                    live = live + table[1]
+                for record in self.records.values():
+                    live = live + record.content_end - record.offset
+                self.size = len(notes)
+                self.dead_bytes = self.size - live
+                self.changed = {}
+            self.update_signature(f)
+        Stats.count("records_scanned", len(self.records))
+        self.build_tree()
+
+
+    # Checks the table against the blocks of the FS and writes a new
+    # table if they do not match, eg. if both slots were lost. A later
+    # block replaces an earlier one with the same key, which is deleted
+    def rebuild(self):
+        try:
+            self.load()
+        except ValueError:
+            self.slot = [1, 0, 0, 0]
+            self.records = {}
+            self.tables = []
+            self.size = os.stat(self.file_system).st_size
+        records = {}
+        replaced = []
+        with Stats.phase("parse"), open(self.file_system, "rb") as f:
+            Stats.count("full_reads")
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as notes:
+                for offset, kind, key, length, attributes in scan_blocks(notes):
+                    if (kind == _FILE or kind == _DIRECTORY or kind == _BLOB):
+                        if (key in records):
+                            replaced.append(records[key])
+                        records[key] = Extent(key, offset, length, True, attributes)
+            Stats.count("records_scanned", len(records))
+        offsets = sorted([record.offset for record in records.values()])
+        if (offsets == sorted([record.offset for record in self.records.values()])):
+            return
+
+        self.records = records
+        self.staged_from = self.size
+        self.changed = None
+        with io.BytesIO() as staging:
+            self.write_table(staging, replaced)
+        self.load()
+
+
+    def update_signature(self, f):
+        fs_stat = os.fstat(f.fileno())
+        self.signature = [fs_stat.st_size, fs_stat.st_mtime_ns]
+
+
+    # Checks if the FS was modified after it was loaded. During a
+    # batch the image is ahead of the FS and is never reloaded
+    def is_stale(self):
+        if (self.discarded == True):
+            return True
+        if (self.staging != None):
+            return False
+        try:
+            fs_stat = os.stat(self.file_system)
+        except FileNotFoundError:
+            return True
+        return ([fs_stat.st_size, fs_stat.st_mtime_ns] != self.signature)
+
+
+    # Deletes blocks by setting their kind to "#" once the change
+    # is committed, or right away in the staged blocks
+    def tombstone_records(self, records):
+        if (len(records) == 0):
+            return
+        with self.changing():
+            for record in records:
+                if (record.offset >= self.staged_from):
+                    self.staging.seek(record.offset - self.staged_from)
+                    self.staging.write(_DELETED)
+                else:
+                    self.pending.append(record)
+                self.dead_bytes = self.dead_bytes + record.content_end - record.offset
+                self.changed[record.key] = pack_entry(record.key, record.offset, True)
+                record.live = False
+                del self.records[record.key]
+            for record in sorted(records, key = lambda record: record.name, reverse = True):
+                self.remove_from_tree(record)
+
+
+    # Appends a file block, copying the external file as it is
+    # or compressed
+    def append_file(self, name, external_file, compression = None):
+        self.append_contents(_FILE, "@" + name, external_file, compression)
+
+
+    # Appends the blob block of contents shared by several files
+    def append_blob(self, digest, external_file, compression = None):
+        self.append_contents(_BLOB, "$" + digest, external_file, compression)
+
+
+    # Appends a file or blob block and its contents
+    def append_contents(self, kind, key, external_file, compression):
+        with Compression.open_contents(external_file, compression,
+                                       False) as (source, attributes):
+            self.append_block(kind, key, attributes, source)
+
+
+    # Reads the contents of an external file as they are stored into
+    # a temporary file, hashing them if needed, like
+    # NotesImage.encode_contents
+    def encode_contents(self, external_file, compression, hashed = False):
+        encoded = Notes.EncodedContents(hashed)
+        with Compression.open_contents(external_file, compression, False,
+                                       encoded.digest) as (source, attributes):
+            encoded.attributes = attributes
+            shutil.copyfileobj(source, encoded.data, _CHUNK_SIZE)
+            encoded.size = encoded.data.tell()
+        return encoded
+
+
+    # Appends a file or blob block and the contents encoded for it
+    def append_encoded(self, key, encoded):
+        encoded.data.seek(0)
+        self.append_block(key[0].encode(), key, encoded.attributes, encoded.data)
+
+
+    # Appends a block, copying its contents from an open file
+    def append_block(self, kind, key, attributes, source):
+        with self.changing():
+            header = pack_block(kind, key, 0, attributes)
+            self.staging.seek(0, os.SEEK_END)
+            start = self.staging.tell()
+            self.staging.write(header)
+            shutil.copyfileobj(source, self.staging, _CHUNK_SIZE)
+            # Writing the length once the contents were copied
+            length = self.staging.tell() - start - len(header)
+            self.staging.seek(start)
+            self.staging.write(pack_block(kind, key, length, attributes))
+            self.add_appended(Extent(key, self.size, length, True, attributes))
+
+
+    # Appends a file block without contents, whose
+    # contents are the ones of a blob
+    def append_link(self, name, digest):
+        key = "@" + name
+        attributes = {Notes._DIGEST: digest}
+        with self.changing():
+            self.staging.seek(0, os.SEEK_END)
+            self.staging.write(pack_block(_FILE, key, 0, attributes))
+            self.add_appended(Extent(key, self.size, 0, True, attributes))
+
+
+    # Appends a dir block
+    def append_directory(self, name):
+        key = "=" + name + "/"
+        with self.changing():
+            self.staging.seek(0, os.SEEK_END)
+            self.staging.write(pack_block(_DIRECTORY, key, 0))
+            self.add_appended(Extent(key, self.size, 0, True))
+
+
+    def add_appended(self, record):
+        self.size = record.content_end
+        self.records[record.key] = record
+        self.changed[record.key] = pack_entry(record.key, record.offset)
+        self.add_to_tree(record)
+
+
+    # Starts a batch, staging the appended blocks in memory (or in a
+    # temporary file once they get large) and the deleted blocks in a list
+    def begin(self):
+        directory = os.path.dirname(os.path.abspath(self.file_system))
+        self.staging = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE,
+                                                     dir = directory)
+        self.staged_from = self.size
+        self.pending = []
+        self.changed = {}
+
+
+    # Discards the changes of a batch. The records in memory are not
+    # restored, so the image must be loaded again if anything changed
+    def rollback(self):
+        if (self.size > self.staged_from or len(self.pending) != 0):
+            self.discarded = True
+        self.staging.close()
+        self.staging = None
+        self.pending = []
+
+
+    # Appends the staged blocks and a new table to the FS and marks the
+    # deleted blocks, makes them durable, then commits them by writing
+    # the other slot. The tables before the change still read the keys
+    # of the marked blocks from their entries
+    def commit(self):
+        staging = self.staging
+        self.staging = None
+        pending = self.pending
+        self.pending = []
+        with staging:
+            if (self.size == self.staged_from and len(pending) == 0):
+                return
+            try:
+                with Stats.phase("commit"):
+                    self.write_table(staging, pending)
+            except BaseException:
+                self.discarded = True
+                raise
+        self.compact_if_needed()
+
+
+    def write_table(self, staging, pending):
+        block, tables, changes = self.next_table()
+        staging.seek(0, os.SEEK_END)
+        staging.write(block)
+        number = 1 - self.slot[0]
+        sequence = self.slot[1] + 1
+
+        with open(self.file_system, "r+b") as f:
+            f.seek(self.staged_from)
+            staging.seek(0)
+            shutil.copyfileobj(staging, f, _CHUNK_SIZE)
+            f.truncate()
+            for record in pending:
+                f.seek(record.offset)
+                f.write(_DELETED)
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(_SLOTS_OFFSET + number * _SLOT.size)
+            f.write(pack_slot(sequence, self.size, len(block)))
+            f.flush()
+            os.fsync(f.fileno())
+            self.update_signature(f)
+
+        # The tables merged into the new one are old tables
+        for table in self.tables[len(tables):]:
+            self.dead_bytes = self.dead_bytes + table[1]
+        self.tables = tables + [[self.size, len(block), changes]]
+        self.changed = {}
+        self.slot = [number, sequence, self.size, len(block)]
+        self.size = self.size + len(block)
+
+
+    # Returns the table block of the changes, the tables before it that
+    # the new slot still leads to and the entries of the block by key.
+    # The changes are merged with the newest deltas that are at most
+    # twice as large, so that every delta is more than twice as large
+    # as the next one and a change is only written again a few times. A
+    # full table is written instead once the delta would be more than
+    # half as large
+    def next_table(self):
+        tables = list(self.tables)
+        changes = self.changed
+        while (changes != None and len(tables) > 1
+               and len(tables[-1][2]) <= 2 * len(changes)
+        ):
+            merged = dict(tables.pop()[2])
+            merged.update(changes)
+            changes = merged
+        if (changes == None or len(tables) == 0
+            or 2 * len(changes) > len(self.records)
+        ):
+            records = sorted(self.records.values(), key = lambda record: record.key.encode())
+            table = b"".join([_OFFSET.pack(pack_entry(record.key, record.offset))
+                              for record in records])
+            return _BLOCK.pack(_TABLE, 0, len(table)) + table, [], None
+        keys = sorted(changes, key = lambda key: key.encode())
+        table = _OFFSET.pack(tables[-1][0]) + b"".join([_OFFSET.pack(changes[key])
+                                                        for key in keys])
+        return _BLOCK.pack(_DELTA, 0, len(table)) + table, tables, changes
+
+
+    # Defragments the FS once the policy requires it, since every
+    # change leaves deleted blocks or merged tables behind
+    def compact_if_needed(self):
+        if (self.staging != None
+            or self.policy.should_compact(self) == False
+        ):
+            return [0, 0]
+        return self.defrag()
+
+
+    # Nothing is stored next to a binary FS
+    def flush(self):
+        pass
+
+
+    # Writes the live blocks into a new FS next to the FS, which then
+    # replaces it, and returns the number of records and bytes that
+    # were reclaimed
+    def defrag(self, replacing = contextlib.nullcontext):
+        size = self.size
+        reclaimed = 0
+        Stats.count("full_reads")
+        with open(self.file_system, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as notes:
+                for offset, kind, key, length, attributes in scan_blocks(notes):
+                    if (kind == _DELETED):
+                        reclaimed = reclaimed + 1
+        rewrite(self.file_system, lambda target: write_binary(target, self.entries()),
+                replacing)
+        self.load()
+        return [reclaimed, size - self.size]
+
+
+    # Returns the key, attributes and a function copying the stored
+    # contents of every live block, in the order of the FS
+    def entries(self):
+        records = sorted(self.records.values(), key = lambda record: record.offset)
+        return [[record.key, record.attributes,
+                 lambda target, record = record: copy_range(self.file_system, record, target)]
+                for record in records]
+
+
+# Finds single blocks in the table of the mapped FS with a binary
+# search on their keys, without loading the FS
+class TableScanner:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.file = open(file_system, "rb")
+        fs_stat = os.fstat(self.file.fileno())
+        self.signature = [fs_stat.st_size, fs_stat.st_mtime_ns]
+        self.notes = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.slot = read_slot(self.notes)
+        self.tables = read_chain(self.notes, self.slot)
+
+
+    # Checks if the FS was modified after it was mapped
+    def is_stale(self):
+        try:
+            fs_stat = os.stat(self.file_system)
+        except FileNotFoundError:
+            return True
+        return ([fs_stat.st_size, fs_stat.st_mtime_ns] != self.signature)
+
+
+    def close(self):
+        self.notes.close()
+        self.file.close()
+
+
+    # Returns the block of a key or None, searching the newest
+    # delta first and the full table last
+    def lookup(self, key):
+        wanted = key.encode()
+        for table in reversed(self.tables):
+            low = 0
+            high = table[3]
+            while (low < high):
+                middle = (low + high) // 2
+                entry = _OFFSET.unpack_from(self.notes, table[2] + middle * _OFFSET.size)[0]
+                found, length, attributes, deleted = read_entry(self.notes, entry)
+                Stats.count("records_scanned")
+                found = found.encode()
+                if (found == wanted):
+                    if (deleted == True):
+                        return None
+                    return Extent(key, entry & _OFFSET_MASK, length, True, attributes)
+                if (found < wanted):
+                    low = middle + 1
+                else:
+                    high = middle
+        return None
+
+
+# Read-only view of the contents of a file block, which are read
+# from the FS as they are, straight into the buffer of the reader
+class ExtentFile(io.RawIOBase):
+
+    def __init__(self, file_system, record):
+        self.name = record.name
+        self.start = record.header_end
+        self.size = record.length
+        self.file = open(file_system, "rb")
+        self.offset = 0
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.offset
+
+
+    def close(self):
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+        super().close()
+
+
+    def readinto(self, buffer):
+        wanted = min(len(buffer), self.size - self.offset)
+        if (wanted <= 0):
+            return 0
+        read = os.preadv(self.file.fileno(), [memoryview(buffer)[:wanted]],
+                         self.start + self.offset)
+        self.offset = self.offset + read
+        return read
+
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset = offset + self.offset
+        elif (whence == io.SEEK_END):
+            offset = offset + self.size
+        elif (whence != io.SEEK_SET):
+            raise ValueError("invalid whence (" + str(whence) + ")")
+        if (offset < 0):
+            raise ValueError("negative seek position " + str(offset))
+        self.offset = offset
+        return self.offset
+
+
+# Copies the contents of a file block to an open file, letting
+# the kernel copy them when it can
+def copy_range(file_system, record, target):
+    with open(file_system, "rb") as source:
+        send_range(source, record, target)
+
+
+# Copies the contents of a file block to an open file like
+# copy_range, reading the FS through an open file at absolute
+# offsets so that several threads can share it
+def send_range(source, record, target):
+    target.flush()
+    position = record.header_end
+    end = record.content_end
+    try:
+        while (position < end):
+            sent = os.sendfile(target.fileno(), source.fileno(), position,
+                               end - position)
+            if (sent == 0):
+                break
+            position = position + sent
+    except (OSError, AttributeError, io.UnsupportedOperation):
+        # Copying through a buffer from where the kernel stopped
+        target.seek(0, os.SEEK_END)
+        for chunk in read_chunks(source, position, end):
+            target.write(chunk)
+    target.seek(0, os.SEEK_END)
+
+
+# Yields the bytes between two offsets of the FS a chunk at a time,
+# reading them with os.pread through an open file
+def read_chunks(source, position, end):
+    while (position < end):
+        chunk = os.pread(source.fileno(), min(_CHUNK_SIZE, end - position), position)
+        if (len(chunk) == 0):
+            break
+        position = position + len(chunk)
+        yield chunk
+
+
+# Copies the contents of a file block to an external file,
+# decompressing them if they are compressed
+def copy_file(file_system, record, external_file):
+    with open(file_system, "rb") as source:
+        export_file(source, record, external_file)
+
+
+# Copies the contents of a file block to an external file like
+# copy_file, reading the FS through an open file that threads can share
+def export_file(source, record, external_file):
+    codec = Compression.get_codec(record.attributes)
+    with open(external_file, "wb") as target:
+        if (codec == None):
+            send_range(source, record, target)
+        else:
+            writer = Compression.DecompressingWriter(target, codec)
+            for chunk in read_chunks(source, record.header_end, record.content_end):
+                writer.write(chunk)
+
+
+# Writes a binary FS from the key, attributes and a function
+# copying the stored contents of every block
+def write_binary(target, entries):
+    target.write(HEADER + bytes(2 * _SLOT.size))
+    offsets = []
+    for key, attributes, copy in entries:
+        start = target.tell()
+        offsets.append([key.encode(), pack_entry(key, start)])
+        if (key[0] != "="):
+            kind = key[0].encode()
+            header = pack_block(kind, key, 0, attributes)
+            target.write(header)
+            copy(target)
+            # Writing the length once the contents were copied
+            length = target.tell() - start - len(header)
+            target.seek(start)
+            target.write(pack_block(kind, key, length, attributes))
+            target.seek(0, os.SEEK_END)
+        else:
+            target.write(pack_block(_DIRECTORY, key, 0))
+    table = b"".join([_OFFSET.pack(entry) for key, entry in sorted(offsets)])
+    start = target.tell()
+    target.write(_BLOCK.pack(_TABLE, 0, len(table)) + table)
+    target.seek(_SLOTS_OFFSET)
+    target.write(pack_slot(1, start, _BLOCK.size + len(table)))
+    target.seek(0, os.SEEK_END)
+
+
+# Writes a text FS from the key, attributes and a function copying the
+# stored contents of every record, the way copyin and mkdir append them.
+# Compressed contents are written as lines of base64
+def write_text(target, entries):
+    target.write(b"NOTES V1.0\n")
+    # Whether the last record written ends with a new-line character
+    ended = True
+    for key, attributes, copy in entries:
+        if (ended == False):
+            target.write(b"\n")
+        if (key[0] != "="):
+            target.write(Notes.join_header(key, attributes).encode() + b"\n")
+            # Adding a space to every line of the contents, which are
+            # read back the same even if they end with new-line characters
+            with tempfile.TemporaryFile() as contents, tempfile.TemporaryFile() as lines:
+                copy(contents)
+                contents.seek(0)
+                exact = (Compression.get_codec(attributes) == None)
+                if (exact == False):
+                    for text in Compression.encode_lines(contents):
+                        lines.write(text)
+                    contents = lines
+                    contents.seek(0)
+                size = Notes.write_content_lines(contents, target, exact)[0]
+            # Lines of base64 end with a new-line character while
+            # contents written exactly never do
+            ended = (size == 0 or exact == False)
+        else:
+            target.write(key.encode())
+            ended = False
+
+
+# Writes a new FS next to a FS with a function, then replaces the FS
+# with it once it is on disk
+def rewrite(file_system, write, replacing):
+    path = os.path.abspath(file_system)
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(path) + ".",
+                                     suffix = ".defrag", dir = directory)
+    Stats.count("full_reads")
+    Stats.count("full_writes")
+    try:
+        with os.fdopen(fd, "wb") as target, Stats.phase("rewrite"):
+            write(target)
+            target.flush()
+            os.fsync(target.fileno())
+        os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        # Only the replace has to wait for the readers of the old FS
+        with replacing():
+            os.replace(temp_path, path)
+            Notes.sync_directory(directory)
+    except BaseException:
+        if (os.path.exists(temp_path)):
+            os.unlink(temp_path)
+        raise
+
+
+# Returns the key, attributes and a function copying the stored contents
+# of every live record of a parsed text FS, in the order of the FS.
+# Compressed contents are decoded from the lines of base64 they are
+# stored as
+def text_entries(image):
+    records = [record for record in image.records.values() if (record.live == True)]
+    records.sort(key = lambda record: record.offset)
+    entries = []
+    for record in records:
+        if (Compression.get_codec(record.attributes) == None):
+            copy = Notes.copy_contents
+        else:
+            copy = Notes.copy_decoded
+        entries.append([record.key, record.attributes,
+                        lambda target, record = record, copy = copy:
+                            copy(image.file_system, record, target)])
+    return entries
+
+
+# Returns the key, attributes and a function copying the stored
+# contents of every live record of a parsed text or binary FS
+def image_entries(image):
+    if (isinstance(image, BinaryImage)):
+        return image.entries()
+    return text_entries(image)
+
+
+# Rewrites a FS in the text ("V1.0") or binary ("V2.0") format
+def convert(image, version, replacing = contextlib.nullcontext):
+    entries = image_entries(image)
+    if (version == "V2.0"):
+        write = lambda target: write_binary(target, entries)
+    else:
+        write = lambda target: write_text(target, entries)
+    rewrite(image.file_system, write, replacing)
+
+
+# Loads the image of a binary FS
+def load_image(file_system):
+    image = BinaryImage(file_system)
+    image.load()
+    return image
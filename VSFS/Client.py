@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import socket
+
+_OPERATION = 1
+_FILESYSTEM = 2
+_RECURSIVE_FLAG = "-r"
+# List of operations that can be run by the server of a FS
+_REMOTE_OPERATIONS = [
+    "list", "copyin", "copyout", "mkdir",
+    "rm", "rmdir", "defrag", "convert", "search"
+]
+# Environment variable with the socket of the server,
+# which is otherwise next to the FS
+_SOCKET_VARIABLE = "VSFS_SOCKET"
+_SOCKET_EXTENSION = ".sock"
+
+
+# Returns the path of the socket of the server of a FS
+def get_socket_path(file_system):
+    path = os.environ.get(_SOCKET_VARIABLE, "")
+    if (path == ""):
+        path = file_system + _SOCKET_EXTENSION
+    return path
+
+
+# Connects to the server listening on a socket and
+# returns None if there is no server
+def connect(socket_path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+# Makes the paths of the FS and of the external files absolute
+# since the server does not share the working directory
+def get_remote_command(command):
+    remote = list(command)
+    remote[_FILESYSTEM] = os.path.abspath(remote[_FILESYSTEM])
+    recursive = (len(remote) == 6 and remote[3] == _RECURSIVE_FLAG)
+    if (remote[_OPERATION] == "copyin" and recursive == True):
+        remote[4] = os.path.abspath(remote[4])
+    elif (remote[_OPERATION] == "copyin"):
+        # The EF of every EF and IF pair
+        for i in range(3, len(remote) - 1, 2):
+            remote[i] = os.path.abspath(remote[i])
+    elif (remote[_OPERATION] == "copyout" and recursive == True):
+        remote[5] = os.path.abspath(remote[5])
+    elif (len(remote) == 5 and remote[_OPERATION] == "copyout"):
+        remote[4] = os.path.abspath(remote[4])
+    return remote
+
+
+# Runs a command on the server of its FS, printing its output and
+# errors, and returns its exit code or None if the command must be
+# run locally because no server is running for the FS
+def run(command):
+    if (len(command) < 3 or command[_OPERATION] not in _REMOTE_OPERATIONS):
+        return None
+    connection = connect(get_socket_path(command[_FILESYSTEM]))
+    if (connection == None):
+        return None
+
+    request = {"command": get_remote_command(command)}
+    try:
+        with connection:
+            connection.sendall(json.dumps(request).encode() + b"\n")
+            with connection.makefile("rb") as f:
+                line = f.readline()
+        response = json.loads(line)
+    except (OSError, ValueError):
+        # The command may have been run, so it is not run again
+        print("Invalid VSFS: Server Closed The Connection", file = sys.stderr)
+        return 1
+
+    # The server is running for another FS
+    if (response.get("served") == False):
+        return None
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["code"]
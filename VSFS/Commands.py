@@ -1,23 +1,49 @@
 #!/usr/bin/python3
 import sys
 import os
+import shlex
 import time
-import subprocess
+import stat
 from pathlib import Path
+import Library
+import Segments
+import Stats
 
 _OPERATION = 1
 _FILESYSTEM = 2
+# Flag of copyin and copyout to copy a dir and everything under it
+_RECURSIVE_FLAG = "-r"
+# Flag of index to build the search index of the FS
+_SEARCH_FLAG = "--search"
 # List of valid operations
 _OPERATIONS = [
     "list","copyin","copyout","mkdir",
-    "rm", "rmdir", "defrag", "index"
+    "rm", "rmdir", "defrag", "index", "batch", "serve",
+    "convert", "search"
+]
+# List of operations that can be used in a batch
+_BATCH_OPERATIONS = [
+    "copyin", "mkdir", "rm", "rmdir"
 ]
 
 class VSFSCommands:
+
+    def __init__(self):
+        # Caching every opened FS so that a command
+        # reads the FS at most once
+        self.file_systems = {}
+        # Streams the output and errors are printed to, which
+        # are the standard ones unless a server replaces them
+        self.stdout = None
+        self.stderr = None
+
  
     # Prints errors using stderr
     def print_stderr(self, *error):
-        print(*error, file = sys.stderr)
+        if (self.stderr == None):
+            print(*error, file = sys.stderr)
+        else:
+            print(*error, file = self.stderr)
 
 
     # Verifies if the entered operation is valid
@@ -31,73 +57,51 @@ class VSFSCommands:
             return True
 
 
+    # Calls a method of the library, printing its error
+    # and exiting instead of raising it
+    def call(self, method, *arguments):
+        try:
+            return method(*arguments)
+        except Library.VSFSError as e:
+            self.print_stderr("Invalid VSFS: " + str(e))
+            exit(1)
+
+
+    # Returns the opened FS, opening it if it was never opened
+    def open_file_system(self, file_system):
+        vsfs = self.file_systems.get(file_system)
+        if (vsfs == None):
+            if (Segments.is_segmented(file_system) == True):
+                vsfs = self.call(Segments.SegmentedVSFS, file_system)
+            else:
+                vsfs = self.call(Library.VSFS, file_system)
+            self.file_systems[file_system] = vsfs
+        return vsfs
+
+
     # Verifies if the entered File System is valid
     def check_file_system(self, file_system):
         extension = ".notes"
 
-        # Checking if FS exists
-        try:
-            with open(file_system, "r") as f:
-                pass
-        except FileNotFoundError:
-            self.print_stderr("Invalid VSFS: File System Not Found")
-            exit(1)
-        else:
-            if extension in file_system:
-                # Checking if first line is "NOTES V1.0"
-                with open(file_system, "r") as f:
-                    first_line = f.readline().rstrip()
-                    if (first_line == "NOTES V1.0"):
-                        return True
-                    else:
-                        self.print_stderr("Invalid VSFS: File System Is Not Valid")
-                        exit(1)
+        # Checking if FS exists and if its first line is "NOTES V1.0",
+        # unless it is the manifest of a segmented FS
+        if (Segments.is_segmented(file_system) == False):
+            self.call(Library.check_file_system, file_system)
+        if extension in file_system:
+            return True
 
 
     # Verifies if the entered Internal File path is valid
+    # and if the dirs above it exist
     def check_internal_file(self, internal_file, file_system):
-        # Checking if IF ends or starts with "/" or
-        # if it is ".", "..", or "/"
-        wrong_if = (internal_file[len(internal_file) - 1] == "/" 
-                    or internal_file[0] == "/" 
-                    or internal_file == "." 
-                    or internal_file == ".."
-                    or internal_file == "/")
-
-        if (wrong_if == False):
-            s = internal_file
-            l = s.split('/')
-            # Checking if the path provided exists
-            if (len(l) > 1):
-                i = 0
-                dir = l[i]
-                while(i != len(l)-1):
-                    index = self.check_internal_directory(dir, file_system)[0]
-                    if (index == -1):
-                        self.print_stderr("Invalid VSFS: Invalid Path To Internal File")
-                        exit(1)
-                    dir = dir + "/" + l[i+1]
-                    i = i + 1
-            
-            return True
-        else:
-            self.print_stderr("Invalid VSFS: Invalid Internal File")
-            exit(1)
+        self.call(self.open_file_system(file_system).check_path, internal_file)
+        return True
 
 
     # Verifies if the entered External File is valid
     def check_external_file(self, external_file):
-        try:
-            with open(external_file, "r") as f:
-                pass
-        except FileNotFoundError:
-            self.print_stderr("Invalid VSFS: External File Not Found")
-            exit(1)
-        except IsADirectoryError:
-            self.print_stderr("Invalid VSFS: Invalid External File")
-            exit(1)
-        else:
-            return True
+        self.call(Library.check_external_file, external_file)
+        return True
 
 
     
@@ -106,31 +110,40 @@ class VSFSCommands:
     # position of ID in FS in a result array 
     def check_internal_directory(self, internal_directory, file_system):
         int_dir = "=" + internal_directory + "/"
-        result = []
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
+        return self.lookup_record(file_system, int_dir)
 
-        # Checking if ID already exists in the FS array
-        try:
-            # If ID is not in the last line of FS,
-            # It will end with "\n"
-            index = contents.index(int_dir + "\n")
-        except ValueError:
+
+    # Returns the parsed image of the FS, loading it from its index
+    # or parsing it if it was never loaded or if the FS has changed since
+    def get_image(self, file_system):
+        vsfs = self.open_file_system(file_system)
+        return self.call(vsfs.get_image)
+
+
+    # Parses the FS from scratch after it was rewritten
+    def update_image(self, file_system):
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.reindex)
+
+
+    # Looks up a live file/dir record in the FS and 
+    # returns exact line of the record in FS and
+    # position of the record in FS in a result array
+    def lookup_record(self, file_system, record):
+        result = []
+        vsfs = self.open_file_system(file_system)
+        with Stats.phase("lookup"):
+            entry = self.call(vsfs.lookup, record)
+        if (entry == None):
             index = -1
         else:
-            int_dir = int_dir + "\n"
-
-        if (index == -1):
-            try:
-                # If ID is in the last line of FS,
-                # It will not end with "\n"
-                index = contents.index(int_dir)
-            except ValueError:
-                index = -1
-        
+            index = entry.line
+            # Only the last line of FS does not end with "\n"
+            if (entry.has_newline() == True):
+                record = record + "\n"
+
         result.append(index)
-        result.append(int_dir)
+        result.append(record)
         return result
         
 
@@ -141,69 +154,120 @@ class VSFSCommands:
             file_system = command[_FILESYSTEM]
             if (self.check_operation(operation) == True):
                 if (self.check_file_system(file_system) == True):
+                    return self.check_arguments(command, length)
+        else:
+            self.print_stderr("Invalid VSFS: WRONG COMMAND")
+            exit(1)
 
-                    if (length == 3 
-                        and (operation == "defrag" 
-                        or operation == "index"
-                        or operation == "list")
-                    ):
-                        return True
-                    elif (length == 4 
-                        and (operation == "mkdir" 
-                        or operation == "rm"
-                        or operation == "rmdir")
-                    ):
-
-                        internal_directory = ""
-                        internal_file = ""
-
-                        if (operation == "rm"):
-                            internal_file = command[3]
-                            if (self.check_internal_file(internal_file, file_system) 
-                                == True):
-                                return True
-                        elif (operation == "mkdir"):
-                            internal_directory = command[3]
-                            result = self.check_internal_directory(internal_directory, file_system)
-                            index = result[0]
-                            if (index != -1):
-                                self.print_stderr("Invalid VSFS: Internal Directory" + 
-                                "Already Exists")
-                                exit(1)
-                            else:
-                                return True
-                        elif (operation == "rmdir"):
-                            internal_directory = command[3]
-                            result = self.check_internal_directory(internal_directory, file_system)
-                            index = result[0]
-                            if (index == -1):
-                                self.print_stderr("Invalid VSFS: Internal Directory" +
-                                "Does Not Exist")
-                                exit(1)
-                            else:
-                                return True
-                    elif (length == 5 
-                        and (operation == "copyin" 
-                        or operation == "copyout")
-                    ):
-
-                        internal_file = ""
-                        external_file = ""
-
-                        if (operation == "copyin"):
-                            external_file = command[3]
-                            internal_file = command[4]
-                        else:
-                            external_file = command[4]
-                            internal_file = command[3]
-
-                        if (self.check_internal_file(internal_file, file_system) == True 
-                            and self.check_external_file(external_file) == True
-                        ):
-                            return True                  
-                    else:
-                        self.print_stderr("Invalid VSFS: WRONG COMMAND")
-                        exit(1)
+
+    # Verifies if the arguments of the entered operation are valid
+    # for a FS that was already verified
+    def check_arguments(self, command, length):
+        operation = command[_OPERATION]
+        file_system = command[_FILESYSTEM]
+
+        if (length == 3 
+            and (operation == "defrag" 
+            or operation == "index"
+            or operation == "list"
+            or operation == "batch"
+            or operation == "serve")
+        ):
+            return True
+        elif (length == 4 
+            and (operation == "mkdir" 
+            or operation == "rm"
+            or operation == "rmdir"
+            or operation == "batch"
+            or operation == "serve"
+            or operation == "convert"
+            or operation == "search"
+            or operation == "index"
+            or operation == "list")
+        ):
+
+            internal_directory = ""
+            internal_file = ""
+
+            if (operation == "rm"):
+                internal_file = command[3]
+                if (self.check_internal_file(internal_file, file_system) 
+                    == True):
+                    return True
+            elif (operation == "mkdir"):
+                internal_directory = command[3]
+                result = self.check_internal_directory(internal_directory, file_system)
+                index = result[0]
+                if (index != -1):
+                    self.print_stderr("Invalid VSFS: Internal Directory" + 
+                    "Already Exists")
+                    exit(1)
+                else:
+                    return True
+            elif (operation == "rmdir"):
+                internal_directory = command[3]
+                result = self.check_internal_directory(internal_directory, file_system)
+                index = result[0]
+                if (index == -1):
+                    self.print_stderr("Invalid VSFS: Internal Directory" +
+                    "Does Not Exist")
+                    exit(1)
+                else:
+                    return True
+            elif (operation == "batch"):
+                # Reading the operations from stdin if the script is "-"
+                script = command[3]
+                if (script == "-" or self.check_external_file(script) == True):
+                    return True
+            elif (operation == "serve"):
+                # Any path can be used for the socket of the server
+                return True
+            elif (operation == "convert"):
+                # The version is checked when converting
+                return True
+            elif (operation == "search"):
+                # Any string can be searched
+                return True
+            elif (operation == "index" and command[3] == _SEARCH_FLAG):
+                return True
+            elif (operation == "list"):
+                # The dir is checked when it is listed
+                return True
+            else:
+                self.print_stderr("Invalid VSFS: WRONG COMMAND")
+                exit(1)
+        elif (length == 5 
+            and (operation == "copyin" 
+            or operation == "copyout")
+        ):
+
+            internal_file = ""
+            external_file = ""
+
+            if (operation == "copyin"):
+                external_file = command[3]
+                internal_file = command[4]
+            else:
+                external_file = command[4]
+                internal_file = command[3]
+
+            if (self.check_internal_file(internal_file, file_system) == True 
+                and self.check_external_file(external_file) == True
+            ):
+                return True                  
+        elif (length == 6 
+            and command[3] == _RECURSIVE_FLAG
+            and (operation == "copyin" 
+            or operation == "copyout")
+        ):
+            # The dirs are checked when they are copied
+            return True
+        elif (length > 5 and length % 2 == 1 and operation == "copyin"):
+            # Checking the EF of every pair, the IFs are checked against
+            # the dir tree at once when they are copied in
+            for external_file in command[3::2]:
+                self.check_external_file(external_file)
+            return True
         else:
             self.print_stderr("Invalid VSFS: WRONG COMMAND")
             exit(1)
@@ -213,324 +277,224 @@ class VSFSCommands:
     # position of IF in FS in a result array 
     def does_if_exist(self, file_system, internal_file):
         int_file = "@" + internal_file
-        result = []
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-
-        # Checking if IF already exists in the FS array
-        try:
-            # If IF is not in the last line of FS,
-            # It will end with "\n"
-            index = contents.index(int_file + "\n")
-        except ValueError:
-            index = -1
-        else:
-            int_file = int_file + "\n"
-
-        if (index == -1):
-            try:
-                # If IF is in the last line of FS,
-                # It will not end with "\n"
-                index = contents.index(int_file)
-            except ValueError:
-                index = -1
-        result.append(index)
-        result.append(int_file)
-        return result
+        return self.lookup_record(file_system, int_file)
 
 
     # Executes the 'copyin' command
     def do_copyin(self, file_system, external_file, internal_file):
-        # Gathering contents of EF in an array
-        with open(external_file, "r") as f:
-            text = f.readlines()
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.copyin, external_file, internal_file)
+
+
+    # Executes the 'copyin' command with several EF and IF pairs,
+    # copying them all in as a single change
+    def do_copyin_many(self, file_system, arguments):
+        vsfs = self.open_file_system(file_system)
+        pairs = [[arguments[i], arguments[i + 1]] for i in range(0, len(arguments), 2)]
+        self.call(vsfs.copyin_many, pairs)
 
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        
-        # Fetching index of IF 
-        result = self.does_if_exist(file_system, internal_file)
-        index = result[0]
-        int_file = result[1]
-        # Appending the new file to the FS
-        if (index == -1):
-            contents.append("\n" + int_file + "\n")     
-        else:
-            # Deleting the file and its contents if it was found
-            contents = self.do_rm(file_system, internal_file)
-            # Appending the new file to the FS 
-            # after deleting the existing file
-            int_file = int_file.strip()
-            contents.append("\n" + int_file + "\n")
-            
-        # Adding a space to every line in the text to be copied 
-        for x in text:
-            x = " " + x
-            contents.append(x)
 
-        # Making changes to FS
-        with open(file_system, "w") as f:
-            contents = "".join(contents)
-            f.write(contents)     
+    # Executes the 'copyin -r' command, copying an ED and everything
+    # under it into the FS as an ID
+    def do_copyin_tree(self, file_system, external_directory, internal_directory):
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.copyin_tree, external_directory, internal_directory)
+
+
+    # Executes the 'copyout -r' command, copying an ID and everything
+    # under it to an ED
+    def do_copyout_tree(self, file_system, internal_directory, external_directory):
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.copyout_tree, internal_directory, external_directory)
 
 
     # Executes the 'copyout' command
     def do_copyout(self, file_system, internal_file, external_file):
-        # Gathering contents of EF in an array
-        with open(external_file, "r") as f:
-            text = f.readlines()
-
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-
-        # Fetching index of IF
-        result = self.does_if_exist(file_system, internal_file)
-        index = result[0]
-        # Throwing error if IF is invalid
-        if (index == -1):
-            self.print_stderr("Invalid VSFS: Internal File Does Not Exist")
-            exit(1)
-        else:
-            index = index + 1
-            # Fetching contents if it was found
-            while(index != len(contents)):
-                if (contents[index][0] == " "):
-                    line = contents[index][1:]
-                    text.append(line)
-                    index = index + 1
-                else:
-                    index = len(contents)
-        
-        # Removing new-line character from the last line
-        text[len(text) - 1] = text[len(text) - 1].strip()
-        # Making changes to EF
-        with open(external_file, "w") as f:
-            text = "".join(text)
-            f.write(text)  
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.copyout, internal_file, external_file)
 
 
     # Executes the 'mkdir' command 
     def do_mkdir(self, file_system, internal_directory):  
-        int_dir = "=" + internal_directory + "/"
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines() 
-
-        # Appending the new directory to the FS
-        contents.append("\n" + int_dir)
-        # Making changes to FS
-        with open(file_system, "w") as f:
-            contents = "".join(contents)
-            f.write(contents) 
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.mkdir, internal_directory)
 
 
     # Executes the 'rm' command
     def do_rm(self, file_system, internal_file):
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        
-        # Fetching index of IF 
-        result = self.does_if_exist(file_system, internal_file)
-        index = result[0]
-        int_file = result[1]
-        if (index == -1):
-            self.print_stderr("Invalid VSFS: Internal File Does Not Exist")
-            exit(1)
-        else:
-            # Deleting the file and its contents if it was found
-            while(index != len(contents)):
-                if (contents[index][0] == " " 
-                    or int_file == contents[index]
-                ):
-                    contents[index] = "#" + contents[index]
-                    index = index + 1
-                else:
-                    index = len(contents) 
-
-        result = contents      
-        # Making changes to FS
-        with open(file_system, "w") as f:
-            contents = "".join(contents)
-            f.write(contents)   
-        return result
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.remove, internal_file)
 
 
     # Executes the 'rmdir' command
     def do_rmdir(self, file_system, internal_directory): 
-        # Getting index of the internal directory
-        result = self.check_internal_directory(internal_directory, file_system)
-        index = result[0]
-        int_dir = result[1]
-
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        # Pattern of a file/directory inside this directory
-        # @dir/file or =dir/dir
-        pattern_1 =  "@" + int_dir[1:].strip()
-        pattern_2 = int_dir.strip()
-
-        # Deleting the files under the directory and their contents
-        while(index != len(contents)):
-            if (pattern_1 in contents[index]):
-                int_file = contents[index][1:].strip()
-                contents = self.do_rm(file_system, int_file) 
-                # Removing the file and it's size from the dictionary
-                # since it is being removed from FS
-                # SIZES.pop(int_file)
-                # del SIZES[int_file]
-                index = index + 1
-            else:
-                index = index + 1
-
-        index = result[0]
-        # Deleting the directories under the internal directory
-        while(index != len(contents)):
-            if (pattern_2 in contents[index] 
-                and int_dir != contents[index]
-            ):
-                contents[index] = "#" + contents[index]
-                index = index + 1
-            else:
-                index = index + 1
-        
-        index = result[0]
-        # Deleting the internal directory itself
-        while(index != len(contents)):
-            if (int_dir == contents[index]):
-                contents[index] = "#" + contents[index]
-                index = index + 1
-            else:
-                index = index + 1
-        
-        # Making changes to FS
-        with open(file_system, "w") as f:
-            contents = "".join(contents)
-            f.write(contents)   
+        vsfs = self.open_file_system(file_system)
+        self.call(vsfs.rmtree, internal_directory)
 
 
     # Executes the 'defrag' command
     def do_defrag(self, file_system):
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        
-        index = 0
-        # Deleting the lines that start with "#"
-        while(index != len(contents)):
-            if (contents[index][0] == "#"):
-                contents.pop(index)
-            else:
-                index = index + 1
-        
-        # Removing new-line character from the last line
-        contents[len(contents) - 1] = contents[len(contents) - 1].rstrip()
-        # Making changes to FS
-        with open(file_system, "w") as f:
-            contents = "".join(contents)
-            f.write(contents) 
+        # Streaming the lines that do not start with "#" into a new FS
+        # which then replaces the old one
+        vsfs = self.open_file_system(file_system)
+        result = self.call(vsfs.defrag)
+        print("Defragmented VSFS: Reclaimed " + str(result[0]) + " Records (" 
+            + str(result[1]) + " Bytes)", file = self.stdout)
+
+
+    # Executes the 'batch' command, applying every operation of the
+    # script to the image of FS and writing them all at once, or
+    # none of them if any operation fails
+    def do_batch(self, file_system, script):
+        if (script == None or script == "-"):
+            lines = sys.stdin
+        else:
+            lines = open(script, "r")
 
+        vsfs = self.open_file_system(file_system)
+        transaction = self.call(vsfs.transaction)
+        number = 0
+        try:
+            with lines, transaction:
+                for line in lines:
+                    number = number + 1
+                    # Each line is an operation and its arguments without FS,
+                    # eg. "copyin ef dir1/note1"
+                    words = shlex.split(line, comments = True)
+                    if (len(words) == 0):
+                        continue
+                    if (words[0] not in _BATCH_OPERATIONS):
+                        self.print_stderr("Invalid VSFS: Operation Not Allowed In Batch")
+                        exit(1)
+                    command = ["batch", words[0], file_system] + words[1:]
+                    if (self.check_arguments(command, len(command)) == True):
+                        self.execute(command)
+        except (SystemExit, ValueError):
+            # Every change of the batch was discarded
+            self.print_stderr("Invalid VSFS: Batch Failed At Line " + str(number))
+            exit(1)
 
-    # Returns the number of directories one level below
-    def get_link_count(self, internal_directory, file_system):
 
-        link_count = 0
-        # Getting index of the internal directory
-        result = self.check_internal_directory(internal_directory, file_system)
-        index = result[0]
-        int_dir = result[1]
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        
-        # Pattern of a directory inside this directory
-        # =dir/dir
-        pattern = int_dir.strip()
-        # Finding the directories under the internal directory
-        index = index + 1
-        while(index != len(contents)):
-            if (pattern in contents[index]):
-                path = contents[index][1:].strip()
-                list = path.split("/")
-                input = internal_directory.split("/")
-                # Checking if no.of.dir under given dir 
-                # in the current path (line) is 1, so that 
-                # we know it is sub dir of given dir
-                if (len(list) == len(input) + 2):
-                    link_count = link_count + 1
-            
-            index = index + 1
+    # Executes the 'serve' command, keeping the image of the FS in
+    # memory and running the commands of clients until interrupted
+    def do_serve(self, file_system, socket_path):
+        # Importing the server only here since it is not needed
+        # by the other commands
+        import Server
+        if (socket_path == None):
+            socket_path = Server.get_socket_path(file_system)
+        try:
+            Server.serve(file_system, socket_path, self)
+        except OSError as e:
+            self.print_stderr("Invalid VSFS: Cannot Serve On " + socket_path
+                              + " (" + e.strerror + ")")
+            exit(1)
+
+
+    # Executes the 'convert' command
+    def do_convert(self, file_system, version):
+        # Rewriting the FS in the other format into a new FS
+        # which then replaces the old one
+        vsfs = self.open_file_system(file_system)
+        if (version == Segments.VERSION and isinstance(vsfs, Library.VSFS) == True):
+            self.call(Segments.split, vsfs)
+        else:
+            self.call(vsfs.convert, version)
+        # Opening the FS again since it may now be segmented or not
+        self.file_systems.pop(file_system, None)
+        vsfs.close()
+        print("Converted VSFS: " + file_system + " To " + version, file = self.stdout)
+
+
+    # Executes the 'index' command
+    def do_index(self, file_system, search = False):
+        # Rebuilding the sidecar index of the FS from scratch
+        self.update_image(file_system)
+        if (search == True):
+            # Building the search index, which every change
+            # of the FS then keeps up to date
+            vsfs = self.open_file_system(file_system)
+            self.call(vsfs.rebuild_search)
+
+
+    # Executes the 'search' command, printing the IFs
+    # that contain a string in alphabetical order
+    def do_search(self, file_system, pattern):
+        vsfs = self.open_file_system(file_system)
+        paths = self.call(vsfs.search, pattern)
+        if (len(paths) != 0):
+            print("\n".join(paths), file = self.stdout)
+
 
-        return link_count
+    # Returns the number of directories one level below
+    def get_link_count(self, internal_directory, file_system):
+        vsfs = self.open_file_system(file_system)
+        if (vsfs.isdir(internal_directory) == False):
+            return 0
+        return vsfs.stat(internal_directory).st_nlink
 
 
-    # Executes the 'list' command
-    def do_list(self, file_system):
+    # Executes the 'list' command, listing everything under
+    # an ID if one is given or the whole FS otherwise
+    def do_list(self, file_system, internal_directory = ""):
         # Fetching permissions, owner, group, file size, date time of the FS
-        permissions = str(subprocess.check_output(["ls", "-l", file_system]))
-        permissions = permissions[3:12]
+        # from a single stat instead of running "ls -l"
+        fs_stat = os.stat(file_system)
+        permissions = stat.filemode(fs_stat.st_mode)[1:]
         path = Path(file_system)
         owner = path.owner()
         group = path.group()
-        file_size = str(os.stat(file_system).st_size)
-        date_time = str(time.ctime(os.path.getctime(file_system)))
+        file_size = str(fs_stat.st_size)
+        date_time = str(time.ctime(fs_stat.st_ctime))
         date_time = date_time[4:len(date_time) - 8]
 
+        format = " " + owner + " " + group + " " + file_size + " " + date_time + " "
+
         # Creating a dictionary to store the names of file/dir
-        # and their corresponding "list" result
+        # and their corresponding "list" result, with the stored
+        # and logical sizes of every file before its name
         ls = {}
-        # Gathering contents of FS in an array
-        with open(file_system, "r") as f:
-            contents = f.readlines()
-        
-        format = " " + owner + " " + group + " " + file_size + " " + date_time + " "
-        
-        # Scanning through notes file from index 1
-        # since index 0 is "NOTES V1.0"
-        index = 1
-        while(index != len(contents)):
-            # Checking if it's a file or dir
-            if (contents[index][0] == "@" 
-            or contents[index][0] == "=" 
-            ):
-                if (contents[index][0] == "@"):
-                    file_name = contents[index][1:].strip()
-                    attribute = "-" + permissions
-                    N = "  1"
-                    file_format = attribute + " " + N + format + file_name 
-                    ls[file_name] = file_format
-                else:
-                    dir_name = contents[index][1:].strip()
-                    attribute = "d" + permissions
-                    lc = self.get_link_count(dir_name[0:len(dir_name)-1], file_system)
-                    N = str(lc)
-                    dir_format = attribute + " " + N + format + dir_name
-                    ls[dir_name] = dir_format
-            index = index + 1
+        vsfs = self.open_file_system(file_system)
+        for entry in self.call(vsfs.entries, internal_directory):
+            sizes = str(entry.stored_size) + " " + str(entry.st_size) + " "
+            if (entry.is_dir() == True):
+                dir_name = entry.name + "/"
+                attribute = "d" + permissions
+                N = str(entry.st_nlink)
+                ls[dir_name] = attribute + " " + N + format + sizes + dir_name
+            else:
+                file_name = entry.name
+                attribute = "-" + permissions
+                N = "  1"
+                ls[file_name] = attribute + " " + N + format + sizes + file_name
 
         # Sorting file and dir names in alphabetical order (like ls)
-        names = ls.keys()
-        names = sorted(names)
-        i = 0
-        # Printing all ls values
-        while (i != len(ls)):
-            print(ls[names[i]])
-            i = i + 1
+        # and printing all ls values at once
+        names = sorted(ls.keys())
+        if (len(names) != 0):
+            print("\n".join([ls[name] for name in names]), file = self.stdout)
             
             
     # Executes the entered command
     def execute(self, command):
 
         if (command[_OPERATION] == "list"):
-            self.do_list(command[_FILESYSTEM])
+            if (len(command) > 3):
+                self.do_list(command[_FILESYSTEM], command[3])
+            else:
+                self.do_list(command[_FILESYSTEM])
         elif (command[_OPERATION] == "copyin"):
-            self.do_copyin(command[_FILESYSTEM], command[3], command[4])
+            if (command[3] == _RECURSIVE_FLAG and len(command) == 6):
+                self.do_copyin_tree(command[_FILESYSTEM], command[4], command[5])
+            elif (len(command) > 5):
+                self.do_copyin_many(command[_FILESYSTEM], command[3:])
+            else:
+                self.do_copyin(command[_FILESYSTEM], command[3], command[4])
         elif (command[_OPERATION] == "copyout"):
-            self.do_copyout(command[_FILESYSTEM], command[3], command[4])
+            if (command[3] == _RECURSIVE_FLAG and len(command) == 6):
+                self.do_copyout_tree(command[_FILESYSTEM], command[4], command[5])
+            else:
+                self.do_copyout(command[_FILESYSTEM], command[3], command[4])
         elif (command[_OPERATION] == "mkdir"):
             self.do_mkdir(command[_FILESYSTEM], command[3])
         elif (command[_OPERATION] == "rm"):
@@ -539,6 +503,19 @@ class VSFSCommands:
             self.do_rmdir(command[_FILESYSTEM], command[3])
         elif (command[_OPERATION] == "defrag"):
             self.do_defrag(command[_FILESYSTEM])
+        elif (command[_OPERATION] == "batch"):
+            if (len(command) > 3):
+                self.do_batch(command[_FILESYSTEM], command[3])
+            else:
+                self.do_batch(command[_FILESYSTEM], None)
         elif (command[_OPERATION] == "index"):
-            self.print_stderr("Not implemented.")
-            exit(1)
\ No newline at end of file
+            self.do_index(command[_FILESYSTEM], (len(command) > 3))
+        elif (command[_OPERATION] == "search"):
+            self.do_search(command[_FILESYSTEM], command[3])
+        elif (command[_OPERATION] == "convert"):
+            self.do_convert(command[_FILESYSTEM], command[3])
+        elif (command[_OPERATION] == "serve"):
+            if (len(command) > 3):
+                self.do_serve(command[_FILESYSTEM], command[3])
+            else:
+                self.do_serve(command[_FILESYSTEM], None)
\ No newline at end of file
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+import io
+import os
+import lzma
+import zlib
+import base64
+import tempfile
+import contextlib
+
+# Environment variable with the compression of the files copied in,
+# which are stored as they are if it is not set
+_COMPRESSION_VARIABLE = "VSFS_COMPRESSION"
+CODECS = ["zlib", "lzma"]
+# Compressed bytes encoded on each content record of a text FS,
+# which gives lines of 76 characters
+_LINE_BYTES = 57
+_CHUNK_SIZE = 64 * 1024
+_SPOOL_SIZE = 8 * 1024 * 1024
+# Attributes of a file: its compression and the size of its contents
+# before they were compressed
+_CODEC = "z"
+_SIZE = "n"
+
+
+# Returns the compression set in the environment or None
+def compression_from_environment():
+    value = os.environ.get(_COMPRESSION_VARIABLE, "")
+    if (value == ""):
+        return None
+    return value
+
+
+# Returns the compression in the attributes of a file or None
+def get_codec(attributes):
+    return attributes.get(_CODEC)
+
+
+# Returns the size of the contents of a file once decompressed
+# from its attributes and the size of its stored contents
+def get_logical_size(attributes, stored_size):
+    if (get_codec(attributes) == None):
+        return stored_size
+    return int(attributes[_SIZE])
+
+
+def new_compressor(codec):
+    if (codec == "zlib"):
+        return zlib.compressobj(9)
+    return lzma.LZMACompressor()
+
+
+# Decompresses a stream a bounded number of bytes at a time,
+# hiding the differences between zlib and lzma
+class Decompressor:
+
+    def __init__(self, codec):
+        self.codec = codec
+        if (codec == "zlib"):
+            self.object = zlib.decompressobj()
+        else:
+            self.object = lzma.LZMADecompressor()
+
+
+    # Checks if all the input given so far was decompressed
+    def needs_input(self):
+        if (self.codec == "zlib"):
+            return (len(self.object.unconsumed_tail) == 0)
+        return (self.object.needs_input == True or self.object.eof == True)
+
+
+    # Returns at most size bytes decompressed from the input
+    # given so far and the new input
+    def decompress(self, data, size):
+        if (self.codec == "zlib"):
+            return self.object.decompress(self.object.unconsumed_tail + data, size)
+        if (self.object.eof == True):
+            return b""
+        return self.object.decompress(data, size)
+
+
+# Compresses the contents of an external file into a temporary file,
+# as lines of base64 for a text FS, and returns it with the attributes
+# of the file. The size of the contents is only known once they were
+# read, so they cannot be written to the FS right away
+def compress(source, codec, encoded):
+    compressor = new_compressor(codec)
+    target = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE)
+    if (encoded == True):
+        writer = Base64Writer(target)
+    else:
+        writer = target
+    size = 0
+    while True:
+        chunk = source.read(_CHUNK_SIZE)
+        if (len(chunk) == 0):
+            break
+        size = size + len(chunk)
+        writer.write(compressor.compress(chunk))
+    writer.write(compressor.flush())
+    if (encoded == True):
+        writer.close()
+    target.seek(0)
+    return target, {_CODEC: codec, _SIZE: str(size)}
+
+
+# Opens the contents of an external file as they must be stored,
+# compressed if a compression is given, and yields them with
+# the attributes of the file. The contents of the external file are
+# also added to a hashlib digest while they are read if one is given
+@contextlib.contextmanager
+def open_contents(external_file, codec, encoded, digest = None):
+    with open(external_file, "rb") as f:
+        if (digest == None):
+            source = f
+        else:
+            source = HashingReader(f, digest)
+        if (codec == None):
+            yield source, {}
+            return
+        target, attributes = compress(source, codec, encoded)
+    with target:
+        yield target, attributes
+
+
+# Reads a file, adding what is read to a hashlib digest
+class HashingReader:
+
+    def __init__(self, source, digest):
+        self.source = source
+        self.digest = digest
+
+
+    def read(self, size = -1):
+        data = self.source.read(size)
+        self.digest.update(data)
+        return data
+
+
+# Writes bytes as lines of base64 with _LINE_BYTES bytes each
+class Base64Writer:
+
+    def __init__(self, target):
+        self.target = target
+        self.pending = b""
+
+
+    def write(self, data):
+        self.pending = self.pending + bytes(data)
+        full = len(self.pending) - len(self.pending) % _LINE_BYTES
+        for start in range(0, full, _LINE_BYTES):
+            self.target.write(base64.b64encode(self.pending[start:start + _LINE_BYTES]) + b"\n")
+        self.pending = self.pending[full:]
+
+
+    def close(self):
+        if (len(self.pending) != 0):
+            self.target.write(base64.b64encode(self.pending) + b"\n")
+        self.pending = b""
+
+
+# Yields the contents of an open file as lines of base64
+# with _LINE_BYTES bytes each
+def encode_lines(source):
+    while True:
+        chunk = source.read(_LINE_BYTES * 1024)
+        if (len(chunk) == 0):
+            break
+        for start in range(0, len(chunk), _LINE_BYTES):
+            yield base64.b64encode(chunk[start:start + _LINE_BYTES]) + b"\n"
+
+
+# Writes the bytes decoded from base64 written to it, ignoring
+# the new-line characters between the lines
+class Base64Reader:
+
+    def __init__(self, target):
+        self.target = target
+        self.pending = b""
+
+
+    def write(self, data):
+        self.pending = self.pending + bytes(data).replace(b"\n", b"")
+        full = len(self.pending) - len(self.pending) % 4
+        if (full > 0):
+            self.target.write(base64.b64decode(self.pending[:full]))
+        self.pending = self.pending[full:]
+
+
+    def close(self):
+        if (len(self.pending) != 0):
+            self.target.write(base64.b64decode(self.pending))
+        self.pending = b""
+
+
+# Writes the bytes decompressed from the compressed bytes written to it
+class DecompressingWriter:
+
+    def __init__(self, target, codec):
+        self.target = target
+        self.decompressor = Decompressor(codec)
+
+
+    def write(self, data):
+        output = self.decompressor.decompress(bytes(data), _CHUNK_SIZE)
+        while (len(output) != 0):
+            self.target.write(output)
+            if (self.decompressor.needs_input() == True):
+                break
+            output = self.decompressor.decompress(b"", _CHUNK_SIZE)
+
+
+# Read-only view of the decompressed contents of a file, which
+# decompresses the stored contents as they are read. Seeking
+# backwards starts decompressing again from the start
+class DecompressingFile(io.RawIOBase):
+
+    def __init__(self, stored, codec, encoded, size):
+        # Stored contents, which are lines of base64 if they are encoded
+        self.stored = io.BufferedReader(stored)
+        self.name = stored.name
+        self.codec = codec
+        self.encoded = encoded
+        self.size = size
+        self.restart()
+
+
+    def restart(self):
+        self.stored.seek(0)
+        self.decompressor = Decompressor(self.codec)
+        self.offset = 0
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.offset
+
+
+    def close(self):
+        if (self.stored != None):
+            self.stored.close()
+            self.stored = None
+        super().close()
+
+
+    # Returns the next stored bytes, decoding them if needed
+    def read_stored(self):
+        if (self.encoded == True):
+            return base64.b64decode(self.stored.readline())
+        return self.stored.read(_CHUNK_SIZE)
+
+
+    def readinto(self, buffer):
+        wanted = min(len(buffer), self.size - self.offset)
+        if (wanted <= 0):
+            return 0
+        while True:
+            if (self.decompressor.needs_input() == True):
+                data = self.read_stored()
+                if (len(data) == 0):
+                    return 0
+            else:
+                data = b""
+            output = self.decompressor.decompress(data, wanted)
+            if (len(output) != 0):
+                buffer[:len(output)] = output
+                self.offset = self.offset + len(output)
+                return len(output)
+
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset = offset + self.offset
+        elif (whence == io.SEEK_END):
+            offset = offset + self.size
+        elif (whence != io.SEEK_SET):
+            raise ValueError("invalid whence (" + str(whence) + ")")
+        if (offset < 0):
+            raise ValueError("negative seek position " + str(offset))
+        if (offset < self.offset):
+            self.restart()
+        # Decompressing forward to the offset
+        buffer = bytearray(min(_CHUNK_SIZE, max(offset - self.offset, 0)))
+        while (self.offset < min(offset, self.size)):
+            view = memoryview(buffer)[:min(offset, self.size) - self.offset]
+            if (self.readinto(view) == 0):
+                break
+        if (offset > self.offset):
+            self.offset = offset
+        return self.offset
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+import os
+import json
+import bisect
+import Stats
+
+# Extension of the sidecar index stored next to the FS
+_EXTENSION = ".idx"
+_INDEX_VERSION = 5
+# Bytes read from the end of the index to find its last state
+_TAIL_SIZE = 4096
+# Characters of changes always appended before the index is saved
+# again, however small its records are
+_MIN_CHANGES_SIZE = 64 * 1024
+_SEPARATORS = (",", ":")
+
+
+# The index is saved as lines of JSON: the records and deleted lines
+# of the FS, then the records and deleted lines changed by every
+# command since. Each of them is followed by a short line with the
+# state of the FS they lead to (size, modification time, number of
+# lines and of deleted lines) and the state they follow, so that a
+# change only appends what it changed and the index is stale as soon
+# as a change is missing. The index is saved again from scratch once
+# its changes are larger than its records
+class NotesIndex:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.path = file_system + _EXTENSION
+        # Maps every "@file" and "=dir/" record to the fields
+        # of its Notes.Record (line span, byte span, live state
+        # and attributes)
+        self.records = {}
+        self.lines = 0
+        self.dead_records = 0
+        self.dead_bytes = 0
+        # Sorted runs of adjacent deleted lines as
+        # [start offset, end offset, first line, number of lines]
+        self.dead_runs = []
+        # Size and modification time of the FS when it was indexed
+        self.size = -1
+        self.mtime_ns = -1
+        # Changes of the runs of deleted lines since the index was
+        # saved, as ["add", start, end, line, lines] or ["grow"]
+        self.changes = []
+        # Size and modification time of the FS the saved index leads
+        # to, which the next change follows, or None if it is unknown
+        self.saved = None
+        # Characters of the saved records and of the changes since
+        self.base_size = 0
+        self.changes_size = 0
+
+
+    # Returns the current size and modification time of the FS
+    def get_signature(self):
+        stat = os.stat(self.file_system)
+        return [stat.st_size, stat.st_mtime_ns]
+
+
+    # Remembers the current size and modification time of the FS
+    def update_signature(self):
+        self.size, self.mtime_ns = self.get_signature()
+
+
+    # Checks if the FS was modified after it was indexed
+    def is_stale(self):
+        try:
+            return (self.get_signature() != [self.size, self.mtime_ns])
+        except FileNotFoundError:
+            return True
+
+
+    # Returns the fields of a record or None if it was never in the FS
+    def lookup(self, key):
+        return self.records.get(key)
+
+
+    # Counts deleted lines, keeping the runs of deleted lines
+    # sorted and merged with the adjacent runs
+    def add_dead_run(self, start, end, line, lines):
+        self.changes.append(["add", start, end, line, lines])
+        self.dead_records = self.dead_records + lines
+        self.dead_bytes = self.dead_bytes + end - start
+        runs = self.dead_runs
+        position = bisect.bisect_left(runs, [start])
+        if (position > 0 and runs[position - 1][1] == start):
+            position = position - 1
+            runs[position][1] = end
+            runs[position][3] = runs[position][3] + lines
+        else:
+            runs.insert(position, [start, end, line, lines])
+        # Merging with the next run if they are now adjacent
+        if (position + 1 < len(runs) and runs[position + 1][0] == end):
+            following = runs.pop(position + 1)
+            runs[position][1] = following[1]
+            runs[position][3] = runs[position][3] + following[3]
+
+
+    # Adds the new-line character appended to the last line of the FS
+    # to the run of deleted lines it ends
+    def grow_last_run(self):
+        self.changes.append(["grow"])
+        self.dead_runs[-1][1] = self.dead_runs[-1][1] + 1
+        self.dead_bytes = self.dead_bytes + 1
+
+
+    # Returns the state line saved after the records or a change
+    def get_state(self, previous):
+        return json.dumps({
+            "version": _INDEX_VERSION,
+            "from": previous,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "lines": self.lines,
+            "dead_records": self.dead_records,
+            "dead_bytes": self.dead_bytes,
+            "base_size": self.base_size,
+            "changes_size": self.changes_size
+        }, separators = _SEPARATORS)
+
+
+    # Sets the counters of a state line and returns the
+    # size and modification time of the FS it leads to
+    def set_state(self, state):
+        self.size = state["size"]
+        self.mtime_ns = state["mtime_ns"]
+        self.lines = state["lines"]
+        self.dead_records = state["dead_records"]
+        self.dead_bytes = state["dead_bytes"]
+        self.base_size = state["base_size"]
+        self.changes_size = state["changes_size"]
+        return [self.size, self.mtime_ns]
+
+
+    # Loads the index saved next to the FS and returns False
+    # if it is missing, unreadable or stale
+    def load(self):
+        self.saved = None
+        try:
+            with Stats.phase("index_load"), open(self.path, "r") as f:
+                saved = self.read_lines(f)
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return False
+        if (saved == None):
+            return False
+        self.saved = saved
+        self.changes = []
+        return (self.is_stale() == False)
+
+
+    # Reads the records and every change that follows them, and returns
+    # the size and modification time of the FS they lead to, or None if
+    # they do not follow each other
+    def read_lines(self, f):
+        previous = None
+        while True:
+            text = f.readline()
+            if (text == ""):
+                return previous
+            state = json.loads(f.readline())
+            if (state["version"] != _INDEX_VERSION or state["from"] != previous):
+                return None
+            data = json.loads(text)
+            if (previous == None):
+                self.records = data["records"]
+                self.dead_runs = data["dead_runs"]
+            else:
+                self.apply_changes(data["runs"], data["records"])
+            previous = self.set_state(state)
+
+
+    # Applies the runs of deleted lines and the records of a change
+    def apply_changes(self, runs, records):
+        for change in runs:
+            if (change[0] == "add"):
+                self.add_dead_run(change[1], change[2], change[3], change[4])
+            else:
+                self.grow_last_run()
+        for key, fields in records.items():
+            if (fields == None):
+                self.records.pop(key, None)
+            else:
+                self.records[key] = fields
+
+
+    # Loads only the state of the FS the saved index leads to, read
+    # from its last line, and returns False if it is missing, stale or
+    # must be saved again from scratch before the next change
+    def load_state(self):
+        self.saved = None
+        try:
+            with open(self.path, "rb") as f:
+                end = f.seek(0, os.SEEK_END)
+                f.seek(max(0, end - _TAIL_SIZE))
+                lines = f.read().split(b"\n")
+            state = json.loads(lines[-2])
+            if (lines[-1] != b"" or len(lines) < 3 or state["version"] != _INDEX_VERSION):
+                return False
+            self.saved = self.set_state(state)
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return False
+        self.changes = []
+        return (self.is_stale() == False and self.is_full() == False)
+
+
+    # Checks if the changes appended to the index are larger than
+    # its records, so that it is cheaper to save it again
+    def is_full(self):
+        return (self.changes_size > max(self.base_size, _MIN_CHANGES_SIZE))
+
+
+    # Saves the index next to the FS, ignoring failures
+    # since the index can always be rebuilt
+    def save(self):
+        data = json.dumps({
+            "dead_runs": self.dead_runs,
+            "records": self.records
+        }, separators = _SEPARATORS)
+        self.base_size = len(data)
+        self.changes_size = 0
+        self.changes = []
+        self.saved = None
+        temp_path = self.path + ".tmp"
+        try:
+            with Stats.phase("index_save"), open(temp_path, "w") as f:
+                f.write(data + "\n" + self.get_state(None) + "\n")
+            os.replace(temp_path, self.path)
+        except OSError:
+            return
+        self.saved = [self.size, self.mtime_ns]
+
+
+    # Applies the records changed since the index was saved, as their
+    # fields or None if they were deleted, and appends them with the
+    # changes of the runs of deleted lines to the saved index. The
+    # index is saved from scratch if it was never saved or loaded, or
+    # once the changes are larger than its records
+    def save_changes(self, records):
+        for key, fields in records.items():
+            if (fields == None):
+                self.records.pop(key, None)
+            else:
+                self.records[key] = fields
+        if (self.saved == None or self.is_full() == True):
+            self.save()
+            return
+        self.append_changes(records)
+
+
+    # Appends a change to the saved index, without the records that
+    # were not changed, which load_state() allows before it is loaded
+    def append_changes(self, records):
+        data = json.dumps({"runs": self.changes, "records": records},
+                          separators = _SEPARATORS)
+        self.changes_size = self.changes_size + len(data)
+        previous = self.saved
+        self.changes = []
+        self.saved = None
+        try:
+            with Stats.phase("index_save"), open(self.path, "a") as f:
+                f.write(data + "\n" + self.get_state(previous) + "\n")
+        except OSError:
+            return
+        self.saved = [self.size, self.mtime_ns]
+
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+import os
+import re
+import mmap
+import zlib
+
+# Extension of the journal stored next to the FS
+_EXTENSION = ".journal"
+_CHUNK_SIZE = 64 * 1024
+_DELETED = b"#"
+
+# An entry of the journal is a header with the offset of the FS the
+# appended bytes go to, their length and the number of deleted spans,
+# followed by the appended bytes, one "start end" line per deleted
+# span and a trailer with the checksum of the bytes and spans. An
+# entry without a valid trailer was never committed
+_HEADER = re.compile(rb"VSFS JOURNAL (\d{20}) (\d{20}) (\d{20})\n")
+_TRAILER = re.compile(rb"VSFS COMMIT ([0-9a-f]{8})\n")
+
+
+# Returns the header of an entry of the journal
+def entry_header(start, length, spans):
+    return b"VSFS JOURNAL %020d %020d %020d\n" % (start, length, spans)
+
+
+def entry_trailer(checksum):
+    return b"VSFS COMMIT %08x\n" % checksum
+
+
+# Write-ahead journal of the changes to a FS. Every change is written
+# to the journal and made durable before the FS is changed in place,
+# so that a change interrupted by a crash can be applied again the
+# next time the FS is opened. Only the bytes that change are written,
+# so a change costs twice its size instead of a copy of the FS
+class NotesJournal:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.path = file_system + _EXTENSION
+
+
+    # Writes the bytes appended at an offset of the FS and the spans
+    # deleted in place as a single entry and makes it durable with a
+    # single fsync, then applies it to the FS. The journal is emptied
+    # once the FS is durable
+    def commit(self, start, source, length, spans):
+        with open(self.path, "wb") as f:
+            f.write(entry_header(start, length, len(spans)))
+            checksum = 0
+            source.seek(0)
+            remaining = length
+            while (remaining > 0):
+                chunk = source.read(min(_CHUNK_SIZE, remaining))
+                if (len(chunk) == 0):
+                    raise OSError("Staged Changes Are Incomplete")
+                checksum = zlib.crc32(chunk, checksum)
+                f.write(chunk)
+                remaining = remaining - len(chunk)
+            for span in spans:
+                line = b"%d %d\n" % (span[0], span[1])
+                checksum = zlib.crc32(line, checksum)
+                f.write(line)
+            f.write(entry_trailer(checksum))
+            f.flush()
+            os.fsync(f.fileno())
+
+        source.seek(0)
+        apply_entry(self.file_system, start, source, length, spans)
+        self.clear(False)
+
+
+    # Empties the journal. Replaying a journal that is not durably
+    # empty only writes the same bytes again, unless the FS is
+    # rewritten by a compaction or a defrag, which must wait for it
+    def clear(self, durable):
+        try:
+            fd = os.open(self.path, os.O_WRONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.ftruncate(fd, 0)
+            if (durable == True):
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    # Returns the committed entries of the journal as
+    # [start, offset in the journal, length, spans]
+    def read_entries(self, f):
+        entries = []
+        while True:
+            match = _HEADER.fullmatch(f.readline())
+            if (match == None):
+                break
+            start, length, count = [int(group) for group in match.groups()]
+            offset = f.tell()
+            checksum = 0
+            remaining = length
+            while (remaining > 0):
+                chunk = f.read(min(_CHUNK_SIZE, remaining))
+                if (len(chunk) == 0):
+                    break
+                checksum = zlib.crc32(chunk, checksum)
+                remaining = remaining - len(chunk)
+            if (remaining > 0):
+                break
+            spans = []
+            for i in range(count):
+                line = f.readline()
+                checksum = zlib.crc32(line, checksum)
+                fields = line.split()
+                if (len(fields) != 2 or line[-1:] != b"\n"):
+                    break
+                spans.append([int(fields[0]), int(fields[1])])
+            trailer = _TRAILER.fullmatch(f.readline())
+            if (len(spans) != count or trailer == None
+                or int(trailer.group(1), 16) != checksum
+            ):
+                break
+            entries.append([start, offset, length, spans])
+        return entries
+
+
+    # Checks if the journal holds an entry, committed or not, which
+    # is left by a change that was interrupted
+    def is_pending(self):
+        try:
+            return (os.path.getsize(self.path) != 0)
+        except FileNotFoundError:
+            return False
+
+
+    # Applies the committed entries of the journal left by an
+    # interrupted change to the FS and returns True if the FS was
+    # changed. An entry that was not committed is discarded since
+    # the FS was not changed yet
+    def replay(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+
+        with f:
+            if (os.fstat(f.fileno()).st_size == 0):
+                return False
+            entries = self.read_entries(f)
+            for start, offset, length, spans in entries:
+                f.seek(offset)
+                apply_entry(self.file_system, start, f, length, spans)
+        self.clear(True)
+        return (len(entries) != 0)
+
+
+# Writes the bytes of an entry at its offset of the FS, truncating what
+# an interrupted change left after them, and sets the first character
+# of every line of its deleted spans to "#", then makes the FS durable.
+# Applying an entry twice leaves the FS the same
+def apply_entry(file_system, start, source, length, spans):
+    with open(file_system, "r+b") as f:
+        f.seek(start)
+        remaining = length
+        while (remaining > 0):
+            chunk = source.read(min(_CHUNK_SIZE, remaining))
+            if (len(chunk) == 0):
+                raise OSError("Journal Entry Is Incomplete")
+            f.write(chunk)
+            remaining = remaining - len(chunk)
+        f.truncate(start + length)
+        f.flush()
+        if (len(spans) != 0):
+            with mmap.mmap(f.fileno(), 0) as notes:
+                for span in sorted(spans):
+                    mark_span(notes, span[0], span[1])
+                notes.flush()
+        os.fsync(f.fileno())
+
+
+# Sets the first character of every line between two offsets
+# of a mapped FS to "#"
+def mark_span(notes, start, end):
+    while (start != -1 and start < end):
+        notes[start] = _DELETED[0]
+        start = notes.find(b"\n", start, end)
+        if (start != -1):
+            start = start + 1
@@ -0,0 +1,1014 @@
+#!/usr/bin/python3
+import io
+import os
+import mmap
+import stat
+import bisect
+import struct
+import hashlib
+import contextlib
+import collections
+import concurrent.futures
+import Notes
+import Binary
+import Compression
+import Search
+import Lock
+import Stats
+
+# First lines of the text and binary formats of the FS
+_HEADERS = [b"NOTES V1.0", b"NOTES V2.0"]
+# Distance between the positions remembered by an open
+# internal file to seek backwards without reading from the start
+_CHECKPOINT_DISTANCE = 64 * 1024
+# Environment variable that stores the contents copied in once
+# for every file with the same contents when set to "1"
+_DEDUP_VARIABLE = "VSFS_DEDUP"
+# Number of threads reading or writing the EFs of copyin_many,
+# copyin_tree and copyout_tree
+_ENCODE_WORKERS = 8
+
+
+# Base of the errors of the library. The message is the one
+# printed by the command line after "Invalid VSFS: "
+class VSFSError(Exception):
+    pass
+
+
+# The FS does not exist or is not a notes file
+class FileSystemError(VSFSError):
+    pass
+
+
+# The path of an IF or ID is not valid
+class InvalidPathError(VSFSError, ValueError):
+    pass
+
+
+# The IF or ID does not exist
+class NotFoundError(VSFSError, FileNotFoundError):
+    pass
+
+
+# The IF or ID already exists
+class ExistsError(VSFSError, FileExistsError):
+    pass
+
+
+# The EF does not exist or is not a file
+class ExternalFileError(VSFSError):
+    pass
+
+
+# The compression of an IF is not "zlib" or "lzma"
+class CompressionError(VSFSError, ValueError):
+    pass
+
+
+# Another process kept the FS locked for longer than the lock timeout
+class LockTimeoutError(VSFSError, TimeoutError):
+    pass
+
+
+# Raises an error if the FS does not exist or if its first
+# line is not "NOTES V1.0" or "NOTES V2.0"
+def check_file_system(file_system):
+    try:
+        with open(file_system, "rb") as f:
+            first_line = f.readline().rstrip()
+    except FileNotFoundError:
+        raise FileSystemError("File System Not Found")
+    if (first_line not in _HEADERS):
+        raise FileSystemError("File System Is Not Valid")
+
+
+# Loads the image of a text or binary FS
+def load_image(file_system):
+    try:
+        if (Binary.is_binary(file_system) == True):
+            return Binary.load_image(file_system)
+    except (ValueError, struct.error):
+        raise FileSystemError("File System Is Not Valid")
+    return Notes.load_image(file_system)
+
+
+# Maps a text or binary FS to look up single records without loading it
+def open_scanner(file_system):
+    try:
+        if (Binary.is_binary(file_system) == True):
+            return Binary.TableScanner(file_system)
+    except (ValueError, struct.error):
+        raise FileSystemError("File System Is Not Valid")
+    return Notes.RecordScanner(file_system)
+
+
+# Returns the size of the contents of a file of a text or binary FS
+# as stored in the FS and once decompressed, reading the FS through
+# an open file
+def get_sizes(source, record):
+    if (isinstance(record, Binary.Extent) == True):
+        stored_size = record.length
+    else:
+        stored_size = Notes.get_stored_size(source, record)
+    return [stored_size, Compression.get_logical_size(record.attributes, stored_size)]
+
+
+# Raises an error if the path of an IF or ID ends or starts
+# with "/", if it is ".", "..", or "/" or if it contains a tab,
+# which separates a record from its attributes, or a new-line
+# character, which ends a record
+def check_path(path):
+    if (path == ""
+        or path[len(path) - 1] == "/"
+        or path[0] == "/"
+        or path == "."
+        or path == ".."
+        or "\t" in path
+        or "\n" in path
+    ):
+        raise InvalidPathError("Invalid Internal File")
+
+
+# Raises an error if the EF does not exist or is not a file
+def check_external_file(external_file):
+    try:
+        with open(external_file, "r") as f:
+            pass
+    except FileNotFoundError:
+        raise ExternalFileError("External File Not Found")
+    except IsADirectoryError:
+        raise ExternalFileError("Invalid External File")
+
+
+# Raises an error if a compression is not None, "zlib" or "lzma"
+def check_compression(compression):
+    if (compression != None and compression not in Compression.CODECS):
+        raise CompressionError("Unknown Compression")
+
+
+# Checks if the contents copied in must be deduplicated
+# according to the environment
+def dedup_from_environment():
+    return (os.environ.get(_DEDUP_VARIABLE, "") == "1")
+
+
+# Returns the SHA-256 of the contents of an external file as they
+# are stored, trimmed or not (see Notes.StoredDigest), which is the
+# key of their blob once deduplicated
+def hash_file(external_file, trimmed):
+    digest = Notes.new_digest(trimmed)
+    with open(external_file, "rb") as f:
+        while True:
+            chunk = f.read(Notes._CHUNK_SIZE)
+            if (len(chunk) == 0):
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Checks if the contents copied in are stored without the new-line
+# character they end with, which a text FS does unless they are compressed
+def is_trimmed(binary, compression):
+    return (binary == False and compression == None)
+
+
+# Yields the result of a function for every item in order, running
+# the function in a pool of threads for at most window items ahead
+# of the one yielded
+def map_ordered(executor, function, items, window):
+    pending = collections.deque()
+    try:
+        for item in items:
+            if (len(pending) == window):
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, item))
+        while (len(pending) != 0):
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# Returns the dirs under a host dir and the [EF, IF] pairs of the files
+# under it, named after an ID that the host dir is copied to, with every
+# dir before the dirs under it. Links to dirs are not followed and what
+# is neither a file nor a dir is skipped
+def walk_directory(external_directory, path):
+    directories = [path]
+    pairs = []
+    pending = [[external_directory, path]]
+    try:
+        while (len(pending) != 0):
+            source, target = pending.pop()
+            with os.scandir(source) as entries:
+                for entry in sorted(entries, key = lambda entry: entry.name):
+                    name = target + "/" + entry.name
+                    if (entry.is_dir(follow_symlinks = False) == True):
+                        directories.append(name)
+                        pending.append([entry.path, name])
+                    elif (entry.is_file() == True):
+                        pairs.append([entry.path, name])
+    except FileNotFoundError:
+        raise ExternalFileError("External Directory Not Found")
+    except OSError:
+        raise ExternalFileError("Invalid External Directory")
+    return directories, pairs
+
+
+# Returns the number of sub dirs of a dir of the tree that have a record
+def count_links(directory):
+    link_count = 0
+    for child in directory.dirs.values():
+        if (child.record != None):
+            link_count = link_count + 1
+    return link_count
+
+
+# Result of stat() for an IF or ID, with the permissions of the FS
+class InternalStat:
+
+    def __init__(self, name, st_mode, st_nlink, st_size, stored_size = None):
+        self.name = name
+        self.st_mode = st_mode
+        self.st_nlink = st_nlink
+        # Size of the contents of an IF, 0 for an ID
+        self.st_size = st_size
+        # Size of the contents of an IF in the FS, which is smaller
+        # than st_size if they are compressed
+        if (stored_size == None):
+            stored_size = st_size
+        self.stored_size = stored_size
+
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.st_mode)
+
+
+# Read-only view of the contents of an IF, which reads the content
+# records from the FS only when they are read. It keeps reading the
+# FS it was opened on, which is not changed by deleting files or by
+# a defrag, but is changed by compacting the FS
+class InternalFile(io.RawIOBase):
+
+    def __init__(self, file_system, record, size):
+        self.file_system = file_system
+        self.name = record.name
+        self.size = size
+        self.file = open(file_system, "rb")
+        # Position in the contents of IF and in the FS
+        self.offset = 0
+        self.position = record.header_end
+        self.line_start = True
+        # Sorted positions at the start of content records as
+        # [offset in IF, offset in FS], remembered while reading
+        self.checkpoints = [[0, record.header_end]]
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.offset
+
+
+    def close(self):
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+        super().close()
+
+
+    # Reads the contents into a buffer, removing the space
+    # at the start of every content record
+    def readinto(self, buffer):
+        wanted = min(len(buffer), self.size - self.offset)
+        if (wanted <= 0):
+            return 0
+        self.file.seek(self.position)
+
+        written = 0
+        while (written < wanted):
+            chunk = self.file.read(min(Notes._CHUNK_SIZE, wanted - written + 1))
+            if (len(chunk) == 0):
+                break
+            index = 0
+            while (index < len(chunk) and written < wanted):
+                if (self.line_start == True):
+                    self.add_checkpoint(self.position + index)
+                    # Skipping the space of the content record
+                    index = index + 1
+                    self.line_start = False
+                    continue
+                newline = chunk.find(b"\n", index)
+                if (newline == -1):
+                    stop = len(chunk)
+                else:
+                    stop = newline + 1
+                stop = min(stop, index + wanted - written)
+                buffer[written:written + stop - index] = chunk[index:stop]
+                written = written + stop - index
+                self.offset = self.offset + stop - index
+                if (chunk[stop - 1:stop] == b"\n"):
+                    self.line_start = True
+                index = stop
+            self.position = self.position + index
+            self.file.seek(self.position)
+        return written
+
+
+    # Remembers the start of a content record if it is far
+    # enough from the last one
+    def add_checkpoint(self, position):
+        last = self.checkpoints[len(self.checkpoints) - 1]
+        if (self.offset - last[0] >= _CHECKPOINT_DISTANCE):
+            self.checkpoints.append([self.offset, position])
+
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if (whence == io.SEEK_CUR):
+            offset = offset + self.offset
+        elif (whence == io.SEEK_END):
+            offset = offset + self.size
+        elif (whence != io.SEEK_SET):
+            raise ValueError("invalid whence (" + str(whence) + ")")
+        if (offset < 0):
+            raise ValueError("negative seek position " + str(offset))
+
+        if (offset < self.offset):
+            # Going back to the closest content record before the offset
+            index = bisect.bisect_right(self.checkpoints, [offset, float("inf")]) - 1
+            self.offset, self.position = self.checkpoints[index]
+            self.line_start = True
+        # Reading forward to the offset
+        buffer = bytearray(min(Notes._CHUNK_SIZE, max(offset - self.offset, 0)))
+        while (self.offset < min(offset, self.size)):
+            view = memoryview(buffer)[:min(offset, self.size) - self.offset]
+            if (self.readinto(view) == 0):
+                break
+        if (offset > self.offset):
+            # Past the end, where nothing can be read
+            self.offset = offset
+        return self.offset
+
+
+class VSFS:
+
+    def __init__(self, file_system, lock_timeout = None):
+        self.file_system = file_system
+        # The image is only loaded by the methods that need the whole
+        # FS, the others scan the mapped FS for the records they need
+        self.image = None
+        self.scanner = None
+        # Search index of the FS, only loaded by the methods that
+        # search the FS or change its IFs
+        self.search_index = None
+        # Seconds to wait for the other processes using the FS,
+        # as long as needed if None
+        if (lock_timeout == None):
+            lock_timeout = Lock.timeout_from_environment()
+        self.lock = Lock.NotesLock(file_system, lock_timeout)
+        check_file_system(file_system)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *error):
+        self.close()
+
+
+    # Releases the mapping and the lock file of the FS
+    def close(self):
+        self.close_scanner()
+        self.lock.close()
+
+
+    def close_scanner(self):
+        if (self.scanner != None):
+            self.scanner.close()
+            self.scanner = None
+
+
+    # Holds locks of the FS for as long as the block runs, raising
+    # an error if they cannot be taken before the lock timeout, or
+    # at all
+    @contextlib.contextmanager
+    def locked(self, *locks):
+        taken = []
+        try:
+            for lock, exclusive in locks:
+                try:
+                    self.lock.acquire(lock, exclusive)
+                except Lock.LockTimeout:
+                    raise LockTimeoutError("Timed Out Waiting For The Lock")
+                except Lock.LockDenied:
+                    raise FileSystemError("Lock File Is Not Writable")
+                taken.append(lock)
+            yield
+        finally:
+            for lock in reversed(taken):
+                self.lock.release(lock)
+
+
+    # Holds the lock shared by the readers of the FS, which then
+    # read a FS that nothing else changes in place
+    @contextlib.contextmanager
+    def reading(self):
+        self.recover()
+        with self.locked([Lock.DATA_LOCK, False]):
+            yield
+
+
+    # Holds the locks of the FS alone to change it. During a
+    # transaction the changes are only staged, so the readers
+    # are only blocked once it is committed
+    @contextlib.contextmanager
+    def writing(self):
+        self.recover()
+        if (self.image != None and self.image.staging != None):
+            locks = [[Lock.WRITER_LOCK, True]]
+        else:
+            locks = [[Lock.WRITER_LOCK, True], [Lock.DATA_LOCK, True]]
+        with self.locked(*locks):
+            yield
+
+
+    # Finishes a change to the FS that was interrupted, eg. by a crash.
+    # It is only done holding both locks alone, so that the readers
+    # sharing the data lock never change the FS; they take it once the
+    # FS was recovered. Nothing is done while this process holds the
+    # data lock, since the FS was recovered when it was taken
+    def recover(self):
+        if (self.lock.holders[Lock.DATA_LOCK] != 0):
+            return
+        if (Notes.needs_recovery(self.file_system) == False):
+            return
+        with self.locked([Lock.WRITER_LOCK, True], [Lock.DATA_LOCK, True]):
+            # Checking again since another process may have done it
+            if (Notes.needs_recovery(self.file_system) == True):
+                Notes.recover(self.file_system)
+
+
+    # Returns the parsed image of the FS, loading it again if
+    # the FS has changed since it was loaded
+    def get_image(self):
+        if (self.image == None or self.image.is_stale()):
+            check_file_system(self.file_system)
+            self.recover()
+            with Stats.phase("load"):
+                self.image = load_image(self.file_system)
+            self.close_scanner()
+        return self.image
+
+
+    # Returns the live record of a file/dir or None, looking it up
+    # in the image if it was loaded or scanning the mapped FS for it
+    def lookup(self, key):
+        with self.reading():
+            if (self.image != None):
+                return self.get_image().lookup(key)
+            if (self.scanner == None or self.scanner.is_stale()):
+                self.close_scanner()
+                check_file_system(self.file_system)
+                self.scanner = open_scanner(self.file_system)
+            return self.scanner.lookup(key)
+
+
+    # Parses the FS from scratch and saves its index. The table of a
+    # binary FS is its index, which is only written again if it does
+    # not match the blocks of the FS
+    def reindex(self):
+        check_file_system(self.file_system)
+        if (Binary.is_binary(self.file_system) == True):
+            with self.writing():
+                image = Binary.BinaryImage(self.file_system)
+                image.rebuild()
+                self.image = image
+            return
+        with self.reading():
+            image = Notes.NotesImage(self.file_system)
+            image.rebuild()
+            self.image = image
+
+
+    # Raises an error if the path of an IF is not valid
+    # or if the dirs above it do not exist. The dirs are found in the
+    # dir tree if the image was loaded, otherwise they are looked up
+    # in the mapped FS
+    def check_path(self, path):
+        check_path(path)
+        with self.reading():
+            if (self.image != None):
+                if (self.get_image().has_parents(path) == False):
+                    raise InvalidPathError("Invalid Path To Internal File")
+                return
+            parts = path.split("/")
+            for i in range(1, len(parts)):
+                if (self.lookup("=" + "/".join(parts[:i]) + "/") == None):
+                    raise InvalidPathError("Invalid Path To Internal File")
+
+
+    # Returns the record of an IF or raises an error
+    def get_file(self, path):
+        record = self.lookup("@" + path)
+        if (record == None):
+            raise NotFoundError("Internal File Does Not Exist")
+        return record
+
+
+    # Returns the record holding the contents of a file, which is
+    # the blob of a file whose contents are deduplicated
+    def get_contents(self, record):
+        digest = Notes.get_digest(record.attributes)
+        if (digest == None):
+            return record
+        blob = self.lookup("$" + digest)
+        if (blob == None):
+            raise FileSystemError("File System Is Not Valid")
+        return blob
+
+
+    # Returns a dir of the tree ("" for the root) or raises an error,
+    # which tells a path naming a file from a missing dir
+    def get_directory(self, path):
+        image = self.get_image()
+        if (path == ""):
+            return image.root
+        directory = image.get_directory(path)
+        if (directory == None):
+            if (image.lookup("@" + path) != None):
+                raise InvalidPathError("Internal Path Is Not A Directory")
+            raise NotFoundError("Internal Directory Does Not Exist")
+        return directory
+
+
+    def isfile(self, path):
+        return (self.lookup("@" + path) != None)
+
+
+    def isdir(self, path):
+        return (path == "" or self.lookup("=" + path + "/") != None)
+
+
+    # Opens an IF for reading, in binary ("rb") or text ("r") mode.
+    # Compressed contents are decompressed as they are read
+    def open(self, path, mode = "r", encoding = "utf-8"):
+        if (mode != "r" and mode != "rb"):
+            raise ValueError("invalid mode: '" + mode + "'")
+        with self.reading():
+            f = self.open_record(self.get_contents(self.get_file(path)))
+        if (mode == "rb"):
+            return f
+        return io.TextIOWrapper(f, encoding = encoding)
+
+
+    # Opens the contents held by a file or blob record for reading
+    # in binary mode, decompressing them as they are read
+    def open_record(self, record):
+        if (isinstance(record, Binary.Extent) == True):
+            raw = Binary.ExtentFile(self.file_system, record)
+            stored_size = record.length
+        else:
+            stored_size = Notes.get_size(self.file_system, record)
+            raw = InternalFile(self.file_system, record, stored_size)
+        codec = Compression.get_codec(record.attributes)
+        if (codec != None):
+            raw = Compression.DecompressingFile(
+                raw, codec, (isinstance(record, Binary.Extent) == False),
+                Compression.get_logical_size(record.attributes, stored_size))
+        return io.BufferedReader(raw)
+
+
+    # Returns the sorted names of the files and dirs one level
+    # below a dir ("" for the root)
+    def listdir(self, path = ""):
+        with self.reading():
+            directory = self.get_directory(path)
+            names = list(directory.files.keys())
+            for name, child in directory.dirs.items():
+                if (child.record != None):
+                    names.append(name)
+        return sorted(names)
+
+
+    # Returns the type, link count and size of an IF or ID
+    def stat(self, path):
+        permissions = stat.S_IMODE(os.stat(self.file_system).st_mode)
+        with self.reading():
+            record = self.lookup("@" + path)
+            if (record != None):
+                with open(self.file_system, "rb") as source:
+                    stored_size, size = get_sizes(source, self.get_contents(record))
+                return InternalStat(path, stat.S_IFREG | permissions, 1,
+                                    size, stored_size)
+            directory = self.get_directory(path)
+            return InternalStat(path, stat.S_IFDIR | permissions,
+                                count_links(directory), 0)
+
+
+    # Returns the stat of every file and dir under a dir ("" for the
+    # whole FS), walking only its part of the dir tree built while
+    # parsing the FS
+    def entries(self, path = ""):
+        permissions = stat.S_IMODE(os.stat(self.file_system).st_mode)
+        entries = []
+        with self.reading():
+            top = self.get_directory(path)
+            pending = [top]
+            # Reading the sizes of every file through a single open file
+            with open(self.file_system, "rb") as source:
+                while (len(pending) != 0):
+                    directory = pending.pop()
+                    if (directory.record != None and directory != top):
+                        entries.append(InternalStat(directory.name,
+                                                    stat.S_IFDIR | permissions,
+                                                    count_links(directory), 0))
+                    for record in directory.files.values():
+                        stored_size, size = get_sizes(source, self.get_contents(record))
+                        entries.append(InternalStat(record.name, stat.S_IFREG | permissions,
+                                                    1, size, stored_size))
+                    pending.extend(directory.dirs.values())
+        return entries
+
+
+    # Copies an EF into the FS as an IF, replacing it if it exists.
+    # The contents are compressed with "zlib" or "lzma" if a compression
+    # is given or set in the VSFS_COMPRESSION environment variable, and
+    # are stored once for every IF with the same contents if dedup is
+    # True or VSFS_DEDUP is set to "1"
+    def copyin(self, external_file, path, compression = None, dedup = None):
+        check_external_file(external_file)
+        if (compression == None):
+            compression = Compression.compression_from_environment()
+        check_compression(compression)
+        if (dedup == None):
+            dedup = dedup_from_environment()
+        digest = None
+        if (dedup == True):
+            # Hashing the contents before the FS is locked, as the
+            # format of the FS stores them
+            trimmed = is_trimmed(Binary.is_binary(self.file_system), compression)
+            digest = hash_file(external_file, trimmed)
+        tokens = None
+        if (Search.exists(self.file_system) == True):
+            tokens = Search.tokenize_file(external_file)
+        with self.writing():
+            self.check_path(path)
+            image = self.get_image()
+            search = self.get_search()
+            # Hashing the contents again if the FS was converted since
+            binary = isinstance(image, Binary.BinaryImage)
+            if (digest != None and is_trimmed(binary, compression) != trimmed):
+                trimmed = is_trimmed(binary, compression)
+                digest = hash_file(external_file, trimmed)
+            # Replacing the file as a single change
+            with image.changing():
+                # Deleting the file and its contents in place if it was found
+                record = image.get_file(path)
+                if (record != None):
+                    image.tombstone_record(record)
+                # Appending the new file to the FS, streaming
+                # the contents of EF instead of rewriting the FS
+                if (digest == None):
+                    image.append_file(path, external_file, compression)
+                else:
+                    # Only appending the contents if no blob has them yet
+                    if (image.get_blob(digest) == None):
+                        image.append_blob(digest, external_file, compression)
+                    image.append_link(path, digest)
+            self.update_search(search, [path], [[path, tokens]])
+
+
+    # Copies many EFs into the FS at once, given as [EF, IF] pairs,
+    # like copyin does for each pair in order, as a single change
+    def copyin_many(self, pairs, compression = None, dedup = None, workers = None):
+        for external_file, path in pairs:
+            check_path(path)
+            check_external_file(external_file)
+        self.append_files([], pairs, compression, dedup, workers)
+
+
+    # Copies a host dir and everything under it into the FS as an ID,
+    # creating the ID and the dirs under it that do not exist and
+    # replacing the IFs that do, as a single change
+    def copyin_tree(self, external_directory, path, compression = None,
+                    dedup = None, workers = None):
+        check_path(path)
+        directories, pairs = walk_directory(external_directory, path)
+        for name in directories + [pair[1] for pair in pairs]:
+            check_path(name)
+        self.append_files(directories, pairs, compression, dedup, workers)
+
+
+    # Appends the dirs that do not exist yet, then the EFs of [EF, IF]
+    # pairs, for copyin_many and copyin_tree. Every path is checked
+    # against the dir tree before anything is read, then a pool of
+    # threads reads, compresses and hashes the EFs while a single writer
+    # appends them in order, and they are all written as a single change
+    def append_files(self, directories, pairs, compression, dedup, workers):
+        if (compression == None):
+            compression = Compression.compression_from_environment()
+        check_compression(compression)
+        if (dedup == None):
+            dedup = dedup_from_environment()
+        if (workers == None):
+            workers = _ENCODE_WORKERS
+        tokenized = Search.exists(self.file_system)
+
+        with self.writing():
+            image = self.get_image()
+            search = self.get_search()
+            # Only checking every dir above the paths once, and not the
+            # dirs appended with them
+            checked = set(directories)
+            for name in directories + [pair[1] for pair in pairs]:
+                parent = name.rpartition("/")[0]
+                while (parent != "" and parent not in checked):
+                    if (image.lookup("=" + parent + "/") == None):
+                        raise InvalidPathError("Invalid Path To Internal File")
+                    checked.add(parent)
+                    parent = parent.rpartition("/")[0]
+
+            # Reading the words of the EFs too if the FS has a search index
+            def encode(pair):
+                encoded = image.encode_contents(pair[0], compression, dedup)
+                if (tokenized == False):
+                    return [encoded, None]
+                return [encoded, Search.tokenize_file(pair[0])]
+
+            added = []
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                with image.changing():
+                    for name in directories:
+                        if (image.lookup("=" + name + "/") == None):
+                            image.append_directory(name)
+                    for path, [encoded, tokens] in zip([pair[1] for pair in pairs],
+                                                       map_ordered(executor, encode, pairs,
+                                                                   2 * workers)):
+                        added.append([path, tokens])
+                        with encoded:
+                            record = image.get_file(path)
+                            if (record != None):
+                                image.tombstone_record(record)
+                            if (dedup == False):
+                                image.append_encoded("@" + path, encoded)
+                                continue
+                            digest = encoded.digest.hexdigest()
+                            if (image.get_blob(digest) == None):
+                                image.append_encoded("$" + digest, encoded)
+                            image.append_link(path, digest)
+            self.update_search(search, [pair[1] for pair in pairs], added)
+
+
+    # Copies the contents of an IF to an EF, replacing what EF
+    # contained and decompressing them if they are compressed
+    def copyout(self, path, external_file):
+        with self.reading():
+            record = self.get_contents(self.get_file(path))
+            if (isinstance(record, Binary.Extent) == True):
+                Binary.copy_file(self.file_system, record, external_file)
+            else:
+                Notes.copy_file(self.file_system, record, external_file)
+
+
+    # Copies an ID and everything under it to a host dir, creating the
+    # host dir and the dirs under it and replacing the files in them.
+    # The contents of the IFs are read in the order they are stored,
+    # in a single forward pass over the FS, while a pool of threads
+    # writes the EFs
+    def copyout_tree(self, path, external_directory, workers = None):
+        check_path(path)
+        if (workers == None):
+            workers = _ENCODE_WORKERS
+        with self.reading():
+            files = []
+            pending = [[self.get_directory(path), external_directory]]
+            try:
+                while (len(pending) != 0):
+                    directory, target = pending.pop()
+                    os.makedirs(target, exist_ok = True)
+                    for name, child in directory.dirs.items():
+                        pending.append([child, os.path.join(target, name)])
+                    for name, record in directory.files.items():
+                        files.append([self.get_contents(record), os.path.join(target, name)])
+            except OSError:
+                raise ExternalFileError("Invalid External Directory")
+            files.sort(key = lambda entry: entry[0].offset)
+
+            if (Binary.is_binary(self.file_system) == True):
+                export = Binary.export_file
+            else:
+                export = Notes.export_file
+            with open(self.file_system, "rb") as source:
+                with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                    copy = lambda entry: export(source, entry[0], entry[1])
+                    try:
+                        for entry in map_ordered(executor, copy, files, 2 * workers):
+                            pass
+                    except OSError:
+                        raise ExternalFileError("Invalid External File")
+
+
+    # Creates an empty ID
+    def mkdir(self, path):
+        check_path(path)
+        with self.writing():
+            image = self.get_image()
+            if (image.lookup("=" + path + "/") != None):
+                raise ExistsError("Internal Directory Already Exists")
+            image.append_directory(path)
+
+
+    # Deletes an IF
+    def remove(self, path):
+        with self.writing():
+            if (self.image == None and Binary.is_binary(self.file_system) == False):
+                # Deleting the file in place without loading the image,
+                # unless the FS must then be compacted
+                record = self.get_file(path)
+                search = self.get_search()
+                if (Notes.tombstone_scanned(self.file_system, record) == True):
+                    self.close_scanner()
+                    self.update_search(search, [path], [])
+                    return
+            image = self.get_image()
+            search = self.get_search()
+            record = self.get_file(path)
+            # Deleting the file and its contents in place, then
+            # compacting the tail of the FS if too much of it is deleted
+            image.tombstone_record(record)
+            self.update_search(search, [path], [])
+
+
+    # Deletes an ID and everything under it
+    def rmtree(self, path):
+        check_path(path)
+        with self.writing():
+            directory = self.get_directory(path)
+            image = self.get_image()
+            search = self.get_search()
+            # Deleting the dir and everything under it in place, in
+            # a single pass over the FS, then compacting the tail of
+            # the FS if too much of it is deleted
+            records = image.get_subtree(directory)
+            image.tombstone_records(records)
+            self.update_search(search, [record.name for record in records
+                                        if (record.kind == "@")], [])
+
+
+    # Removes every deleted record and every blob no IF refers to
+    # anymore from the FS, and returns the number of records and
+    # bytes that were reclaimed. The readers keep reading the old
+    # FS until it is replaced. The search index of the FS, if it
+    # has one, is rebuilt from the new FS
+    def defrag(self):
+        with self.locked([Lock.WRITER_LOCK, True]):
+            with self.writing():
+                image = self.get_image()
+                image.tombstone_records(image.get_unreferenced_blobs())
+            result = image.defrag(lambda: self.locked([Lock.DATA_LOCK, True]))
+            if (Search.exists(self.file_system) == True):
+                self.rebuild_search()
+            return result
+
+
+    # Rewrites the FS in the text ("V1.0") or binary ("V2.0") format.
+    # The readers keep reading the old FS until it is replaced
+    def convert(self, version):
+        if (version not in ["V1.0", "V2.0"]):
+            raise FileSystemError("Unknown File System Version")
+        with self.locked([Lock.WRITER_LOCK, True]):
+            with self.reading():
+                image = self.get_image()
+            Binary.convert(image, version,
+                           lambda: self.locked([Lock.DATA_LOCK, True]))
+            self.image = None
+            self.close_scanner()
+            if (Search.exists(self.file_system) == True):
+                self.rebuild_search()
+
+
+    # Returns the search index of the FS, loading it again if the FS
+    # has changed since it was loaded, or None if the FS has no search
+    # index or if it is stale
+    def get_search(self):
+        if (self.search_index == None or self.search_index.is_stale()):
+            self.search_index = None
+            if (Search.exists(self.file_system) == True):
+                search = Search.SearchIndex(self.file_system)
+                if (search.load() == True):
+                    self.search_index = search
+        return self.search_index
+
+
+    # Updates the search index loaded before IFs were removed and added,
+    # given with their words, and saves it unless the change is part of
+    # a batch, which saves it once committed. The index is rebuilt by
+    # the next search if the words of an added IF were not read
+    def update_search(self, search, removed, added):
+        if (search == None):
+            return
+        if (any(tokens == None for path, tokens in added)):
+            search.invalidate()
+            self.search_index = None
+            return
+        search.remove(removed)
+        for path, tokens in added:
+            search.add(path, tokens)
+        if (self.image == None or self.image.staging == None):
+            search.save()
+
+
+    # Reads the words of every IF into a new search index saved next
+    # to the FS, which every change then keeps up to date
+    def rebuild_search(self):
+        search = Search.SearchIndex(self.file_system)
+        with self.reading():
+            records = [record for record in self.get_image().records.values()
+                       if (record.kind == "@" and record.live == True)]
+            # Reading the contents in the order they are stored, and the
+            # contents shared by several IFs only once
+            stored = {}
+            for record in records:
+                stored[record.key] = self.get_contents(record)
+            words = {}
+            for record in sorted(records, key = lambda record: stored[record.key].offset):
+                contents = stored[record.key]
+                if (contents.key not in words):
+                    with self.open_record(contents) as f:
+                        words[contents.key] = Search.tokenize(f)
+                search.add(record.name, words[contents.key])
+            search.save()
+        self.search_index = search
+
+
+    # Returns the sorted paths of the IFs whose contents contain a
+    # string. If the FS has a search index, only the contents of the
+    # IFs it gives are searched, otherwise the contents of every IF
+    # are searched in a single pass over the FS
+    def search(self, pattern):
+        needle = pattern.encode()
+        found = []
+        with self.reading():
+            image = self.get_image()
+            records = [record for record in image.records.values()
+                       if (record.kind == "@" and record.live == True)]
+            if (Search.exists(self.file_system) == True):
+                if (self.get_search() == None):
+                    self.rebuild_search()
+                candidates = self.search_index.get_candidates(pattern)
+                if (candidates != None):
+                    records = [record for record in records if (record.name in candidates)]
+
+            # Searching the contents shared by several IFs only once
+            holders = {}
+            for record in records:
+                contents = self.get_contents(record)
+                holders.setdefault(contents.key, [contents, []])[1].append(record.name)
+            Stats.count("records_scanned", len(holders))
+            lines = (Binary.is_binary(self.file_system) == False)
+            with open(self.file_system, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as notes:
+                    for contents, paths in sorted(holders.values(),
+                                                  key = lambda holder: holder[0].offset):
+                        if (Compression.get_codec(contents.attributes) != None):
+                            with self.open_record(contents) as source:
+                                matched = Search.contains(source, needle)
+                        else:
+                            end = contents.content_end
+                            if (lines == True):
+                                end = Notes.get_content_end(f, contents)
+                            matched = Search.find_in_region(notes, needle, contents.header_end,
+                                                            end, lines)
+                        if (matched == True):
+                            found.extend(paths)
+        return sorted(found)
+
+
+    # Applies every change made inside the block to the FS at once,
+    # or none of them if the block raises an error
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.locked([Lock.WRITER_LOCK, True]):
+            with self.reading():
+                image = self.get_image()
+                search = self.get_search()
+            image.begin()
+            try:
+                yield self
+            except BaseException:
+                # The image is loaded again if it no longer matches the FS,
+                # and so is the search index
+                image.rollback()
+                self.search_index = None
+                raise
+            with self.locked([Lock.DATA_LOCK, True]):
+                image.commit()
+            if (search != None and search == self.search_index and search.changed == True):
+                search.save()
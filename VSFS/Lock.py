@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+import os
+import time
+import fcntl
+import threading
+
+# Extension of the lock file stored next to the FS
+_EXTENSION = ".lock"
+# Environment variable with the number of seconds to wait for a lock,
+# which is waited for as long as needed if it is not set
+_TIMEOUT_VARIABLE = "VSFS_LOCK_TIMEOUT"
+# Longest wait between two attempts to take a lock
+_MAX_DELAY = 0.05
+
+# Bytes of the lock file that are locked. Readers share the data lock,
+# which commands changing the FS in place hold alone. Commands that
+# change the FS hold the writer lock alone for as long as they run,
+# so that a defrag does not have to block the readers until it
+# replaces the FS
+DATA_LOCK = 0
+WRITER_LOCK = 1
+
+
+# Raised when a lock cannot be taken before the timeout
+class LockTimeout(Exception):
+    pass
+
+
+# Raised when a lock alone cannot be taken at all, since the lock
+# file cannot be written
+class LockDenied(Exception):
+    pass
+
+
+# Returns the lock timeout set in the environment or None, which is
+# also returned if it is not a number
+def timeout_from_environment():
+    value = os.environ.get(_TIMEOUT_VARIABLE, "")
+    if (value == ""):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# Reader/writer locks shared by every process using a FS, taken with
+# fcntl on a lock file next to the FS since the FS itself is replaced
+# by defrag. The threads of a process share the locks of the process
+class NotesLock:
+
+    def __init__(self, file_system, timeout):
+        self.path = file_system + _EXTENSION
+        self.timeout = timeout
+        self.fd = None
+        # Whether the lock file is open for writing, which fcntl needs
+        # to take a lock alone
+        self.writable = False
+        # Number of holders of each lock in this process, and the
+        # mutexes the threads of this process take to change them
+        self.holders = [0, 0]
+        self.mutexes = [threading.Lock(), threading.Lock()]
+        self.opening = threading.Lock()
+
+
+    # Opens the lock file, creating it if needed. Shared locks are
+    # skipped if the lock file cannot be opened at all, eg. on a
+    # read-only disk, while locks alone need it to be writable
+    def open(self):
+        if (self.fd != None):
+            return
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            self.writable = True
+        except OSError:
+            self.writable = False
+            try:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            except OSError:
+                self.fd = -1
+
+
+    # Closes the lock file, which releases every lock of this process
+    def close(self):
+        with self.opening:
+            if (self.fd != None and self.fd != -1):
+                os.close(self.fd)
+            self.fd = None
+            self.writable = False
+            self.holders = [0, 0]
+
+
+    # Takes a lock, shared or alone, waiting at most for the timeout.
+    # A lock already held by this process is held once more
+    def acquire(self, lock, exclusive):
+        with self.mutexes[lock]:
+            if (self.holders[lock] == 0):
+                self.lock_byte(lock, exclusive)
+            self.holders[lock] = self.holders[lock] + 1
+
+
+    def release(self, lock):
+        with self.mutexes[lock]:
+            self.holders[lock] = self.holders[lock] - 1
+            if (self.holders[lock] == 0 and self.fd != -1):
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, lock)
+
+
+    def lock_byte(self, lock, exclusive):
+        with self.opening:
+            self.open()
+        if (exclusive == True and self.writable == False):
+            raise LockDenied()
+        if (self.fd == -1):
+            return
+        if (exclusive == True):
+            command = fcntl.LOCK_EX
+        else:
+            command = fcntl.LOCK_SH
+
+        if (self.timeout == None):
+            fcntl.lockf(self.fd, command, 1, lock)
+            return
+        # Retrying with a growing delay until the timeout passes
+        deadline = time.monotonic() + self.timeout
+        delay = 0.001
+        while True:
+            try:
+                fcntl.lockf(self.fd, command | fcntl.LOCK_NB, 1, lock)
+                return
+            except (BlockingIOError, PermissionError):
+                remaining = deadline - time.monotonic()
+                if (remaining <= 0):
+                    raise LockTimeout()
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, _MAX_DELAY)
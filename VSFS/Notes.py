@@ -0,0 +1,1342 @@
+#!/usr/bin/python3
+import io
+import os
+import re
+import mmap
+import stat
+import bisect
+import hashlib
+import shutil
+import tempfile
+import contextlib
+import Index
+import Journal
+import Compression
+import Stats
+
+# First characters of the records in a notes file
+_FILE = b"@"
+_DIRECTORY = b"="
+_CONTENT = b" "
+_DELETED = b"#"
+# Record of contents shared by the files with the same contents,
+# eg. "$" followed by the SHA-256 of the contents
+_BLOB = b"$"
+# Attribute of a file whose contents are the ones of a blob
+_DIGEST = "h"
+
+# Size of the buffer used to copy the contents of a file
+_CHUNK_SIZE = 64 * 1024
+# Size of the part of a mapped FS copied at once to count its lines
+_COUNT_SIZE = 1024 * 1024
+# Start of the first line that is not a content record
+_NOT_CONTENT = re.compile(rb"\n[^ ]")
+# Start of the first line that is not deleted in place, which
+# includes the records deleted by prepending "#" to them
+_NOT_DELETED = re.compile(rb"\n(?:[^#]|#[@=$])")
+# Size of the changes of a batch kept in memory before
+# they are moved to a temporary file
+_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Default policy for compacting the FS after records are deleted
+_COMPACT_RATIO = 0.5
+_COMPACT_BYTES = 64 * 1024 * 1024
+_COMPACT_MIN_BYTES = 1024 * 1024
+# Extension of the region being compacted, stored next to the FS
+_COMPACT_EXTENSION = ".compact"
+
+
+class Record:
+
+    def __init__(self, key, line, offset, end, live):
+        # Record as it appears in the FS, eg. "@dir1/note1" or "=dir1/"
+        self.key = key
+        self.kind = key[0]
+        # Path of the file/dir without the trailing "/" of a dir
+        self.name = key[1:].rstrip("/")
+        # Lines of the record and its contents in the FS
+        # (same as readlines() indexes)
+        self.line = line
+        self.last_line = line
+        # Byte offsets of the record, the end of the record line
+        # and the end of its content records
+        self.offset = offset
+        self.header_end = end
+        self.content_end = end
+        self.live = live
+        # Attributes written after the record, eg. the compression
+        # of the contents of a file
+        self.attributes = {}
+
+
+    # Checks if the record line ends with a new-line character,
+    # which is only false for the last line of the FS
+    def has_newline(self):
+        length = len(join_header(self.key, self.attributes).encode())
+        return (self.header_end - self.offset > length)
+
+
+    # Returns the fields saved in the index for this record
+    def to_fields(self):
+        return [self.line, self.last_line, self.offset,
+                self.header_end, self.content_end, self.live, self.attributes]
+
+
+# Creates a record from the fields saved in the index
+def record_from_fields(key, fields):
+    record = Record(key, fields[0], fields[2], fields[3], fields[5])
+    record.last_line = fields[1]
+    record.content_end = fields[4]
+    record.attributes = fields[6]
+    return record
+
+
+# Returns the digest of the blob with the contents of a file or None
+def get_digest(attributes):
+    return attributes.get(_DIGEST)
+
+
+# Splits a file/dir record into its key and the attributes written
+# after a tab, eg. "@note1\tz=zlib;n=1200"
+def split_header(text):
+    key, tab, rest = text.partition("\t")
+    attributes = {}
+    if (rest != ""):
+        for field in rest.split(";"):
+            name, equals, value = field.partition("=")
+            attributes[name] = value
+    return key, attributes
+
+
+# Returns a file/dir record with its attributes
+def join_header(key, attributes):
+    if (len(attributes) == 0):
+        return key
+    fields = [name + "=" + value for name, value in attributes.items()]
+    return key + "\t" + ";".join(fields)
+
+
+class Directory:
+
+    def __init__(self, name, record):
+        # Path of the dir, "" for the root of the FS
+        self.name = name
+        # "=dir/" record of the dir, None if the dir is only
+        # implied by the paths of the records under it
+        self.record = record
+        # Sub dirs and files one level below, by name
+        self.dirs = {}
+        self.files = {}
+
+
+class CompactionPolicy:
+
+    def __init__(self, ratio, dead_bytes, min_bytes):
+        # Compacting when deleted lines make up this fraction of
+        # the FS (0 to disable)
+        self.ratio = ratio
+        # or when there are this many bytes of deleted lines
+        # (0 to disable)
+        self.dead_bytes = dead_bytes
+        # but never for less than this many bytes of deleted lines
+        self.min_bytes = min_bytes
+
+
+    # Checks if the deleted lines of the FS must be compacted
+    def should_compact(self, index):
+        if (index.dead_bytes == 0 or index.dead_bytes < self.min_bytes):
+            return False
+        if (self.ratio > 0 and index.dead_bytes >= index.size * self.ratio):
+            return True
+        if (self.dead_bytes > 0 and index.dead_bytes >= self.dead_bytes):
+            return True
+        return False
+
+
+    # Returns the run of deleted lines where compaction starts: the
+    # start of the longest tail of the FS in which deleted lines make
+    # up at least the ratio, or of the densest tail if there is none
+    def choose_region(self, index):
+        best = None
+        densest = None
+        best_density = -1
+        dead = 0
+        for run in reversed(index.dead_runs):
+            dead = dead + run[1] - run[0]
+            density = dead / (index.size - run[0])
+            if (density >= self.ratio):
+                best = run
+            if (density > best_density):
+                densest = run
+                best_density = density
+        if (best == None):
+            return densest
+        return best
+
+
+# Reads the compaction policy from the VSFS_COMPACT_RATIO,
+# VSFS_COMPACT_BYTES and VSFS_COMPACT_MIN_BYTES environment variables
+def policy_from_environment():
+    try:
+        ratio = float(os.environ.get("VSFS_COMPACT_RATIO", _COMPACT_RATIO))
+    except ValueError:
+        ratio = _COMPACT_RATIO
+    try:
+        dead_bytes = int(os.environ.get("VSFS_COMPACT_BYTES", _COMPACT_BYTES))
+    except ValueError:
+        dead_bytes = _COMPACT_BYTES
+    try:
+        min_bytes = int(os.environ.get("VSFS_COMPACT_MIN_BYTES", _COMPACT_MIN_BYTES))
+    except ValueError:
+        min_bytes = _COMPACT_MIN_BYTES
+    return CompactionPolicy(ratio, dead_bytes, min_bytes)
+
+
+class NotesImage:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.index = Index.NotesIndex(file_system)
+        # Live and deleted file/dir records by key
+        self.records = {}
+        self.root = Directory("", None)
+        # Number of live files referring to every blob, by digest
+        self.references = {}
+        # Whether the FS was written in place and must be reindexed,
+        # and the keys of the records changed since the index was
+        # saved, or None if it must be saved from scratch
+        self.written = False
+        self.touched = set()
+        self.policy = policy_from_environment()
+        # Appended bytes and deleted records of a batch, which are
+        # only written to the FS when the batch is committed
+        self.staging = None
+        self.staged_from = 0
+        self.pending = []
+        self.journal = Journal.NotesJournal(file_system)
+        # Whether the changes of a batch were discarded,
+        # so that the image must be loaded again
+        self.discarded = False
+
+
+    # Loads the records from the saved index, or parses
+    # the FS and saves its index if the index is stale. A change
+    # that was interrupted must have been finished with recover()
+    def load(self):
+        if (self.index.load() == True):
+            self.records = {}
+            for key, fields in self.index.records.items():
+                self.records[key] = record_from_fields(key, fields)
+            self.build_tree()
+        else:
+            self.rebuild()
+
+
+    # Parses the FS from scratch and saves its index
+    def rebuild(self):
+        self.index.update_signature()
+        with Stats.phase("parse"), open(self.file_system, "rb") as f:
+            Stats.count("full_reads")
+            if (os.fstat(f.fileno()).st_size == 0):
+                self.parse(f)
+            else:
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as notes:
+                    self.parse(notes)
+            Stats.count("records_scanned", len(self.records))
+        self.index.save()
+
+
+    # Checks if the FS was modified after it was loaded. During a
+    # batch the image is ahead of the FS and is never reloaded
+    def is_stale(self):
+        if (self.discarded == True):
+            return True
+        if (self.staging != None):
+            return False
+        return self.index.is_stale()
+
+
+    # Parses the lines (or the mapping) of the FS into
+    # records and dirs in a single streaming pass
+    def parse(self, lines):
+        self.records = {}
+        self.touched = set()
+        self.index.dead_records = 0
+        self.index.dead_bytes = 0
+        self.index.dead_runs = []
+        if (isinstance(lines, mmap.mmap) == True):
+            self.index.lines = self.parse_mapping(lines, 0, 0)[1]
+        else:
+            self.index.lines = self.parse_region(lines, 0, 0)[1]
+        self.save_records()
+        self.build_tree()
+
+
+    # Parses a mapped FS from a byte offset and line like parse_region,
+    # but skips all the content records of a file and every run of
+    # lines deleted in place with a single search, so that only the
+    # file/dir records are copied out of the mapping
+    def parse_mapping(self, notes, offset, line):
+        size = len(notes)
+        # Record and content marker of the file being parsed
+        current = None
+        marker = _CONTENT
+        while (offset < size):
+            first = notes[offset:offset + 1]
+            head = notes[offset:offset + 2]
+            if (current != None and marker == _CONTENT and first == _CONTENT):
+                # Content records of the current file
+                end = find_line(notes, offset, _NOT_CONTENT)
+                lines = count_lines(notes, offset, end)
+                current.last_line = line + lines - 1
+                current.content_end = end
+            elif (first == _DELETED
+                and head != _DELETED + _FILE
+                and head != _DELETED + _DIRECTORY
+                and head != _DELETED + _BLOB
+                and (current == None or head.startswith(marker) == False)
+            ):
+                # Lines deleted in place
+                end = find_line(notes, offset, _NOT_DELETED)
+                lines = count_lines(notes, offset, end)
+                self.add_dead_run(offset, end, line, lines)
+                current = None
+            else:
+                # File/dir record or a single line of any other kind,
+                # parsed the same way as by parse_region
+                end = notes.find(b"\n", offset)
+                if (end == -1):
+                    end = size
+                else:
+                    end = end + 1
+                lines = 1
+                if (current != None and head.startswith(marker)):
+                    current.last_line = line
+                    current.content_end = end
+                elif (first == _FILE or first == _DIRECTORY or first == _BLOB):
+                    current = self.parse_record(notes[offset:end], line, offset, end, True)
+                    marker = _CONTENT
+                elif (head == _DELETED + _FILE
+                    or head == _DELETED + _DIRECTORY
+                    or head == _DELETED + _BLOB
+                ):
+                    # Record deleted by prepending "#" to it
+                    current = self.parse_record(notes[offset + 1:end], line,
+                                                offset, end, False)
+                    marker = _DELETED + _CONTENT
+                else:
+                    current = None
+                if (first == _DELETED):
+                    self.add_dead_run(offset, end, line, 1)
+            offset = end
+            line = line + lines
+        return [offset, line]
+
+
+    # Parses lines that start at a byte offset and line of the FS,
+    # adding their records and deleted lines, and returns
+    # the offset and line after the last one
+    def parse_region(self, lines, offset, line):
+        # Record and content marker of the file being parsed
+        current = None
+        marker = _CONTENT
+        for text in lines:
+            first = text[0:1]
+            end = offset + len(text)
+            if (current != None and text.startswith(marker)):
+                # Content record of the current file
+                current.last_line = line
+                current.content_end = end
+            elif (first == _FILE or first == _DIRECTORY or first == _BLOB):
+                current = self.parse_record(text, line, offset, end, True)
+                marker = _CONTENT
+            elif (text.startswith(_DELETED + _FILE)
+                or text.startswith(_DELETED + _DIRECTORY)
+                or text.startswith(_DELETED + _BLOB)
+            ):
+                # Record deleted by prepending "#" to it
+                current = self.parse_record(text[1:], line, offset, end, False)
+                marker = _DELETED + _CONTENT
+            else:
+                current = None
+
+            if (first == _DELETED):
+                self.add_dead_run(offset, end, line, 1)
+            offset = end
+            line = line + 1
+        return [offset, line]
+
+
+    # Counts deleted lines, keeping the runs of deleted lines
+    # sorted and merged with the adjacent runs
+    def add_dead_run(self, start, end, line, lines):
+        self.index.add_dead_run(start, end, line, lines)
+
+
+    # Remembers that a record was changed, added or deleted since
+    # the index was saved
+    def touch(self, record):
+        if (self.touched != None):
+            self.touched.add(record.key)
+
+
+    # Adds a parsed file/dir record and returns it
+    def parse_record(self, text, line, offset, end, live):
+        key, attributes = split_header(text.rstrip(b"\n").decode())
+        record = Record(key, line, offset, end, live)
+        record.attributes = attributes
+        existing = self.records.get(key)
+        # A deleted record never hides a live record with the same name
+        if (live == True or existing == None or existing.live == False):
+            self.records[key] = record
+        return record
+
+
+    # Builds the dir tree from the live records and counts
+    # the references to every blob
+    def build_tree(self):
+        self.root = Directory("", None)
+        self.references = {}
+        for record in self.records.values():
+            if (record.live == True):
+                self.add_to_tree(record)
+
+
+    # Returns the dir one level above a path,
+    # creating the missing dirs on the way
+    def get_parent(self, name):
+        parts = name.split("/")
+        directory = self.root
+        for part in parts[:-1]:
+            child = directory.dirs.get(part)
+            if (child == None):
+                if (directory.name == ""):
+                    path = part
+                else:
+                    path = directory.name + "/" + part
+                child = Directory(path, None)
+                directory.dirs[part] = child
+            directory = child
+        return directory, parts[-1]
+
+
+    # Adds a live record to the dir tree. Blobs are not in the tree,
+    # but the files referring to them are counted
+    def add_to_tree(self, record):
+        if (record.kind == "$"):
+            return
+        digest = get_digest(record.attributes)
+        if (digest != None):
+            self.references[digest] = self.references.get(digest, 0) + 1
+        directory, name = self.get_parent(record.name)
+        if (record.kind == "@"):
+            directory.files[name] = record
+        else:
+            child = directory.dirs.get(name)
+            if (child == None):
+                child = Directory(record.name, record)
+                directory.dirs[name] = child
+            child.record = record
+
+
+    # Removes a deleted record from the dir tree. A blob is kept
+    # once no file refers to it, until the FS is defragmented
+    def remove_from_tree(self, record):
+        if (record.kind == "$"):
+            return
+        digest = get_digest(record.attributes)
+        if (digest != None):
+            self.references[digest] = self.references[digest] - 1
+        directory, name = self.get_parent(record.name)
+        if (record.kind == "@"):
+            directory.files.pop(name, None)
+        else:
+            directory.dirs.pop(name, None)
+
+
+    # Returns the live record of a file/dir or None
+    def lookup(self, key):
+        record = self.records.get(key)
+        if (record == None or record.live == False):
+            return None
+        return record
+
+
+    # Returns the live record of a file or None
+    def get_file(self, name):
+        return self.lookup("@" + name)
+
+
+    # Returns the live record of a blob or None
+    def get_blob(self, digest):
+        return self.lookup("$" + digest)
+
+
+    # Returns the live blobs that no live file refers to anymore
+    def get_unreferenced_blobs(self):
+        return [record for record in self.records.values()
+                if (record.kind == "$"
+                    and record.live == True
+                    and self.references.get(record.name, 0) == 0)]
+
+
+    # Returns an existing dir of the tree or None
+    def get_directory(self, name):
+        directory = self.root
+        for part in name.split("/"):
+            directory = directory.dirs.get(part)
+            if (directory == None):
+                return None
+        if (directory.record == None):
+            return None
+        return directory
+
+
+    # Checks if every dir above a file/dir exists, walking the
+    # dir tree one path component at a time
+    def has_parents(self, name):
+        directory = self.root
+        for part in name.split("/")[:-1]:
+            directory = directory.dirs.get(part)
+            if (directory == None or directory.record == None):
+                return False
+        return True
+
+
+    # Returns the live records of a dir and of everything under it,
+    # matching whole path components only (eg. "dir1/..." but
+    # not "dir10/...")
+    def get_subtree(self, directory):
+        records = []
+        pending = [directory]
+        while (len(pending) != 0):
+            directory = pending.pop()
+            if (directory.record != None):
+                records.append(directory.record)
+            records.extend(directory.files.values())
+            pending.extend(directory.dirs.values())
+        return records
+
+
+    # Copies the fields of the records to the index
+    def save_records(self):
+        self.index.records = {}
+        for key, record in self.records.items():
+            self.index.records[key] = record.to_fields()
+
+
+    # Copies the records to the index after the FS was written in
+    # place and saves it, appending only the records changed since it
+    # was saved unless it must be saved from scratch
+    def save_index(self):
+        self.index.update_signature()
+        if (self.touched == None):
+            self.save_records()
+            self.index.save()
+        else:
+            records = {}
+            for key in self.touched:
+                record = self.records.get(key)
+                if (record == None):
+                    records[key] = None
+                else:
+                    records[key] = record.to_fields()
+            self.index.save_changes(records)
+        self.touched = set()
+
+
+    # Returns the new-line character needed before appending
+    # a record, unless the FS already ends with one
+    def get_separator(self):
+        if (self.index.size == 0):
+            return b""
+        if (self.staging != None and self.index.size > self.staged_from):
+            # The last byte is in the changes of the batch
+            self.staging.seek(-1, os.SEEK_END)
+            last = self.staging.read(1)
+        else:
+            with open(self.file_system, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                last = f.read(1)
+        if (last == b"\n"):
+            return b""
+        return b"\n"
+
+
+    # Returns the file that appended records are staged in
+    @contextlib.contextmanager
+    def open_append(self):
+        self.staging.seek(0, os.SEEK_END)
+        yield self.staging
+
+
+    # Deletes a record and its contents in place by setting the
+    # first character of every line to "#", without moving any byte
+    def tombstone_record(self, record):
+        self.tombstone_records([record])
+
+
+    # Deletes many records in a single forward pass over
+    # one mapping of the FS, in the order of their offsets.
+    # The records already in the FS are only deleted when
+    # the change or batch is committed
+    def tombstone_records(self, records):
+        if (len(records) == 0):
+            return
+        records = sorted(records, key = lambda record: record.offset)
+        with self.changing():
+            for record in records:
+                if (record.offset >= self.staged_from):
+                    mark_lines(self.staging, record.offset - self.staged_from,
+                               record.content_end - self.staged_from)
+                else:
+                    self.pending.append(record)
+
+            for record in records:
+                self.add_dead_run(record.offset, record.content_end, record.line,
+                                  record.last_line - record.line + 1)
+                # The name of a record deleted in place is lost, so it is
+                # forgotten like it would be when parsing the FS again
+                record.live = False
+                del self.records[record.key]
+                self.touch(record)
+            # Removing the deepest records from the dir tree first
+            for record in sorted(records, key = lambda record: record.name, reverse = True):
+                self.remove_from_tree(record)
+            self.written = True
+
+
+    # Appends a file record to the end of the FS, streaming
+    # the lines of the external file as content records. Compressed
+    # contents are stored as lines of base64
+    def append_file(self, name, external_file, compression = None):
+        self.append_contents("@" + name, external_file, compression)
+
+
+    # Appends the blob record of contents shared by several files
+    def append_blob(self, digest, external_file, compression = None):
+        self.append_contents("$" + digest, external_file, compression)
+
+
+    # Appends a file or blob record and its contents
+    def append_contents(self, key, external_file, compression):
+        with Compression.open_contents(external_file, compression,
+                                       True) as (source, attributes):
+            # Adding a space to every line of the external file
+            self.append_record(key, attributes,
+                               lambda f: write_content_lines(source, f))
+
+
+    # Reads the contents of an external file and encodes them as
+    # content records into a temporary file, hashing them if needed.
+    # Nothing of the image is used, so several files can be encoded
+    # by other threads while records are appended
+    def encode_contents(self, external_file, compression, hashed = False):
+        encoded = EncodedContents(hashed, (compression == None))
+        with Compression.open_contents(external_file, compression, True,
+                                       encoded.digest) as (source, attributes):
+            encoded.attributes = attributes
+            encoded.size, encoded.lines = write_content_lines(source, encoded.data)
+        return encoded
+
+
+    # Appends a file or blob record and the contents encoded for it
+    # by encode_contents
+    def append_encoded(self, key, encoded):
+        encoded.data.seek(0)
+        self.append_record(key, encoded.attributes,
+                           lambda f: encoded.copy_to(f))
+
+
+    # Appends a file or blob record whose content records are written
+    # by a function that returns their size and number of lines
+    def append_record(self, key, attributes, write):
+        with self.changing():
+            separator = self.start_append()
+            offset = self.index.size + len(separator)
+            header = join_header(key, attributes).encode() + b"\n"
+            record = Record(key, self.index.lines, offset,
+                            offset + len(header), True)
+            record.attributes = attributes
+
+            with self.open_append() as f:
+                f.write(separator + header)
+                size, lines = write(f)
+            record.content_end = record.content_end + size
+            record.last_line = record.last_line + lines
+            self.add_appended(record)
+
+
+    # Appends a file record without contents, whose
+    # contents are the ones of a blob
+    def append_link(self, name, digest):
+        key = "@" + name
+        with self.changing():
+            separator = self.start_append()
+            offset = self.index.size + len(separator)
+            attributes = {_DIGEST: digest}
+            header = join_header(key, attributes).encode() + b"\n"
+            record = Record(key, self.index.lines, offset,
+                            offset + len(header), True)
+            record.attributes = attributes
+
+            with self.open_append() as f:
+                f.write(separator + header)
+            self.add_appended(record)
+
+
+    # Appends a dir record to the end of the FS
+    def append_directory(self, name):
+        key = "=" + name + "/"
+        with self.changing():
+            separator = self.start_append()
+            offset = self.index.size + len(separator)
+            header = key.encode()
+            record = Record(key, self.index.lines, offset,
+                            offset + len(header), True)
+
+            with self.open_append() as f:
+                f.write(separator + header)
+            self.add_appended(record)
+
+
+    # Returns the new-line character needed before appending
+    # a record, which belongs to the last line of the FS
+    def start_append(self):
+        separator = self.get_separator()
+        if (len(separator) == 0):
+            return separator
+        size = self.index.size
+        runs = self.index.dead_runs
+        if (len(runs) != 0 and runs[-1][1] == size):
+            self.index.grow_last_run()
+        for record in self.records.values():
+            if (record.content_end == size):
+                if (record.header_end == size):
+                    record.header_end = size + 1
+                record.content_end = size + 1
+                self.touch(record)
+        return separator
+
+
+    # Adds a record appended to the FS to the records and dir tree
+    def add_appended(self, record):
+        self.index.size = record.content_end
+        self.index.lines = record.last_line + 1
+        self.records[record.key] = record
+        self.add_to_tree(record)
+        self.touch(record)
+        self.written = True
+
+
+    # Returns the size of the contents of a file without the space
+    # at the start of every content record
+    def get_size(self, record):
+        return get_size(self.file_system, record)
+
+
+    # Copies the contents of a file to an external file through a
+    # bounded buffer, removing the space at the start of every content
+    # record and the new-line character at the end of the last one
+    def copy_file(self, record, external_file):
+        copy_file(self.file_system, record, external_file)
+
+
+    # Compacts a region of the FS if the compaction policy
+    # requires it and returns the number of records and bytes
+    # that were reclaimed
+    def compact_if_needed(self):
+        if (self.staging != None
+            or self.policy.should_compact(self.index) == False
+        ):
+            return [0, 0]
+        return self.compact()
+
+
+    # Removes the deleted lines from the tail of the FS chosen by the
+    # compaction policy, without rewriting the FS before it. The live
+    # lines of the tail are first written to a file next to the FS so
+    # that an interrupted compaction can be finished by the next command
+    def compact(self):
+        with Stats.phase("compact"):
+            return self.compact_region()
+
+
+    # Compacts the tail of the FS for compact()
+    def compact_region(self):
+        run = self.policy.choose_region(self.index)
+        start = run[0]
+        size = self.index.size
+
+        # Forgetting the records and deleted lines of the tail,
+        # which are parsed again while they are copied
+        for key in list(self.records.keys()):
+            if (self.records[key].offset >= start):
+                del self.records[key]
+        runs = self.index.dead_runs
+        position = bisect.bisect_left(runs, [start])
+        reclaimed = 0
+        for removed in runs[position:]:
+            reclaimed = reclaimed + removed[3]
+            self.index.dead_bytes = self.index.dead_bytes - (removed[1] - removed[0])
+        self.index.dead_records = self.index.dead_records - reclaimed
+        del runs[position:]
+
+        # Replaying the journal would undo the compaction
+        self.journal.clear(True)
+        temp_path = self.file_system + _COMPACT_EXTENSION
+        with open(temp_path, "wb") as target:
+            target.write(compaction_header(start, 0, 0))
+            with open(self.file_system, "rb") as source:
+                source.seek(start)
+                end = self.parse_region(self.copy_live_lines(source, target, False),
+                                        start, run[2])
+            # Marking the region as complete once it is on disk
+            target.flush()
+            os.fsync(target.fileno())
+            target.seek(0)
+            target.write(compaction_header(start, end[0] - start, 1))
+            target.flush()
+            os.fsync(target.fileno())
+        apply_compaction(self.file_system)
+
+        self.index.size = end[0]
+        self.index.lines = end[1]
+        self.build_tree()
+        self.written = True
+        self.touched = None
+        return [reclaimed, size - end[0]]
+
+
+    # Saves the index after the FS was written in place so that
+    # the next command does not have to parse the FS again.
+    # Nothing is saved until a batch is committed
+    def flush(self):
+        if (self.staging != None):
+            return
+        if (self.written == True):
+            self.save_index()
+        self.written = False
+
+
+    # Starts a batch, staging the appended records in memory (or in a
+    # temporary file once they get large) and the deleted records in
+    # a list, so that nothing is written to the FS until it is committed
+    def begin(self):
+        directory = os.path.dirname(os.path.abspath(self.file_system))
+        self.staging = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE,
+                                                     dir = directory)
+        self.staged_from = self.index.size
+        self.pending = []
+
+
+    # Discards the changes of a batch. The records in memory are not
+    # restored, so the image must be loaded again if anything changed
+    def rollback(self):
+        if (self.index.size > self.staged_from or len(self.pending) != 0):
+            self.discarded = True
+        self.staging.close()
+        self.staging = None
+        self.pending = []
+
+
+    # Writes the changes of a batch to the journal as a single entry
+    # with a single fsync, then to the FS with a single sequential
+    # append and a single pass to delete the records, and finally
+    # compacts the FS if needed and saves the index
+    def commit(self):
+        staging = self.staging
+        self.staging = None
+        spans = [[record.offset, record.content_end] for record in self.pending]
+        self.pending = []
+        with staging, Stats.phase("commit"):
+            length = self.index.size - self.staged_from
+            if (length > 0 or len(spans) != 0):
+                try:
+                    self.journal.commit(self.staged_from, staging, length, spans)
+                except BaseException:
+                    # The FS is what the journal is replayed into
+                    self.discarded = True
+                    raise
+        self.compact_if_needed()
+        self.flush()
+
+
+    # Stages the changes made inside the block and commits them
+    # at once, unless they are part of a batch being staged
+    @contextlib.contextmanager
+    def changing(self):
+        if (self.staging != None):
+            yield
+            return
+        self.begin()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+
+    # Removes every deleted line from the FS by streaming the live lines
+    # into a temporary file in the same dir, which atomically replaces
+    # the FS once it is on disk, and returns the number of records
+    # and bytes that were reclaimed
+    def defrag(self, replacing = contextlib.nullcontext):
+        path = os.path.abspath(self.file_system)
+        directory = os.path.dirname(path)
+        size = os.stat(path).st_size
+        # Replaying the journal would change the new FS
+        self.journal.clear(True)
+        fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(path) + ".",
+                                         suffix = ".defrag", dir = directory)
+        Stats.count("full_reads")
+        Stats.count("full_writes")
+        try:
+            with os.fdopen(fd, "wb") as target, Stats.phase("rewrite"):
+                with open(path, "rb") as source:
+                    # Parsing the live lines while they are written
+                    self.parse(self.copy_live_lines(source, target, True))
+                    Stats.count("records_scanned", len(self.records))
+                target.flush()
+                os.fsync(target.fileno())
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+            # Only the replace has to wait for the readers of the old FS
+            with replacing():
+                os.replace(temp_path, path)
+                sync_directory(directory)
+                self.index.update_signature()
+                self.index.save()
+        except BaseException:
+            if (os.path.exists(temp_path)):
+                os.unlink(temp_path)
+            raise
+        return [self.reclaimed, size - self.index.size]
+
+
+    # Writes the lines of the source that do not start with "#" to
+    # the target and yields them, removing the new-line character
+    # of the last line if needed
+    def copy_live_lines(self, source, target, strip_last):
+        self.reclaimed = 0
+        previous = None
+        for text in source:
+            if (text[0:1] == _DELETED):
+                self.reclaimed = self.reclaimed + 1
+                continue
+            if (previous != None):
+                target.write(previous)
+                yield previous
+            previous = text
+
+        if (previous != None):
+            if (strip_last == True):
+                previous = previous.rstrip(b"\n")
+            target.write(previous)
+            yield previous
+
+
+# Makes a rename in a dir durable
+def sync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Returns the end of the contents of a file without the new-line
+# character at the end of its last content record, reading the FS
+# with os.pread so that several threads can share the open file
+def get_content_end(source, record):
+    end = record.content_end
+    if (end > record.header_end):
+        if (os.pread(source.fileno(), 1, end - 1) == b"\n"):
+            end = end - 1
+    return end
+
+
+# Returns the size of the contents of a file without the space
+# at the start of every content record, as stored in the FS
+def get_size(file_system, record):
+    with open(file_system, "rb") as source:
+        return get_stored_size(source, record)
+
+
+# Returns the size of the contents of a file like get_size,
+# reading the FS through an open file
+def get_stored_size(source, record):
+    end = get_content_end(source, record)
+    return end - record.header_end - (record.last_line - record.line)
+
+
+# Copies the contents of a file to an external file through a
+# bounded buffer, removing the space at the start of every content
+# record and the new-line character at the end of the last one.
+# Compressed contents are decompressed while they are copied
+def copy_file(file_system, record, external_file):
+    with open(file_system, "rb") as source:
+        export_file(source, record, external_file)
+
+
+# Copies the contents of a file to an external file like copy_file,
+# reading the FS through an open file that threads can share
+def export_file(source, record, external_file):
+    codec = Compression.get_codec(record.attributes)
+    # Truncating the external file instead of adding to it
+    with open(external_file, "wb") as target:
+        if (codec == None):
+            copy_record(source, record, target)
+        else:
+            decoder = Compression.Base64Reader(
+                Compression.DecompressingWriter(target, codec))
+            copy_record(source, record, decoder)
+            decoder.close()
+
+
+# Copies the compressed contents of a file to an open file,
+# decoding the lines of base64 they are stored as
+def copy_decoded(file_system, record, target):
+    decoder = Compression.Base64Reader(target)
+    copy_contents(file_system, record, decoder)
+    decoder.close()
+
+
+# Copies the contents of a file to an open file like copy_file
+def copy_contents(file_system, record, target):
+    with open(file_system, "rb") as source:
+        copy_record(source, record, target)
+
+
+# Copies the contents of a file to an open file like copy_contents,
+# reading the FS through an open file with os.pread so that several
+# threads can share it
+def copy_record(source, record, target):
+    end = get_content_end(source, record)
+    position = record.header_end
+    line_start = True
+    while (position < end):
+        chunk = os.pread(source.fileno(), min(_CHUNK_SIZE, end - position), position)
+        if (len(chunk) == 0):
+            break
+        position = position + len(chunk)
+        # Every line is a content record, so a space follows every
+        # new-line character, except at the end of the chunk
+        data = chunk.replace(b"\n" + _CONTENT, b"\n")
+        if (line_start == True):
+            # Skipping the space of the content record
+            data = data[1:]
+        target.write(data)
+        line_start = (chunk[len(chunk) - 1:] == b"\n")
+
+
+# Writes the contents of an open file as content records, adding a
+# space at the start of every line a chunk at a time, and returns
+# the number of bytes and lines written. The new-line character ending
+# the last content record is not part of the contents, so contents
+# ending with one lose it unless they are written exactly, which ends
+# them with an empty content record
+def write_content_lines(source, target, exact = False):
+    size = 0
+    lines = 0
+    line_start = True
+    while True:
+        chunk = source.read(_CHUNK_SIZE)
+        if (len(chunk) == 0):
+            break
+        # A new-line character at the end of the chunk only starts
+        # a line if the next chunk has one
+        last = len(chunk) - 1
+        lines = lines + chunk.count(b"\n", 0, last)
+        data = chunk[:last].replace(b"\n", b"\n" + _CONTENT) + chunk[last:]
+        if (line_start == True):
+            data = _CONTENT + data
+            lines = lines + 1
+        target.write(data)
+        size = size + len(data)
+        line_start = (chunk[last:] == b"\n")
+    if (exact == True and size != 0 and line_start == True):
+        target.write(_CONTENT)
+        size = size + len(_CONTENT)
+        lines = lines + 1
+    return [size, lines]
+
+
+# SHA-256 of contents as a text FS stores them without compression,
+# which is without the new-line character they end with, if any, since
+# it is read back as the end of the last content record
+class StoredDigest:
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.pending = b""
+
+
+    def update(self, data):
+        data = bytes(data)
+        if (len(data) == 0):
+            return
+        self.digest.update(self.pending)
+        self.pending = b""
+        if (data[len(data) - 1:] == b"\n"):
+            data = data[:len(data) - 1]
+            self.pending = b"\n"
+        self.digest.update(data)
+
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+# Returns a new SHA-256 of contents as they are stored, which are
+# trimmed for the uncompressed contents of a text FS
+def new_digest(trimmed):
+    if (trimmed == True):
+        return StoredDigest()
+    return hashlib.sha256()
+
+
+# Contents of an external file encoded by encode_contents as they are
+# stored, in memory or in a temporary file once they get large
+class EncodedContents:
+
+    def __init__(self, hashed, trimmed = False):
+        self.data = tempfile.SpooledTemporaryFile(max_size = _SPOOL_SIZE)
+        self.attributes = {}
+        self.size = 0
+        # Number of content records, which a binary FS does not have
+        self.lines = 0
+        # SHA-256 of the contents as they are stored if they are hashed
+        self.digest = None
+        if (hashed == True):
+            self.digest = new_digest(trimmed)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *error):
+        self.data.close()
+
+
+    # Copies the encoded contents to an open file and
+    # returns their size and number of lines
+    def copy_to(self, target):
+        shutil.copyfileobj(self.data, target, _CHUNK_SIZE)
+        return [self.size, self.lines]
+
+
+# Returns the start of the first line after an offset of a mapped FS
+# that matches a pattern, or the end of the FS
+def find_line(notes, offset, pattern):
+    match = pattern.search(notes, offset)
+    if (match == None):
+        return len(notes)
+    return match.start() + 1
+
+
+# Counts the lines between two offsets of a mapped FS,
+# copying a bounded part of the mapping at a time
+def count_lines(notes, start, end):
+    lines = 0
+    position = start
+    while (position < end):
+        stop = min(end, position + _COUNT_SIZE)
+        lines = lines + notes[position:stop].count(b"\n")
+        position = stop
+    if (end > start and notes[end - 1:end] != b"\n"):
+        lines = lines + 1
+    return lines
+
+
+# Sets the first character of every line between two offsets
+# of a file to "#"
+def mark_lines(f, start, end):
+    f.seek(start)
+    span = f.read(end - start)
+    position = 0
+    while (position != -1 and position < len(span)):
+        f.seek(start + position)
+        f.write(_DELETED)
+        position = span.find(b"\n", position)
+        if (position != -1):
+            position = position + 1
+
+
+# Returns the fixed length header of a compacted region
+def compaction_header(start, length, complete):
+    return b"VSFS COMPACT %020d %020d %d\n" % (start, length, complete)
+
+
+# Copies a compacted region written next to the FS back into the FS
+# and truncates the FS after it. A region that was not completely
+# written is discarded since the FS was not changed yet. Returns True
+# if the FS was changed
+def apply_compaction(file_system):
+    temp_path = file_system + _COMPACT_EXTENSION
+    try:
+        f = open(temp_path, "rb")
+    except FileNotFoundError:
+        return False
+
+    changed = False
+    with f:
+        header = f.readline()
+        fields = header.split()
+        if (len(fields) == 5 and fields[4] == b"1"):
+            start = int(fields[2])
+            length = int(fields[3])
+            with open(file_system, "r+b") as notes:
+                notes.seek(start)
+                shutil.copyfileobj(f, notes)
+                notes.truncate(start + length)
+                notes.flush()
+                os.fsync(notes.fileno())
+            changed = True
+    try:
+        os.unlink(temp_path)
+    except FileNotFoundError:
+        # Finished by another process at the same time
+        pass
+    sync_directory(os.path.dirname(os.path.abspath(file_system)))
+    return changed
+
+
+# Checks if a compaction or a change was interrupted, without reading
+# the FS, so that it is cheap enough to be checked by every command
+def needs_recovery(file_system):
+    if (os.path.exists(file_system + _COMPACT_EXTENSION) == True):
+        return True
+    return Journal.NotesJournal(file_system).is_pending()
+
+
+# Finishes a compaction or applies the journal of a change that was
+# interrupted, and returns True if the FS was changed. The FS is
+# changed in place, so it must be held alone
+def recover(file_system):
+    compacted = apply_compaction(file_system)
+    replayed = Journal.NotesJournal(file_system).replay()
+    return (compacted == True or replayed == True)
+
+
+# Finds single file/dir records in the mapped FS without parsing it,
+# for the commands that only read a few records. The pages of the
+# mapping are shared by every process reading the FS, which must
+# have been recovered
+class RecordScanner:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.file = open(file_system, "rb")
+        fs_stat = os.fstat(self.file.fileno())
+        # Size and modification time of the FS when it was mapped
+        self.signature = [fs_stat.st_size, fs_stat.st_mtime_ns]
+        self.notes = None
+        if (fs_stat.st_size > 0):
+            self.notes = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        # Records already looked up, None if they were not found
+        self.records = {}
+        # Sorted [offset, line] pairs of the lines already counted
+        self.lines = [[0, 0]]
+
+
+    # Checks if the FS was modified after it was mapped
+    def is_stale(self):
+        try:
+            fs_stat = os.stat(self.file_system)
+        except OSError:
+            return True
+        return ([fs_stat.st_size, fs_stat.st_mtime_ns] != self.signature)
+
+
+    def close(self):
+        if (self.notes != None):
+            self.notes.close()
+            self.notes = None
+        self.file.close()
+
+
+    # Returns the live record of a file/dir or None
+    def lookup(self, key):
+        if (key not in self.records):
+            self.records[key] = self.find(key)
+        return self.records[key]
+
+
+    # Searches the mapped FS for the last live record of a file/dir,
+    # which is the one kept when parsing the FS
+    def find(self, key):
+        notes = self.notes
+        if (notes == None):
+            return None
+        Stats.count("records_scanned")
+        header = b"\n" + key.encode()
+        size = len(notes)
+        if (size >= len(header) and notes[size - len(header):] == header):
+            # Last line of the FS, without a new-line character
+            offset = size - len(header) + 1
+            end = size
+        else:
+            # The record is followed by a new-line character
+            # or by a tab and its attributes
+            position = max(notes.rfind(header + b"\n"), notes.rfind(header + b"\t"))
+            if (position == -1):
+                return None
+            offset = position + 1
+            end = notes.find(b"\n", offset)
+            if (end == -1):
+                end = size
+            else:
+                end = end + 1
+
+        record = Record(key, self.get_line(offset), offset, end, True)
+        record.attributes = split_header(notes[offset:end].rstrip(b"\n").decode())[1]
+        if (notes[end:end + 1] == _CONTENT):
+            record.content_end = find_line(notes, end, _NOT_CONTENT)
+            record.last_line = record.line + count_lines(notes, end, record.content_end)
+        return record
+
+
+    # Returns the line that starts at an offset, counting the lines
+    # from the closest offset that was already counted
+    def get_line(self, offset):
+        position = bisect.bisect_right(self.lines, [offset, float("inf")]) - 1
+        start, line = self.lines[position]
+        if (start != offset):
+            line = line + count_lines(self.notes, start, offset)
+            self.lines.insert(position + 1, [offset, line])
+        return line
+
+
+# Deletes a file/dir record found by a RecordScanner and its contents
+# in place without loading the image of the FS, and appends the
+# change to the index. Returns False without changing anything if
+# the index is stale or the FS must then be compacted, which needs
+# the image
+def tombstone_scanned(file_system, record):
+    index = Index.NotesIndex(file_system)
+    if (index.load_state() == False):
+        return False
+    index.add_dead_run(record.offset, record.content_end, record.line,
+                       record.last_line - record.line + 1)
+    if (policy_from_environment().should_compact(index) == True):
+        return False
+    with Stats.phase("commit"):
+        Journal.NotesJournal(file_system).commit(index.size, io.BytesIO(), 0,
+                                                 [[record.offset, record.content_end]])
+    index.update_signature()
+    index.append_changes({record.key: None})
+    return True
+
+
+# Loads the image of a FS, using its index if it is fresh
+def load_image(file_system):
+    image = NotesImage(file_system)
+    image.load()
+    return image
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+import os
+import re
+import json
+
+# Extension of the search index stored next to the FS, which is
+# only kept up to date once it was built with "index --search"
+_EXTENSION = ".search"
+_SEARCH_VERSION = 1
+_CHUNK_SIZE = 64 * 1024
+# Words are runs of ASCII letters, digits and "_"
+_TOKEN = re.compile(rb"\w+")
+_TRAILING_TOKEN = re.compile(rb"\w*\Z")
+# Longer words are not indexed, and the files that have some are
+# listed under the empty token so that they are always searched
+_MAX_TOKEN = 64
+_LONG_TOKEN = ""
+
+
+# Collects the words of contents read a chunk at a time,
+# including the words split between two chunks
+class Tokenizer:
+
+    def __init__(self):
+        self.tokens = set()
+        self.pending = b""
+
+
+    def update(self, data):
+        data = self.pending + bytes(data)
+        end = _TRAILING_TOKEN.search(data).start()
+        self.add(data[:end])
+        self.pending = data[end:]
+        if (len(self.pending) > _MAX_TOKEN):
+            self.tokens.add(_LONG_TOKEN)
+            self.pending = b""
+
+
+    def add(self, data):
+        for token in _TOKEN.findall(data):
+            if (len(token) > _MAX_TOKEN):
+                self.tokens.add(_LONG_TOKEN)
+            else:
+                self.tokens.add(token.decode("ascii"))
+
+
+    # Returns the words of everything that was read
+    def finish(self):
+        self.add(self.pending)
+        self.pending = b""
+        return self.tokens
+
+
+# Returns the words of the contents of an open file
+def tokenize(source):
+    tokenizer = Tokenizer()
+    while True:
+        chunk = source.read(_CHUNK_SIZE)
+        if (len(chunk) == 0):
+            break
+        tokenizer.update(chunk)
+    return tokenizer.finish()
+
+
+def tokenize_file(external_file):
+    with open(external_file, "rb") as source:
+        return tokenize(source)
+
+
+# Checks if a file contains a string, reading it a chunk at a time
+def contains(source, needle):
+    tail = b""
+    while True:
+        chunk = source.read(_CHUNK_SIZE)
+        if (len(chunk) == 0):
+            return False
+        data = tail + chunk
+        if (needle in data):
+            return True
+        # Keeping what could be the start of a match with the next chunk
+        tail = data[max(len(data) - len(needle) + 1, 0):]
+
+
+# Checks if the contents of a record stored as they are between two
+# offsets of a mapped FS contain a string. The contents of a text FS
+# are lines, each stored after a space that is not part of them
+def find_in_region(notes, needle, start, end, lines):
+    if (lines == True):
+        needle = needle.replace(b"\n", b"\n ")
+    position = notes.find(needle, start, end)
+    while (position != -1):
+        # A match starting at the space of a line is not in the contents
+        if (lines == False or notes[position - 1:position] != b"\n"):
+            return True
+        position = notes.find(needle, position + 1, end)
+    return False
+
+
+# Checks if a word of the index can hold a word of the searched string,
+# which is only a part of a word where the string starts or ends
+def token_matches(token, word, left_open, right_open):
+    if (left_open == True and right_open == True):
+        return (word in token)
+    if (left_open == True):
+        return token.endswith(word)
+    if (right_open == True):
+        return token.startswith(word)
+    return (token == word)
+
+
+# Checks if the FS has a search index
+def exists(file_system):
+    return os.path.exists(file_system + _EXTENSION)
+
+
+# Maps the words of the contents of every IF to the IFs that
+# contain them, saved next to the FS
+class SearchIndex:
+
+    def __init__(self, file_system):
+        self.file_system = file_system
+        self.path = file_system + _EXTENSION
+        # Paths of the IFs that contain every word
+        self.postings = {}
+        # Words of every IF, by path
+        self.files = {}
+        # Paths of the IFs and their numbers that contain every word,
+        # as they are saved, until the index is changed
+        self.paths = None
+        self.saved = None
+        # Size and modification time of the FS when it was indexed
+        self.size = -1
+        self.mtime_ns = -1
+        # Whether IFs were added or removed since the index was saved
+        self.changed = False
+
+
+    # Returns the current size and modification time of the FS
+    def get_signature(self):
+        stat = os.stat(self.file_system)
+        return [stat.st_size, stat.st_mtime_ns]
+
+
+    def update_signature(self):
+        self.size, self.mtime_ns = self.get_signature()
+
+
+    # Checks if the FS was modified after it was indexed
+    def is_stale(self):
+        try:
+            return (self.get_signature() != [self.size, self.mtime_ns])
+        except FileNotFoundError:
+            return True
+
+
+    # Loads the index saved next to the FS and returns False
+    # if it is missing, unreadable or stale
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if (data.get("version") != _SEARCH_VERSION):
+            return False
+        self.size = data["size"]
+        self.mtime_ns = data["mtime_ns"]
+        self.paths = data["paths"]
+        self.saved = data["tokens"]
+        return (self.is_stale() == False)
+
+
+    # Maps the words to the paths of the IFs that contain them, and the
+    # IFs to their words, before the index is changed. A search only
+    # needs the words as they are saved
+    def expand(self):
+        if (self.saved == None):
+            return
+        for token, ids in self.saved.items():
+            self.postings[token] = set([self.paths[i] for i in ids])
+        for path in self.paths:
+            self.files[path] = set()
+        for token, posting in self.postings.items():
+            for path in posting:
+                self.files[path].add(token)
+        self.paths = None
+        self.saved = None
+
+
+    # Returns the words of the index
+    def get_tokens(self):
+        if (self.saved != None):
+            return self.saved.keys()
+        return self.postings.keys()
+
+
+    # Returns the paths of the IFs that contain a word
+    def get_posting(self, token):
+        if (self.saved != None):
+            return set([self.paths[i] for i in self.saved.get(token, [])])
+        return set(self.postings.get(token, set()))
+
+
+    # Saves the index next to the FS with the current signature
+    # of the FS, ignoring failures since the index can always be rebuilt
+    def save(self):
+        self.update_signature()
+        self.write()
+
+
+    # Saves the index so that it is rebuilt by the next search,
+    # once it can no longer be kept up to date
+    def invalidate(self):
+        self.size = -1
+        self.mtime_ns = -1
+        self.write()
+
+
+    def write(self):
+        self.expand()
+        paths = sorted(self.files.keys())
+        ids = {}
+        for i, path in enumerate(paths):
+            ids[path] = i
+        tokens = {}
+        for token, posting in self.postings.items():
+            tokens[token] = sorted([ids[path] for path in posting])
+        data = {
+            "version": _SEARCH_VERSION,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "paths": paths,
+            "tokens": tokens
+        }
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(data, f, separators = (",", ":"))
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+        self.changed = False
+
+
+    # Adds the words of an IF, replacing the ones it had
+    def add(self, path, tokens):
+        self.expand()
+        self.remove([path])
+        self.changed = True
+        self.files[path] = set(tokens)
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(path)
+
+
+    def remove(self, paths):
+        self.expand()
+        for path in paths:
+            if (path in self.files):
+                self.changed = True
+            for token in self.files.pop(path, set()):
+                posting = self.postings[token]
+                posting.discard(path)
+                if (len(posting) == 0):
+                    del self.postings[token]
+
+
+    # Returns the paths of the IFs that may contain a string, or None
+    # if the string has no word to look up. Only the words where the
+    # string starts or ends can be parts of longer words, the words of
+    # the index are checked for them
+    def get_candidates(self, pattern):
+        data = pattern.encode()
+        candidates = None
+        for match in _TOKEN.finditer(data):
+            word = match.group().decode("ascii")
+            left_open = (match.start() == 0)
+            right_open = (match.end() == len(data))
+            if (left_open == False and right_open == False and len(word) <= _MAX_TOKEN):
+                paths = self.get_posting(word)
+            else:
+                paths = self.get_posting(_LONG_TOKEN)
+                for token in self.get_tokens():
+                    if (token_matches(token, word, left_open, right_open) == True):
+                        paths.update(self.get_posting(token))
+            if (candidates == None):
+                candidates = paths
+            else:
+                candidates = candidates & paths
+        return candidates
@@ -0,0 +1,651 @@
+#!/usr/bin/python3
+import os
+import json
+import stat
+import threading
+import contextlib
+import collections
+import Notes
+import Binary
+import Compression
+import Library
+import Search
+import Lock
+
+# First line of the manifest of a segmented FS, which is followed by
+# the size of its segments and the names of its segments as JSON
+_HEADER = b"NOTES SEGMENTS"
+# Version given to convert to split a FS into segments
+VERSION = "SEGMENTS"
+# Size a segment is filled to before a new one is started, read from
+# the VSFS_SEGMENT_SIZE environment variable when a FS is split
+_SEGMENT_SIZE = 64 * 1024 * 1024
+_SEGMENT_SIZE_VARIABLE = "VSFS_SEGMENT_SIZE"
+# Files kept next to a segment, which are deleted with it
+_SIDECARS = [".idx", ".search", ".journal", ".lock"]
+
+
+# Checks if a FS is the manifest of a segmented FS
+def is_segmented(file_system):
+    try:
+        with open(file_system, "rb") as f:
+            return (f.readline().rstrip() == _HEADER)
+    except OSError:
+        return False
+
+
+def segment_size_from_environment():
+    try:
+        size = int(os.environ.get(_SEGMENT_SIZE_VARIABLE, _SEGMENT_SIZE))
+    except ValueError:
+        size = _SEGMENT_SIZE
+    if (size <= 0):
+        size = _SEGMENT_SIZE
+    return size
+
+
+# Returns the size and the names of the segments of a segmented FS,
+# from the oldest to the active one
+def read_manifest(file_system):
+    try:
+        with open(file_system, "rb") as f:
+            first_line = f.readline().rstrip()
+            data = f.read()
+    except FileNotFoundError:
+        raise Library.FileSystemError("File System Not Found")
+    if (first_line != _HEADER):
+        raise Library.FileSystemError("File System Is Not Valid")
+    try:
+        data = json.loads(data)
+        return data["segment_size"], data["segments"]
+    except (ValueError, KeyError, TypeError):
+        raise Library.FileSystemError("File System Is Not Valid")
+
+
+# Writes the manifest of a segmented FS next to it, then replaces
+# the FS with it once it is on disk
+def write_manifest(file_system, segment_size, names):
+    data = {
+        "segment_size": segment_size,
+        "segments": names
+    }
+    temp_path = file_system + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_HEADER + b"\n" + json.dumps(data).encode() + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(temp_path, stat.S_IMODE(os.stat(file_system).st_mode))
+    os.replace(temp_path, file_system)
+    Notes.sync_directory(os.path.dirname(os.path.abspath(file_system)))
+
+
+# Returns the path of a segment, which is next to the manifest
+def get_path(file_system, name):
+    return os.path.join(os.path.dirname(file_system), name)
+
+
+# Returns the name of the segment started after the others,
+# eg. "VSFS.notes.3" after "VSFS.notes.2"
+def next_name(file_system, names):
+    number = 1
+    if (len(names) != 0):
+        number = int(names[-1].rpartition(".")[2]) + 1
+    return os.path.basename(file_system) + "." + str(number)
+
+
+# Writes a new text segment with a function, with the same permissions
+# as the manifest, and makes it durable
+def write_segment(file_system, name, write):
+    path = get_path(file_system, name)
+    with open(path, "wb") as target:
+        write(target)
+        target.flush()
+        os.fsync(target.fileno())
+    os.chmod(path, stat.S_IMODE(os.stat(file_system).st_mode))
+
+
+# Deletes a segment and the files kept next to it
+def delete_segment(segment):
+    segment.close()
+    for path in [segment.file_system] + [segment.file_system + extension
+                                         for extension in _SIDECARS]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+# Splits the entries of a FS into its dirs, the blobs by digest
+# and the files
+def split_entries(entries):
+    directories = []
+    blobs = {}
+    files = []
+    for entry in entries:
+        if (entry[0][0] == "="):
+            directories.append(entry)
+        elif (entry[0][0] == "$"):
+            blobs[entry[0][1:]] = entry
+        else:
+            files.append(entry)
+    return directories, blobs, files
+
+
+# Returns the entry of a file preceded by the entry of the blob holding
+# its contents, unless the blob is in a set of blobs already written
+def with_blob(entry, blobs, written):
+    digest = Notes.get_digest(entry[1])
+    if (digest == None or digest in written):
+        return [entry]
+    if (digest not in blobs):
+        raise Library.FileSystemError("File System Is Not Valid")
+    written.add(digest)
+    return [blobs[digest], entry]
+
+
+# Yields the entries written to a segment while it has room: every dir,
+# then the next files and the blobs of their contents, so that the
+# files of a segment only refer to its own blobs. A segment holds at
+# least one file even if it is larger than the segment size
+def fill_segment(target, directories, blobs, files, segment_size):
+    for entry in directories:
+        yield entry
+    written = set()
+    count = 0
+    while (len(files) != 0 and (count == 0 or target.tell() < segment_size)):
+        for entry in with_blob(files.popleft(), blobs, written):
+            yield entry
+        count = count + 1
+
+
+# Returns the entries of a FS holding the live records of the images of
+# segments: the dirs of the active segment, then the newest copy of
+# every file, after the blob holding its contents
+def merge_entries(images):
+    directories = split_entries(Binary.image_entries(images[-1]))[0]
+    blobs = {}
+    files = {}
+    for image in images:
+        segment_blobs, segment_files = split_entries(Binary.image_entries(image))[1:]
+        for digest, entry in segment_blobs.items():
+            blobs.setdefault(digest, entry)
+        for entry in segment_files:
+            # Keeping the files in the order they were last written
+            files.pop(entry[0], None)
+            files[entry[0]] = entry
+    entries = list(directories)
+    written = set()
+    for entry in files.values():
+        entries.extend(with_blob(entry, blobs, written))
+    return entries
+
+
+# Splits [EF, IF] pairs into the batches appended to a segment each,
+# given the room left in the active segment. A new batch is started
+# when an EF does not fit in the room left, and the first batch is
+# empty if the active segment has no room for the first EF
+def split_pairs(pairs, room, segment_size):
+    batches = [[]]
+    for pair in pairs:
+        size = os.path.getsize(pair[0])
+        if (size > room and (len(batches) == 1 or len(batches[-1]) != 0)):
+            batches.append([])
+            room = segment_size
+        batches[-1].append(pair)
+        room = room - size
+    return batches
+
+
+# Adds the dirs a segment does not hold yet as a single change
+def add_directories(segment, directories):
+    with segment.transaction():
+        for name in directories:
+            if (segment.isdir(name) == False):
+                segment.mkdir(name)
+
+
+# Splits a text or binary FS into text segments of about the segment
+# size (VSFS_SEGMENT_SIZE by default) and replaces it with their
+# manifest. Every segment holds every dir, and the blobs of its files
+def split(vsfs, segment_size = None):
+    if (segment_size == None):
+        segment_size = segment_size_from_environment()
+    file_system = vsfs.file_system
+    searched = Search.exists(file_system)
+    with vsfs.locked([Lock.WRITER_LOCK, True]):
+        with vsfs.reading():
+            image = vsfs.get_image()
+        directories, blobs, files = split_entries(Binary.image_entries(image))
+        files = collections.deque(files)
+        names = []
+        while (len(names) == 0 or len(files) != 0):
+            names.append(next_name(file_system, names))
+            write_segment(file_system, names[-1], lambda target:
+                Binary.write_text(target, fill_segment(target, directories, blobs,
+                                                       files, segment_size)))
+        # Only the replace has to wait for the readers of the old FS
+        with vsfs.locked([Lock.DATA_LOCK, True]):
+            write_manifest(file_system, segment_size, names)
+        vsfs.image = None
+        vsfs.close_scanner()
+        for extension in [".idx", ".search"]:
+            try:
+                os.unlink(file_system + extension)
+            except FileNotFoundError:
+                pass
+    if (searched == True):
+        with SegmentedVSFS(file_system) as segmented:
+            segmented.rebuild_search()
+
+
+# A FS split into a manifest and text segments, which are each a valid
+# text FS. Every segment holds every dir, while a file is appended to
+# the last (active) segment and deleted from the segment holding it
+# before, so a change only writes to the segments holding what it
+# changes. If a file is in several segments after a crash, the newest
+# copy is the one kept. New segments are started once the active one
+# is full, and defrag removes the segments left with no file
+class SegmentedVSFS:
+
+    def __init__(self, file_system, lock_timeout = None):
+        self.file_system = file_system
+        if (lock_timeout == None):
+            lock_timeout = Lock.timeout_from_environment()
+        self.lock_timeout = lock_timeout
+        self.lock = Lock.NotesLock(file_system, lock_timeout)
+        # Opened segments by name, and the mutex the threads of
+        # this process take to open them
+        self.opened = {}
+        self.opening = threading.Lock()
+        self.segment_size = read_manifest(file_system)[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *error):
+        self.close()
+
+
+    # Closes every opened segment and the lock file of the manifest
+    def close(self):
+        with self.opening:
+            for segment in self.opened.values():
+                segment.close()
+            self.opened = {}
+        self.lock.close()
+
+
+    # Holds locks of the manifest for as long as the block runs, which
+    # the segments are only changed under
+    @contextlib.contextmanager
+    def locked(self, *locks):
+        taken = []
+        try:
+            for lock, exclusive in locks:
+                try:
+                    self.lock.acquire(lock, exclusive)
+                except Lock.LockTimeout:
+                    raise Library.LockTimeoutError("Timed Out Waiting For The Lock")
+                except Lock.LockDenied:
+                    raise Library.FileSystemError("Lock File Is Not Writable")
+                taken.append(lock)
+            yield
+        finally:
+            for lock in reversed(taken):
+                self.lock.release(lock)
+
+
+    def reading(self):
+        return self.locked([Lock.DATA_LOCK, False])
+
+
+    def writing(self):
+        return self.locked([Lock.WRITER_LOCK, True], [Lock.DATA_LOCK, True])
+
+
+    # Returns the segments from the oldest to the active one, reading
+    # the manifest again since another process may have changed them
+    def get_segments(self):
+        self.segment_size, names = read_manifest(self.file_system)
+        with self.opening:
+            for name in list(self.opened.keys()):
+                if (name not in names):
+                    self.opened.pop(name).close()
+            segments = []
+            for name in names:
+                if (name not in self.opened):
+                    self.opened[name] = Library.VSFS(get_path(self.file_system, name),
+                                                     self.lock_timeout)
+                segments.append(self.opened[name])
+        return segments
+
+
+    # Returns the newest segment holding an IF, or the active segment,
+    # which then raises the errors of a missing IF, if none does
+    def get_holder(self, segments, path):
+        for segment in reversed(segments):
+            if (segment.isfile(path) == True):
+                return segment
+        return segments[-1]
+
+
+    # Raises an error if a path names a file, which is not always held
+    # by the active segment that the dirs are read from
+    def check_directory(self, segments, path):
+        if (path != "" and self.get_holder(segments, path).isfile(path) == True):
+            raise Library.InvalidPathError("Internal Path Is Not A Directory")
+
+
+    # Starts a new active segment holding every dir of the active one,
+    # which is on disk before the manifest lists it, and returns it
+    def add_segment(self, segments):
+        active = segments[-1]
+        names = [os.path.basename(segment.file_system) for segment in segments]
+        name = next_name(self.file_system, names)
+        with active.reading():
+            directories = split_entries(Binary.image_entries(active.get_image()))[0]
+        write_segment(self.file_system, name,
+                      lambda target: Binary.write_text(target, directories))
+        write_manifest(self.file_system, self.segment_size, names + [name])
+        segment = self.get_segments()[-1]
+        if (Search.exists(active.file_system) == True):
+            segment.rebuild_search()
+        segments.append(segment)
+        return segment
+
+
+    # Loads the image of every segment and returns the image of
+    # the active segment, which holds every dir
+    def get_image(self):
+        with self.reading():
+            segments = self.get_segments()
+            for segment in segments:
+                segment.get_image()
+            return segments[-1].get_image()
+
+
+    # Parses every segment from scratch and saves its index
+    def reindex(self):
+        with self.reading():
+            for segment in self.get_segments():
+                segment.reindex()
+
+
+    # Returns the live record of a file/dir or None. A file is looked
+    # up from the active segment back to the oldest one
+    def lookup(self, key):
+        with self.reading():
+            segments = self.get_segments()
+            if (key[0] == "="):
+                return segments[-1].lookup(key)
+            for segment in reversed(segments):
+                record = segment.lookup(key)
+                if (record != None):
+                    return record
+        return None
+
+
+    def check_path(self, path):
+        with self.reading():
+            self.get_segments()[-1].check_path(path)
+
+
+    def isfile(self, path):
+        return (self.lookup("@" + path) != None)
+
+
+    def isdir(self, path):
+        with self.reading():
+            return self.get_segments()[-1].isdir(path)
+
+
+    def open(self, path, mode = "r", encoding = "utf-8"):
+        with self.reading():
+            segments = self.get_segments()
+            return self.get_holder(segments, path).open(path, mode, encoding)
+
+
+    def listdir(self, path = ""):
+        names = set()
+        with self.reading():
+            segments = self.get_segments()
+            self.check_directory(segments, path)
+            for segment in segments:
+                names.update(segment.listdir(path))
+        return sorted(names)
+
+
+    def stat(self, path):
+        with self.reading():
+            segments = self.get_segments()
+            return self.get_holder(segments, path).stat(path)
+
+
+    # Returns the stat of every file and dir under a dir ("" for the
+    # whole FS): the dirs of the active segment and the newest copy
+    # of every file
+    def entries(self, path = ""):
+        directories = []
+        files = {}
+        with self.reading():
+            segments = self.get_segments()
+            self.check_directory(segments, path)
+            for segment in segments:
+                for entry in segment.entries(path):
+                    if (entry.is_dir() == False):
+                        files[entry.name] = entry
+                    elif (segment == segments[-1]):
+                        directories.append(entry)
+        return directories + list(files.values())
+
+
+    def copyin(self, external_file, path, compression = None, dedup = None):
+        Library.check_path(path)
+        Library.check_external_file(external_file)
+        self.append_files([], [[external_file, path]], compression, dedup, None)
+
+
+    def copyin_many(self, pairs, compression = None, dedup = None, workers = None):
+        for external_file, path in pairs:
+            Library.check_path(path)
+            Library.check_external_file(external_file)
+        self.append_files([], pairs, compression, dedup, workers)
+
+
+    def copyin_tree(self, external_directory, path, compression = None,
+                    dedup = None, workers = None):
+        Library.check_path(path)
+        directories, pairs = Library.walk_directory(external_directory, path)
+        for name in directories + [pair[1] for pair in pairs]:
+            Library.check_path(name)
+        self.append_files(directories, pairs, compression, dedup, workers)
+
+
+    # Adds the dirs that do not exist yet to every segment, then appends
+    # the EFs of [EF, IF] pairs to the active segment, starting a new
+    # segment whenever the active one is full, and deletes the IFs that
+    # were replaced from the older segments that held them
+    def append_files(self, directories, pairs, compression, dedup, workers):
+        if (compression == None):
+            compression = Compression.compression_from_environment()
+        Library.check_compression(compression)
+        with self.writing():
+            segments = self.get_segments()
+            active = segments[-1]
+            # Checking every dir above the paths before anything is written
+            with active.reading():
+                image = active.get_image()
+                checked = set(directories)
+                for name in directories + [pair[1] for pair in pairs]:
+                    parent = name.rpartition("/")[0]
+                    if (parent != "" and parent not in checked):
+                        if (image.has_parents(name) == False):
+                            raise Library.InvalidPathError("Invalid Path To Internal File")
+                        checked.add(parent)
+            if (len(directories) != 0):
+                for segment in segments:
+                    add_directories(segment, directories)
+
+            written = {}
+            room = self.segment_size - os.path.getsize(active.file_system)
+            for i, batch in enumerate(split_pairs(pairs, room, self.segment_size)):
+                if (i > 0):
+                    active = self.add_segment(segments)
+                if (len(batch) != 0):
+                    active.append_files([], batch, compression, dedup, workers)
+                for pair in batch:
+                    written[pair[1]] = active
+            self.remove_replaced(segments, written)
+
+
+    # Deletes the IFs written to a segment from the other segments,
+    # as a single change for every segment holding some of them
+    def remove_replaced(self, segments, written):
+        if (len(written) == 0):
+            return
+        for segment in segments:
+            with segment.reading():
+                image = segment.get_image()
+                paths = [path for path, holder in written.items()
+                         if (holder != segment and image.get_file(path) != None)]
+            if (len(paths) != 0):
+                with segment.transaction():
+                    for path in paths:
+                        segment.remove(path)
+
+
+    def copyout(self, path, external_file):
+        with self.reading():
+            segments = self.get_segments()
+            self.get_holder(segments, path).copyout(path, external_file)
+
+
+    # Copies an ID and everything under it to a host dir, from the
+    # oldest segment to the active one so that the newest copy of
+    # every IF is the one left
+    def copyout_tree(self, path, external_directory, workers = None):
+        with self.reading():
+            for segment in self.get_segments():
+                segment.copyout_tree(path, external_directory, workers)
+
+
+    # Creates an empty ID in every segment, the active one last
+    def mkdir(self, path):
+        Library.check_path(path)
+        with self.writing():
+            segments = self.get_segments()
+            if (segments[-1].isdir(path) == True):
+                raise Library.ExistsError("Internal Directory Already Exists")
+            for segment in segments[:-1]:
+                add_directories(segment, [path])
+            segments[-1].mkdir(path)
+
+
+    # Deletes an IF from the segments holding it, without
+    # changing the other segments
+    def remove(self, path):
+        with self.writing():
+            holders = [segment for segment in self.get_segments()
+                       if (segment.isfile(path) == True)]
+            if (len(holders) == 0):
+                raise Library.NotFoundError("Internal File Does Not Exist")
+            for segment in holders:
+                segment.remove(path)
+
+
+    # Deletes an ID and everything under it from every segment,
+    # the active one last
+    def rmtree(self, path):
+        Library.check_path(path)
+        with self.writing():
+            segments = self.get_segments()
+            if (segments[-1].isdir(path) == False):
+                raise Library.NotFoundError("Internal Directory Does Not Exist")
+            for segment in segments:
+                if (segment.isdir(path) == True):
+                    segment.rmtree(path)
+
+
+    # Defragments the segments one at a time, so that a defrag never
+    # rewrites more than a segment at once, and deletes the segments
+    # left with no file except the active one. Returns the number of
+    # records and bytes that were reclaimed
+    def defrag(self):
+        reclaimed = [0, 0]
+        with self.locked([Lock.WRITER_LOCK, True]):
+            with self.reading():
+                segments = self.get_segments()
+            empty = []
+            for segment in segments:
+                result = segment.defrag()
+                reclaimed = [reclaimed[0] + result[0], reclaimed[1] + result[1]]
+                with segment.reading():
+                    records = segment.get_image().records.values()
+                    if (segment != segments[-1]
+                        and all(record.key[0] == "=" for record in records
+                                if (record.live == True))):
+                        empty.append(segment)
+            if (len(empty) != 0):
+                names = [os.path.basename(segment.file_system) for segment in segments
+                         if (segment not in empty)]
+                with self.locked([Lock.DATA_LOCK, True]):
+                    write_manifest(self.file_system, self.segment_size, names)
+                    with self.opening:
+                        for segment in empty:
+                            self.opened.pop(os.path.basename(segment.file_system))
+                            delete_segment(segment)
+        return reclaimed
+
+
+    # Merges the segments back into a single FS in the text ("V1.0")
+    # or binary ("V2.0") format, which replaces the manifest
+    def convert(self, version):
+        if (version == VERSION):
+            return
+        if (version not in ["V1.0", "V2.0"]):
+            raise Library.FileSystemError("Unknown File System Version")
+        with self.locked([Lock.WRITER_LOCK, True]):
+            with self.reading():
+                segments = self.get_segments()
+                entries = merge_entries([segment.get_image() for segment in segments])
+            searched = any(Search.exists(segment.file_system) for segment in segments)
+            if (version == "V2.0"):
+                write = lambda target: Binary.write_binary(target, entries)
+            else:
+                write = lambda target: Binary.write_text(target, entries)
+            Binary.rewrite(self.file_system, write,
+                           lambda: self.locked([Lock.DATA_LOCK, True]))
+            with self.opening:
+                for segment in segments:
+                    delete_segment(segment)
+                self.opened = {}
+        if (searched == True):
+            with Library.VSFS(self.file_system, self.lock_timeout) as vsfs:
+                vsfs.rebuild_search()
+
+
+    # Builds the search index of every segment
+    def rebuild_search(self):
+        with self.reading():
+            for segment in self.get_segments():
+                segment.rebuild_search()
+
+
+    # Returns the sorted paths of the IFs whose newest copy contains
+    # a string, searching every segment
+    def search(self, pattern):
+        found = []
+        with self.reading():
+            segments = self.get_segments()
+            for i, segment in enumerate(segments):
+                for path in segment.search(pattern):
+                    if (all(newer.isfile(path) == False for newer in segments[i + 1:])):
+                        found.append(path)
+        return sorted(found)
+
+
+    # Changes spanning several segments cannot be applied at once
+    def transaction(self):
+        raise Library.FileSystemError("Batches Are Not Supported By Segmented File Systems")
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+import io
+import os
+import json
+import errno
+import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import Client
+import Commands
+import Segments
+
+_OPERATION = 1
+_FILESYSTEM = 2
+# List of operations that only read the FS and can run at the same time
+_READ_OPERATIONS = ["list", "copyout", "search"]
+# Number of commands that can run at the same time
+_WORKERS = 8
+
+get_socket_path = Client.get_socket_path
+
+
+# Raised to discard the transaction of a group of write commands
+class GroupFailed(Exception):
+    pass
+
+
+# Lets many readers or a single writer hold it, giving
+# waiting writers priority so that they are not starved
+class ReadWriteLock:
+
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+        self.condition = asyncio.Condition()
+
+
+    async def acquire_read(self):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.writing == False and self.waiting_writers == 0)
+            self.readers = self.readers + 1
+
+
+    async def release_read(self):
+        async with self.condition:
+            self.readers = self.readers - 1
+            self.condition.notify_all()
+
+
+    async def acquire_write(self):
+        async with self.condition:
+            self.waiting_writers = self.waiting_writers + 1
+            await self.condition.wait_for(
+                lambda: self.writing == False and self.readers == 0)
+            self.waiting_writers = self.waiting_writers - 1
+            self.writing = True
+
+
+    async def release_write(self):
+        async with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+
+class VSFSServer:
+
+    def __init__(self, file_system, socket_path, commands):
+        self.file_system = file_system
+        self.socket_path = socket_path
+        # The commands of every client share the opened FS
+        self.commands = commands
+        self.executor = ThreadPoolExecutor(_WORKERS)
+        self.lock = None
+        self.stopped = None
+        self.loop = None
+        # Write commands waiting to be committed together, as
+        # [command, future], and whether they are being committed
+        self.writes = []
+        self.committing = False
+
+
+    # Checks if a command is for the FS of the server
+    def is_served(self, command):
+        try:
+            return os.path.samefile(command[_FILESYSTEM], self.file_system)
+        except OSError:
+            return False
+
+
+    # Runs a command with its own output and error streams
+    # and returns them with its exit code. The changes of write
+    # commands are durable once they return
+    def run_command(self, command):
+        object = Commands.VSFSCommands()
+        object.file_systems = self.commands.file_systems
+        object.stdout = io.StringIO()
+        object.stderr = io.StringIO()
+        code = 0
+        try:
+            if (object.check_command(command, len(command)) == True):
+                object.execute(command)
+        except SystemExit as e:
+            code = e.code
+        except Exception as e:
+            # Keeping the server running, but parsing the FS again
+            # since the image may not match the FS anymore
+            self.commands.file_systems.pop(command[_FILESYSTEM], None)
+            object.print_stderr("Invalid VSFS: " + str(e))
+            code = 1
+        return {
+            "code": code,
+            "stdout": object.stdout.getvalue(),
+            "stderr": object.stderr.getvalue()
+        }
+
+
+    # Runs write commands one after the other as a single transaction,
+    # so that their changes are committed with a single fsync of the
+    # journal. If any of them fails, the transaction is discarded and
+    # they are run again one at a time, which gives the same results
+    def run_group(self, commands):
+        vsfs = self.commands.file_systems.get(commands[0][_FILESYSTEM])
+        # The changes of a segmented FS cannot be applied at once
+        if (len(commands) > 1 and vsfs != None
+            and isinstance(vsfs, Segments.SegmentedVSFS) == False):
+            try:
+                with vsfs.transaction():
+                    results = [self.run_command(command) for command in commands]
+                    if (any(result["code"] != 0 for result in results)):
+                        raise GroupFailed()
+                return results
+            except GroupFailed:
+                pass
+        return [self.run_command(command) for command in commands]
+
+
+    # Runs a command in a worker thread, letting commands that only
+    # read the FS run at the same time and every other command alone
+    async def schedule(self, command):
+        if (command[_OPERATION] not in _READ_OPERATIONS):
+            return await self.schedule_write(command)
+        await self.lock.acquire_read()
+        try:
+            return await self.loop.run_in_executor(self.executor,
+                                                   self.run_command, command)
+        finally:
+            await self.lock.release_read()
+
+
+    # Queues a write command and commits the queued commands as groups
+    # until none is left, unless another client already does
+    async def schedule_write(self, command):
+        future = self.loop.create_future()
+        self.writes.append([command, future])
+        if (self.committing == False):
+            self.committing = True
+            try:
+                while (len(self.writes) != 0):
+                    group = self.next_group()
+                    await self.lock.acquire_write()
+                    try:
+                        results = await self.loop.run_in_executor(
+                            self.executor, self.run_group,
+                            [entry[0] for entry in group])
+                    except Exception as e:
+                        results = [{"code": 1, "stdout": "",
+                                    "stderr": "Invalid VSFS: " + str(e) + "\n"}] * len(group)
+                    finally:
+                        await self.lock.release_write()
+                    for entry, result in zip(group, results):
+                        entry[1].set_result(result)
+            finally:
+                self.committing = False
+        return await future
+
+
+    # Takes the queued write commands that can be committed together,
+    # which excludes the commands that cannot be part of a batch
+    def next_group(self):
+        count = 0
+        for command, future in self.writes:
+            if (command[_OPERATION] not in Commands._BATCH_OPERATIONS
+                or command[_FILESYSTEM] != self.writes[0][0][_FILESYSTEM]
+            ):
+                break
+            count = count + 1
+        group = self.writes[:max(count, 1)]
+        del self.writes[:len(group)]
+        return group
+
+
+    # Answers the requests of a client, one JSON line each
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if (line == b""):
+                    break
+                request = json.loads(line)
+                command = [str(word) for word in request["command"]]
+                if (len(command) < 3
+                    or command[_OPERATION] not in Client._REMOTE_OPERATIONS
+                    or self.is_served(command) == False
+                ):
+                    response = {"served": False}
+                else:
+                    response = await self.schedule(command)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ValueError, KeyError, TypeError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    # Serves the FS until stopped
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.lock = ReadWriteLock()
+        self.stopped = asyncio.Event()
+        # Loading the image of the FS once before accepting clients
+        self.commands.get_image(self.file_system)
+        remove_stale_socket(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle,
+                                                 path = self.socket_path)
+        if (threading.current_thread() == threading.main_thread()):
+            for number in [signal.SIGINT, signal.SIGTERM]:
+                self.loop.add_signal_handler(number, self.stopped.set)
+        print("Serving VSFS: " + self.file_system + " On " + self.socket_path,
+              file = self.commands.stdout, flush = True)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.executor.shutdown()
+
+
+    # Stops the server from another thread
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+# Removes the socket left by a server that is not running anymore
+def remove_stale_socket(socket_path):
+    if (os.path.exists(socket_path) == False):
+        return
+    connection = Client.connect(socket_path)
+    if (connection != None):
+        connection.close()
+        raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+    os.unlink(socket_path)
+
+
+# Serves a FS on a unix socket until interrupted
+def serve(file_system, socket_path, commands):
+    asyncio.run(VSFSServer(file_system, socket_path, commands).run())
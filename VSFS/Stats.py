@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+
+# Environment variable that reports the stats of every command on
+# stderr when set to "1", or appends them to the file it names
+_STATS_VARIABLE = "VSFS_STATS"
+# Environment variable with the file a profile of every command
+# is saved to, which can be read with the pstats module
+_PROFILE_VARIABLE = "VSFS_PROFILE"
+_STATS_FLAG = "--stats"
+
+# Stats of the command being run, None unless they are reported
+_current = None
+
+
+# Time, I/O and memory used by a command, split into phases. The
+# time of a phase includes the time of the phases run inside it
+class CommandStats:
+
+    def __init__(self, command):
+        self.command = command
+        self.start = time.perf_counter()
+        # Seconds and number of runs of every phase, by name
+        self.phases = {}
+        # Number of times the whole FS was read (parsed, copied or
+        # scanned block by block) and written (rewritten to a new FS),
+        # and of file/dir records parsed or looked up
+        self.counters = {"full_reads": 0, "full_writes": 0, "records_scanned": 0}
+        self.io_start = read_process_io()
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase["seconds"] = phase["seconds"] + seconds
+            phase["calls"] = phase["calls"] + 1
+
+
+    def count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+
+    # Returns the stats as a dict that can be saved as JSON
+    def report(self):
+        report = {"command": self.command,
+                  "seconds": time.perf_counter() - self.start,
+                  "phases": self.phases}
+        report.update(self.counters)
+        io_end = read_process_io()
+        for name, field in [["bytes_read", "rchar"], ["bytes_written", "wchar"]]:
+            if (field in self.io_start and field in io_end):
+                report[name] = io_end[field] - self.io_start[field]
+            else:
+                report[name] = None
+        # Kilobytes on Linux
+        report["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+
+
+# Returns the I/O counters of this process, which are empty
+# where the system does not provide them
+def read_process_io():
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+# Removes the stats flag from the arguments of a command and returns
+# True if it was there or if the environment asks for the stats
+def parse_flag(arguments):
+    enabled = (os.environ.get(_STATS_VARIABLE, "") != "")
+    while (_STATS_FLAG in arguments):
+        arguments.remove(_STATS_FLAG)
+        enabled = True
+    return enabled
+
+
+# Starts collecting the stats of a command
+def start(command):
+    global _current
+    _current = CommandStats(list(command))
+
+
+# Times a phase of the command if its stats are collected
+def phase(name):
+    if (_current == None):
+        return contextlib.nullcontext()
+    return _current.phase(name)
+
+
+# Adds to a counter of the command if its stats are collected
+def count(name, amount = 1):
+    if (_current != None):
+        _current.count(name, amount)
+
+
+# Stops collecting the stats of the command and reports them on
+# stderr, or appends them to the file named by VSFS_STATS
+def finish():
+    global _current
+    if (_current == None):
+        return
+    report = _current.report()
+    _current = None
+    target = os.environ.get(_STATS_VARIABLE, "")
+    if (target == "" or target == "1"):
+        print("VSFS Stats: " + json.dumps(report), file = sys.stderr)
+        return
+    try:
+        with open(target, "a") as f:
+            f.write(json.dumps(report) + "\n")
+    except OSError as e:
+        print("Invalid VSFS: Cannot Write Stats To " + target
+              + " (" + e.strerror + ")", file = sys.stderr)
+
+
+# Runs a function under cProfile if VSFS_PROFILE names a file,
+# saving the profile there once it returns or exits
+def run_profiled(function):
+    path = os.environ.get(_PROFILE_VARIABLE, "")
+    if (path == ""):
+        return function()
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return function()
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
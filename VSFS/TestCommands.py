@@ -1,9 +1,50 @@
 #!/usr/bin/python3
+import io
+import json
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import contextlib
+import threading
 import unittest
 import Commands
+import Notes
+import Library
+import Journal
+import Binary
+import Client
+import Server
+import Benchmark
+import Stats
+import Search
+import Segments
+import Lock
+
+# Dir of the modules, which the fixtures in its "tests" dir are copied from
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
 class TestCommands(unittest.TestCase):
 
+    # Running every test on a copy of the fixtures, so that the tests
+    # can change them and leave nothing next to them
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous = os.getcwd()
+        shutil.copytree(os.path.join(_DIRECTORY, "tests"),
+                        os.path.join(self.directory.name, "tests"),
+                        ignore = shutil.ignore_patterns("*.idx", "*.lock", "*.journal",
+                                                        "*.search", "*.compact"))
+        os.chdir(self.directory.name)
+
+
+    def tearDown(self):
+        os.chdir(self.previous)
+        self.directory.cleanup()
+
+
     def test_check_operation(self):
         object = Commands.VSFSCommands()
         message = "TEST FAILED"
@@ -20,7 +61,8 @@ class TestCommands(unittest.TestCase):
         object = Commands.VSFSCommands()
         message = "TEST FAILED"
         # Testing a correct FS
-        self.assertTrue(object.check_file_system("VSFS.notes"), message)
+        self.assertTrue(object.check_file_system(os.path.join(_DIRECTORY, "VSFS.notes")),
+                        message)
         with self.assertRaises(SystemExit) as cm:
             # Testing an FS which does not exist
             # and checking if it exits with exit(1)
@@ -145,18 +187,25 @@ class TestCommands(unittest.TestCase):
             result = f.readlines()
 
         # Gathering contents of expected FS in an array
-        with open("tests/copyin_test.notes", "r") as f:
+        with open("tests/copyin_expected.notes", "r") as f:
             expected = f.readlines()
 
         self.assertEqual(result, expected)
 
+        # The replaced file must be deleted in place without
+        # moving the records before it
+        image = Notes.load_image("tests/copyin_test.notes")
+        record = image.get_file("dir1/note2")
+        self.assertEqual(record.line, 8)
+        self.assertEqual(image.lookup("@note1").offset, 18)
+
     
     def test_do_copyout(self):
 
         object = Commands.VSFSCommands()
 
         # Trying to copy out a file
-        object.do_copyout("tests/copyin_test.notes", "dir1/note2", "tests/copyout_result")
+        object.do_copyout("tests/copyin_expected.notes", "dir1/note2", "tests/copyout_result")
 
         # Gathering contents of FS in an array
         with open("tests/copyout_result", "r") as f:
@@ -168,9 +217,15 @@ class TestCommands(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+        # Copying out again must replace the contents of EF
+        object.do_copyout("tests/copyin_expected.notes", "dir1/note2", "tests/copyout_result")
+        with open("tests/copyout_result", "r") as f:
+            result = f.readlines()
+        self.assertEqual(result, expected)
+
         # Testing a wrong IF
         with self.assertRaises(SystemExit) as cm:
-            object.do_copyout("tests/copyin_test.notes", "dummy", "tests/copyout_result")
+            object.do_copyout("tests/copyin_expected.notes", "dummy", "tests/copyout_result")
         self.assertEqual(cm.exception.code, 1)
 
 
@@ -232,9 +287,83 @@ class TestCommands(unittest.TestCase):
         self.assertEqual(result, expected)
 
 
+    def test_do_rmdir_prefix(self):
+        object = Commands.VSFSCommands()
+        # Only whole path components must match, so "dir10/" and
+        # "dir1note" must not be deleted with "dir1/"
+        object.do_rmdir("tests/rmdir_prefix_test.notes", "dir1")
+
+        # Gathering contents of FS in an array
+        with open("tests/rmdir_prefix_test.notes", "r") as f:
+            result = f.readlines()
+
+        # Gathering contents of expected FS in an array
+        with open("tests/rmdir_prefix_expected.notes", "r") as f:
+            expected = f.readlines()
+
+        self.assertEqual(result, expected)
+
+
+    def test_do_batch(self):
+        object = Commands.VSFSCommands()
+        with open("tests/batch_test.notes", "r") as f:
+            original = f.readlines()
+
+        # Testing a script that fails on its second line, which
+        # must leave the FS unchanged
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as cm:
+                object.do_batch("tests/batch_test.notes", "tests/batch_fail_script")
+        self.assertEqual(cm.exception.code, 1)
+        self.assertIn("Invalid VSFS: Batch Failed At Line 2", stderr.getvalue())
+        with open("tests/batch_test.notes", "r") as f:
+            result = f.readlines()
+        self.assertEqual(result, original)
+
+        object.do_batch("tests/batch_test.notes", "tests/batch_script")
+
+        # Gathering contents of FS in an array
+        with open("tests/batch_test.notes", "r") as f:
+            result = f.readlines()
+
+        # Gathering contents of expected FS in an array
+        with open("tests/batch_expected.notes", "r") as f:
+            expected = f.readlines()
+
+        self.assertEqual(result, expected)
+
+
+    def test_compaction(self):
+        object = Commands.VSFSCommands()
+        image = object.get_image("tests/compact_test.notes")
+        # Compacting once 50 bytes are deleted, but only the tail
+        # in which at least 60% of the bytes are deleted
+        image.policy = Notes.CompactionPolicy(0.6, 50, 0)
+        object.do_rm("tests/compact_test.notes", "dir1/note2")
+
+        # Gathering contents of FS in an array
+        with open("tests/compact_test.notes", "r") as f:
+            result = f.readlines()
+
+        # Gathering contents of expected FS in an array
+        with open("tests/compact_expected.notes", "r") as f:
+            expected = f.readlines()
+
+        self.assertEqual(result, expected)
+        # The records kept in memory must match a fresh parse of the FS
+        parsed = Notes.NotesImage("tests/compact_test.notes")
+        parsed.rebuild()
+        self.assertEqual(image.index.records, parsed.index.records)
+        self.assertEqual(image.index.dead_runs, parsed.index.dead_runs)
+        self.assertEqual(image.index.lines, parsed.index.lines)
+        self.assertFalse(os.path.exists("tests/compact_test.notes.compact"))
+
+
     def test_do_defrag(self):
         object = Commands.VSFSCommands()
-        object.do_defrag("tests/defrag_test.notes")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            object.do_defrag("tests/defrag_test.notes")
 
         # Gathering contents of FS in an array
         with open("tests/defrag_test.notes", "r") as f:
@@ -245,6 +374,154 @@ class TestCommands(unittest.TestCase):
             expected = f.readlines()
 
         self.assertEqual(result, expected)
+        # Checking the reclaimed space was reported and that
+        # no temporary file was left behind
+        self.assertTrue("Reclaimed 5 Records" in output.getvalue())
+        for name in os.listdir("tests"):
+            self.assertFalse(name.endswith(".defrag"))
+
+
+    def test_do_index(self):
+        object = Commands.VSFSCommands()
+        object.do_index("tests/valid.notes")
+
+        # The saved index must be fresh and point at the exact records
+        image = Notes.NotesImage("tests/valid.notes")
+        self.assertTrue(image.index.load())
+        image.load()
+        record = image.lookup("@dir1/dir2/note1")
+        self.assertEqual(record.line, 6)
+        with open("tests/valid.notes", "rb") as f:
+            contents = f.read()
+        self.assertEqual(contents[record.offset:record.header_end], b"@dir1/dir2/note1\n")
+        self.assertEqual(contents[record.header_end:record.content_end], b" This is a note.")
+
+        # Deleted records are not live and are counted as dead lines
+        image = Notes.load_image("tests/rmdir_expected.notes")
+        self.assertEqual(image.lookup("@dir1/note1"), None)
+        self.assertNotEqual(image.lookup("=dir2/"), None)
+        self.assertEqual(image.lookup("@dummy"), None)
+        self.assertEqual(image.index.dead_records, 6)
+
+
+    def test_notes_image(self):
+        image = Notes.load_image("tests/valid.notes")
+        # Checking the dir tree built from the records
+        self.assertEqual(list(image.root.dirs.keys()), ["dir1"])
+        self.assertEqual(list(image.root.files.keys()), ["note1"])
+        directory = image.get_directory("dir1/dir2")
+        self.assertEqual(directory.record.key, "=dir1/dir2/")
+        self.assertEqual(list(directory.files.keys()), ["note1"])
+        self.assertEqual(image.get_directory("dir1/note1"), None)
+        # Checking the dirs above a path
+        self.assertTrue(image.has_parents("dir1/dir2/note2"))
+        self.assertTrue(image.has_parents("note2"))
+        self.assertFalse(image.has_parents("dir1/dir/note2"))
+        self.assertFalse(image.has_parents("dir1/note1/note2"))
+        # Checking the records of a subtree
+        keys = [record.key for record in image.get_subtree(image.get_directory("dir1"))]
+        self.assertEqual(sorted(keys), ["=dir1/", "=dir1/dir2/", "@dir1/dir2/note1"])
+
+
+    def test_index_changes(self):
+        Library.VSFS("tests/valid.notes").reindex()
+        with open("tests/valid.notes.idx", "r") as f:
+            records = f.readline()
+        for change in ["mkdir", "copyin", "rm", "rm", "rmtree"]:
+            with Library.VSFS("tests/valid.notes") as vsfs:
+                if (change == "mkdir"):
+                    vsfs.mkdir("dir3")
+                elif (change == "copyin"):
+                    vsfs.copyin("tests/valid_ef", "dir3/note1")
+                elif (change == "rm"):
+                    vsfs.remove(["dir3/note1", "note1"][vsfs.isfile("note1")])
+                    # Deleting a file does not load the image
+                    self.assertEqual(vsfs.image, None)
+                else:
+                    vsfs.rmtree("dir1")
+
+            # Only appending the change to the index, which then
+            # gives the records of a fresh parse
+            with open("tests/valid.notes.idx", "r") as f:
+                self.assertEqual(f.readline(), records)
+            image = Notes.NotesImage("tests/valid.notes")
+            self.assertTrue(image.index.load())
+            parsed = Notes.NotesImage("tests/valid.notes")
+            with open("tests/valid.notes", "rb") as f:
+                parsed.parse(f)
+            self.assertEqual(image.index.records, parsed.index.records)
+            self.assertEqual(image.index.dead_runs, parsed.index.dead_runs)
+            self.assertEqual(image.index.dead_records, parsed.index.dead_records)
+            self.assertEqual(image.index.dead_bytes, parsed.index.dead_bytes)
+            self.assertEqual(image.index.lines, parsed.index.lines)
+
+        # The index is stale once a change is missing from it
+        with open("tests/valid.notes", "ab") as f:
+            f.write(b"\n=dir4/")
+        self.assertFalse(Notes.NotesImage("tests/valid.notes").index.load())
+        self.assertEqual(Library.VSFS("tests/valid.notes").listdir(), ["dir3", "dir4"])
+
+
+    def test_record_scanner(self):
+        for file_system in ["tests/valid.notes", "tests/rm_expected.notes",
+                            "tests/defrag_test.notes", "tests/compact_test.notes"]:
+            # Parsing the mapped FS must match parsing it line by line
+            image = Notes.NotesImage(file_system)
+            image.rebuild()
+            streamed = Notes.NotesImage(file_system)
+            with open(file_system, "rb") as f:
+                streamed.parse(f)
+            self.assertEqual(image.index.records, streamed.index.records)
+            self.assertEqual(image.index.dead_runs, streamed.index.dead_runs)
+            self.assertEqual(image.index.lines, streamed.index.lines)
+
+            # Scanning for a record must find the record kept by parsing
+            scanner = Notes.RecordScanner(file_system)
+            for key in list(image.records.keys()) + ["@dummy"]:
+                record = image.lookup(key)
+                found = scanner.lookup(key)
+                if (record == None):
+                    self.assertEqual(found, None)
+                else:
+                    self.assertEqual(found.to_fields(), record.to_fields())
+            scanner.close()
+
+
+    def test_do_list(self):
+        object = Commands.VSFSCommands()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            object.do_list("tests/list_test.notes")
+        lines = output.getvalue().splitlines()
+
+        # Checking the names are sorted like ls
+        names = [line.split(" ")[-1] for line in lines]
+        self.assertEqual(names, ["AA", "ZZ", "a", "dir1/", "dir1/dir2/", "dir1/dir2/bla",
+            "dir1/dir2/dir3/", "dir1/dir2/dir3/dir4/", "dir1/dir2/dir4/", "dir1/dir3/", "z"])
+        # Checking the attributes and link counts of a dir and a file
+        self.assertTrue(lines[4].startswith("d"))
+        self.assertEqual(lines[4].split()[1], "2")
+        self.assertTrue(lines[0].startswith("-"))
+        self.assertEqual(lines[0].split()[1], "1")
+
+        # Listing only what is under a dir, and not under the dirs
+        # whose names start with the same characters
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            object.execute(["VSFS.py", "list", "tests/list_test.notes", "dir1/dir2"])
+        names = [line.split(" ")[-1] for line in output.getvalue().splitlines()]
+        self.assertEqual(names, ["dir1/dir2/bla", "dir1/dir2/dir3/",
+            "dir1/dir2/dir3/dir4/", "dir1/dir2/dir4/"])
+        self.assertTrue(object.check_arguments(["VSFS.py", "list",
+                                                "tests/list_test.notes", "dir1"], 4))
+        # Telling a missing dir from a path naming a file
+        for path, error in [["dir1/dir", "Internal Directory Does Not Exist"],
+                            ["dir1/dir2/bla", "Internal Path Is Not A Directory"]]:
+            object.stderr = io.StringIO()
+            with self.assertRaises(SystemExit) as cm:
+                object.execute(["VSFS.py", "list", "tests/list_test.notes", path])
+            self.assertEqual(cm.exception.code, 1)
+            self.assertEqual(object.stderr.getvalue(), "Invalid VSFS: " + error + "\n")
 
 
     def test_get_link_count(self):
@@ -253,5 +530,764 @@ class TestCommands(unittest.TestCase):
         self.assertEqual(result, 3)
 
 
+
+    def test_do_serve(self):
+        object = Commands.VSFSCommands()
+        server = Server.VSFSServer("tests/serve_test.notes",
+                                   "tests/serve_test.notes.sock", object)
+        thread = threading.Thread(target = lambda: Server.asyncio.run(server.run()))
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread.start()
+            # Waiting for the server to listen
+            while (os.path.exists("tests/serve_test.notes.sock") == False):
+                time.sleep(0.01)
+
+        try:
+            # Running the commands of a client on the server
+            for command in [["mkdir", "dir3"],
+                            ["copyin", "tests/valid_ef", "dir3/note2"],
+                            ["rm", "note1"]]:
+                code = Client.run(["VSFS.py", command[0], "tests/serve_test.notes"]
+                                  + command[1:])
+                self.assertEqual(code, 0)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                code = Client.run(["VSFS.py", "list", "tests/serve_test.notes"])
+            self.assertEqual(code, 0)
+            self.assertEqual(len(stdout.getvalue().splitlines()), 4)
+
+            # Testing a wrong IF
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                code = Client.run(["VSFS.py", "rm", "tests/serve_test.notes", "note1"])
+            self.assertEqual(code, 1)
+            self.assertIn("Internal File Does Not Exist", stderr.getvalue())
+
+            # Commands for another FS must be run locally
+            code = Client.run(["VSFS.py", "list", "tests/list_test.notes"])
+            self.assertEqual(code, None)
+        finally:
+            server.stop()
+            thread.join()
+
+        self.assertFalse(os.path.exists("tests/serve_test.notes.sock"))
+
+        # Committing write commands of many clients together, or one
+        # at a time if any of them fails
+        for group in [[["mkdir", "dir4"], ["copyin", "tests/valid_ef", "dir4/note3"]],
+                      [["mkdir", "dir5"], ["rm", "note1"], ["rmdir", "dir4"]]]:
+            results = server.run_group([["VSFS.py", command[0], "tests/serve_test.notes"]
+                                        + command[1:] for command in group])
+            codes = [result["code"] for result in results]
+            self.assertEqual(codes, [0] * len(group) if (len(group) == 2) else [0, 1, 0])
+
+        # Gathering contents of FS in an array
+        with open("tests/serve_test.notes", "r") as f:
+            result = f.readlines()
+
+        # Gathering contents of expected FS in an array
+        with open("tests/serve_expected.notes", "r") as f:
+            expected = f.readlines()
+
+        self.assertEqual(result, expected)
+
+
+    def test_library(self):
+        vsfs = Library.VSFS("tests/library_test.notes")
+        self.assertEqual(vsfs.listdir(), ["dir1", "note1"])
+        self.assertEqual(vsfs.listdir("dir1"), ["dir2"])
+        self.assertTrue(vsfs.stat("dir1").is_dir())
+        self.assertEqual(vsfs.stat("dir1").st_nlink, 1)
+        self.assertEqual(vsfs.stat("dir1/dir2/note1").st_size, 15)
+
+        # Reading an IF through a seekable file-like object
+        with vsfs.open("note1") as f:
+            self.assertEqual(f.readline(), "Bob: “Looks like you’ve been missing a lot of work lately.”\n")
+            self.assertEqual(f.read(), "Peter: “I wouldn’t say I’ve been missing it, Bob.”")
+        with vsfs.open("dir1/dir2/note1", "rb") as f:
+            f.seek(-5, io.SEEK_END)
+            self.assertEqual(f.read(), b"note.")
+            f.seek(5)
+            self.assertEqual(f.read(2), b"is")
+
+        vsfs.mkdir("dir3")
+        vsfs.remove("note1")
+        vsfs.rmtree("dir1")
+        self.assertEqual(vsfs.listdir(), ["dir3"])
+
+        # Errors are raised instead of exiting
+        with self.assertRaises(Library.NotFoundError):
+            vsfs.open("note1")
+        with self.assertRaises(FileNotFoundError):
+            vsfs.rmtree("dir1")
+        with self.assertRaises(Library.ExistsError) as cm:
+            vsfs.mkdir("dir3")
+        self.assertEqual(str(cm.exception), "Internal Directory Already Exists")
+        with self.assertRaises(Library.InvalidPathError):
+            vsfs.copyin("tests/valid_ef", "dir1/note2")
+        with self.assertRaises(Library.FileSystemError):
+            Library.VSFS("tests/invalid.notes")
+
+
+    def test_locks(self):
+        # Holding the writer lock, or both locks, in another process
+        script = ("import sys, Lock\n"
+                  "lock = Lock.NotesLock(sys.argv[1], None)\n"
+                  "lock.acquire(Lock.WRITER_LOCK, True)\n"
+                  "if (sys.argv[2] == 'data'):\n"
+                  "    lock.acquire(Lock.DATA_LOCK, True)\n"
+                  "print('locked', flush = True)\n"
+                  "sys.stdin.readline()\n")
+        for locks in ["writer", "data"]:
+            holder = subprocess.Popen([sys.executable, "-c", script,
+                                       "tests/valid.notes", locks],
+                                      env = dict(os.environ, PYTHONPATH = _DIRECTORY),
+                                      stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+            try:
+                self.assertEqual(holder.stdout.readline(), b"locked\n")
+                with Library.VSFS("tests/valid.notes", lock_timeout = 0.05) as vsfs:
+                    # Writers always wait for the other writer
+                    with self.assertRaises(Library.LockTimeoutError):
+                        vsfs.mkdir("dir3")
+                    # Readers only wait while the FS is changed in place
+                    if (locks == "writer"):
+                        self.assertEqual(vsfs.listdir(), ["dir1", "note1"])
+                    else:
+                        with self.assertRaises(Library.LockTimeoutError):
+                            vsfs.listdir()
+            finally:
+                holder.communicate(b"\n")
+
+        # Waiting as long as needed if the timeout is not a number
+        os.environ["VSFS_LOCK_TIMEOUT"] = "abc"
+        try:
+            self.assertEqual(Lock.timeout_from_environment(), None)
+            self.assertEqual(Library.VSFS("tests/valid.notes").listdir(), ["dir1", "note1"])
+        finally:
+            del os.environ["VSFS_LOCK_TIMEOUT"]
+
+        # Only taking shared locks if the lock file cannot be written,
+        # so that nothing changes the FS without holding it alone
+        vsfs = Library.VSFS("tests/valid.notes")
+        vsfs.lock.open()
+        vsfs.lock.close()
+        vsfs.lock.fd = os.open(vsfs.lock.path, os.O_RDONLY)
+        try:
+            with self.assertRaises(Lock.LockDenied):
+                vsfs.lock.acquire(Lock.WRITER_LOCK, True)
+            self.assertEqual(vsfs.listdir(), ["dir1", "note1"])
+            with self.assertRaises(Library.FileSystemError):
+                vsfs.mkdir("dir3")
+            self.assertEqual(vsfs.listdir(), ["dir1", "note1"])
+        finally:
+            vsfs.close()
+
+
+    def test_journal(self):
+        # Crashing once the change is in the journal
+        # but before the FS was changed
+        apply_entry = Journal.apply_entry
+        def crash(*arguments):
+            raise OSError("Crashed")
+        Journal.apply_entry = crash
+        try:
+            with self.assertRaises(OSError):
+                Library.VSFS("tests/journal_test.notes").copyin("tests/valid_ef", "note1")
+        finally:
+            Journal.apply_entry = apply_entry
+        with open("tests/journal_test.notes.journal", "rb") as f:
+            entry = f.read()
+
+        # Readers only replay the journal holding the FS alone, so they
+        # wait for another process sharing the data lock
+        script = ("import sys, Lock\n"
+                  "lock = Lock.NotesLock(sys.argv[1], None)\n"
+                  "lock.acquire(Lock.DATA_LOCK, False)\n"
+                  "print('locked', flush = True)\n"
+                  "sys.stdin.readline()\n")
+        holder = subprocess.Popen([sys.executable, "-c", script, "tests/journal_test.notes"],
+                                  env = dict(os.environ, PYTHONPATH = _DIRECTORY),
+                                  stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline(), b"locked\n")
+            with Library.VSFS("tests/journal_test.notes", lock_timeout = 0.05) as vsfs:
+                with self.assertRaises(Library.LockTimeoutError):
+                    vsfs.listdir()
+            with open("tests/journal_test.notes.journal", "rb") as f:
+                self.assertEqual(f.read(), entry)
+        finally:
+            holder.communicate(b"\n")
+
+        # Replaying the journal when the FS is opened again
+        self.assertEqual(Library.VSFS("tests/journal_test.notes").listdir(), ["dir1", "note1"])
+        with open("tests/journal_test.notes", "r") as f:
+            result = f.readlines()
+        with open("tests/journal_expected.notes", "r") as f:
+            expected = f.readlines()
+        self.assertEqual(result, expected)
+        self.assertEqual(os.path.getsize("tests/journal_test.notes.journal"), 0)
+
+        # Replaying the same entry again leaves the FS the same,
+        # while an entry that was not completely written is discarded
+        for data in [entry, entry[:-1]]:
+            with open("tests/journal_test.notes.journal", "wb") as f:
+                f.write(data)
+            self.assertEqual(Notes.recover("tests/journal_test.notes"), (data == entry))
+            with open("tests/journal_test.notes", "r") as f:
+                self.assertEqual(f.readlines(), expected)
+
+    def test_binary(self):
+        object = Commands.VSFSCommands()
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            object.do_convert("tests/binary_test.notes", "V2.0")
+        self.assertIn("To V2.0", stdout.getvalue())
+        self.assertTrue(Binary.is_binary("tests/binary_test.notes"))
+
+        # Using a binary FS like a text one
+        vsfs = Library.VSFS("tests/binary_test.notes")
+        self.assertEqual(vsfs.listdir(), ["dir1", "note1"])
+        self.assertEqual(vsfs.stat("dir1/dir2/note1").st_size, 15)
+        with vsfs.open("note1") as f:
+            f.seek(5)
+            self.assertEqual(f.readline(), "“Looks like you’ve been missing a lot of work lately.”\n")
+        vsfs.copyin("tests/valid_ef", "dir1/note2")
+        vsfs.remove("note1")
+        self.assertEqual(Library.VSFS("tests/binary_test.notes").listdir(), ["dir1"])
+
+        # Tearing the slot of the last change, which leaves the table
+        # before it, until the table is built again from the blocks
+        with open("tests/binary_test.notes", "r+b") as f:
+            slot = Binary.read_slot(f.read())
+            f.seek(Binary._SLOTS_OFFSET + slot[0] * Binary._SLOT.size)
+            f.write(b"\xff")
+        self.assertEqual(Library.VSFS("tests/binary_test.notes").listdir(), ["dir1", "note1"])
+        object = Commands.VSFSCommands()
+        object.do_index("tests/binary_test.notes")
+        self.assertEqual(Library.VSFS("tests/binary_test.notes").listdir(), ["dir1"])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            object.do_convert("tests/binary_test.notes", "V1.0")
+        with open("tests/binary_test.notes", "r") as f:
+            result = f.readlines()
+        with open("tests/binary_expected.notes", "r") as f:
+            expected = f.readlines()
+        self.assertEqual(result, expected)
+
+
+    def test_binary_deltas(self):
+        vsfs = Library.VSFS("tests/binary_test.notes")
+        vsfs.convert("V2.0")
+        vsfs = Library.VSFS("tests/binary_test.notes")
+        for number in range(16):
+            vsfs.mkdir("dir" + str(number + 2))
+        vsfs.remove("note1")
+
+        # The last changes only wrote delta tables
+        with open("tests/binary_test.notes", "rb") as f:
+            notes = f.read()
+        tables = Binary.read_chain(notes, Binary.read_slot(notes))
+        self.assertGreater(len(tables), 1)
+        self.assertLess(len(tables), 5)
+        self.assertEqual(notes[tables[-1][0]:tables[-1][0] + 1], Binary._DELTA)
+        image = Binary.load_image("tests/binary_test.notes")
+        self.assertNotIn("@note1", image.records)
+        self.assertIn("=dir17/", image.records)
+        self.assertEqual(image.dead_bytes, image.size - Binary._DATA_OFFSET
+                         - sum([table[1] for table in tables])
+                         - sum([record.content_end - record.offset
+                                for record in image.records.values()]))
+        scanner = Binary.TableScanner("tests/binary_test.notes")
+        self.assertEqual(scanner.lookup("@note1"), None)
+        self.assertEqual(scanner.lookup("=dir17/").offset, image.records["=dir17/"].offset)
+        self.assertEqual(scanner.lookup("@dir1/dir2/note1").length, 15)
+        scanner.close()
+
+        # The block deleted by the last change was marked before its
+        # slot, and the table before it still finds it
+        with open("tests/binary_test.notes", "r+b") as f:
+            slot = Binary.read_slot(f.read())
+            f.seek(Binary._SLOTS_OFFSET + slot[0] * Binary._SLOT.size)
+            f.write(b"\xff")
+        vsfs = Library.VSFS("tests/binary_test.notes")
+        self.assertIn("note1", vsfs.listdir())
+        with vsfs.open("note1") as f:
+            f.seek(5)
+            self.assertEqual(f.readline(), "“Looks like you’ve been missing a lot of work lately.”\n")
+        vsfs.defrag()
+        image = Binary.load_image("tests/binary_test.notes")
+        self.assertEqual(len(image.tables), 1)
+        self.assertEqual(image.dead_bytes, 0)
+
+
+    def test_convert_newlines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_system = os.path.join(directory, "newlines.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+            external_file = os.path.join(directory, "ef")
+            vsfs = Library.VSFS(file_system)
+            vsfs.convert("V2.0")
+            # Contents ending with new-line characters, which the binary
+            # format stores as they are
+            contents = [b"z\n", b"z\n\n\n", b"\n", b"\n\n", b" \n", b"z"]
+            for i, data in enumerate(contents):
+                with open(external_file, "wb") as f:
+                    f.write(data)
+                vsfs.copyin(external_file, "note" + str(i + 2))
+                vsfs.copyin(external_file, "zlib" + str(i + 2), "zlib")
+            for version in ["V1.0", "V2.0", "V1.0", "V1.0"]:
+                vsfs.convert(version)
+                for i, data in enumerate(contents):
+                    for name in ["note" + str(i + 2), "zlib" + str(i + 2)]:
+                        with vsfs.open(name, "rb") as f:
+                            self.assertEqual(f.read(), data)
+
+
+    def test_compression(self):
+        with open("tests/valid_ef", "rb") as f:
+            contents = f.read()
+        vsfs = Library.VSFS("tests/compression_test.notes")
+        vsfs.copyin("tests/valid_ef", "note2", "zlib")
+        vsfs.copyin("tests/valid_ef", "dir1/note3", "lzma")
+        with self.assertRaises(Library.CompressionError):
+            vsfs.copyin("tests/valid_ef", "note4", "gzip")
+
+        # Checking the compression is in the file record
+        with open("tests/compression_test.notes", "r") as f:
+            lines = f.readlines()
+        self.assertIn("@note2\tz=zlib;n=" + str(len(contents)) + "\n", lines)
+        image = Notes.load_image("tests/compression_test.notes")
+        scanner = Notes.RecordScanner("tests/compression_test.notes")
+        self.assertEqual(scanner.lookup("@dir1/note3").to_fields(),
+                         image.lookup("@dir1/note3").to_fields())
+        scanner.close()
+
+        # Reading the decompressed contents from both formats
+        for version in ["V1.0", "V2.0", "V1.0"]:
+            vsfs.convert(version)
+            for path in ["note2", "dir1/note3"]:
+                vsfs.copyout(path, "tests/copyout_result")
+                with open("tests/copyout_result", "rb") as f:
+                    self.assertEqual(f.read(), contents)
+                with vsfs.open(path, "rb") as f:
+                    f.seek(10)
+                    self.assertEqual(f.read(), contents[10:])
+                    f.seek(2)
+                    self.assertEqual(f.read(8), contents[2:10])
+                self.assertEqual(vsfs.stat(path).st_size, len(contents))
+                self.assertNotEqual(vsfs.stat(path).stored_size, len(contents))
+
+        # Listing the stored and logical sizes before the name
+        object = Commands.VSFSCommands()
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            object.do_list("tests/compression_test.notes")
+        sizes = {}
+        for line in stdout.getvalue().splitlines():
+            fields = line.split()
+            sizes[fields[-1]] = [int(fields[-3]), int(fields[-2])]
+        self.assertEqual(sizes["dir1/dir2/note1"], [15, 15])
+        self.assertEqual(sizes["note2"][1], len(contents))
+        self.assertNotEqual(sizes["note2"][0], len(contents))
+        self.assertEqual(sizes["dir1/"], [0, 0])
+
+
+    def test_dedup(self):
+        with open("tests/valid_ef", "rb") as f:
+            contents = f.read()
+        vsfs = Library.VSFS("tests/dedup_test.notes")
+        vsfs.mkdir("dir2")
+        for path in ["dir1/note2", "dir2/note2", "dir2/note3"]:
+            vsfs.copyin("tests/valid_ef", path, dedup = True)
+
+        # Checking the contents are only stored once
+        with open("tests/dedup_test.notes", "r") as f:
+            lines = f.readlines()
+        digest = Library.hash_file("tests/valid_ef", True)
+        self.assertEqual(lines.count("$" + digest + "\n"), 1)
+        self.assertIn("@dir2/note3\th=" + digest + "\n", lines)
+        image = Notes.load_image("tests/dedup_test.notes")
+        self.assertEqual(image.references[digest], 3)
+
+        for version in ["V1.0", "V2.0"]:
+            vsfs.convert(version)
+            vsfs.copyout("dir2/note3", "tests/copyout_result")
+            with open("tests/copyout_result", "rb") as f:
+                self.assertEqual(f.read(), contents.rstrip(b"\n"))
+            with vsfs.open("dir1/note2", "rb") as f:
+                self.assertEqual(f.read(), contents.rstrip(b"\n"))
+
+            # Dropping the references, while the blob is kept until a defrag
+            vsfs.rmtree("dir2")
+            image = vsfs.get_image()
+            self.assertEqual(image.references[digest], 1)
+            self.assertEqual(image.get_unreferenced_blobs(), [])
+            vsfs.remove("dir1/note2")
+            self.assertEqual(vsfs.get_image().references[digest], 0)
+            self.assertNotEqual(vsfs.get_image().get_blob(digest), None)
+            vsfs.defrag()
+            self.assertEqual(vsfs.get_image().get_blob(digest), None)
+
+            vsfs.mkdir("dir2")
+            for path in ["dir1/note2", "dir2/note2", "dir2/note3"]:
+                vsfs.copyin("tests/valid_ef", path, dedup = True)
+
+
+    def test_dedup_newlines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_system = os.path.join(directory, "fs.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+            vsfs = Library.VSFS(file_system)
+            external_file = os.path.join(directory, "ef")
+            result = os.path.join(directory, "result")
+            open(result, "wb").close()
+
+            # Copying in with or without deduplication reads the same
+            # contents back, whatever the FS was converted from
+            for version in ["V1.0", "V2.0", "V1.0"]:
+                vsfs.convert(version)
+                for contents in [b"\n", b"z\n", b"z\n\n", b"z"]:
+                    with open(external_file, "wb") as f:
+                        f.write(contents)
+                    vsfs.copyin(external_file, "plain")
+                    vsfs.copyin(external_file, "dedup", dedup = True)
+                    vsfs.copyout("plain", result)
+                    with open(result, "rb") as f:
+                        expected = f.read()
+                    vsfs.copyout("dedup", result)
+                    with open(result, "rb") as f:
+                        self.assertEqual(f.read(), expected)
+                    vsfs.copyin(external_file, "blob" + str(len(contents)), dedup = True)
+
+
+    def test_copyin_many(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pairs = []
+            for i, contents in enumerate([b"", b"a\nb\n", b"a\n" * 40000, b"a\nb\n"]):
+                external_file = os.path.join(directory, "ef" + str(i))
+                with open(external_file, "wb") as f:
+                    f.write(contents)
+                pairs.append([external_file, ["note2", "dir1/note3", "note1", "note2"][i]])
+            file_systems = []
+            for name in ["sequential", "many"]:
+                file_system = os.path.join(directory, name + ".notes")
+                shutil.copyfile("tests/valid.notes", file_system)
+                file_systems.append(file_system)
+
+            # Copying the pairs in at once gives the FS of copying them
+            # in one at a time
+            vsfs = Library.VSFS(file_systems[0])
+            for external_file, path in pairs:
+                vsfs.copyin(external_file, path)
+            vsfs = Library.VSFS(file_systems[1])
+            vsfs.copyin_many(pairs, workers = 2)
+            with open(file_systems[0], "rb") as f:
+                expected = f.read()
+            with open(file_systems[1], "rb") as f:
+                self.assertEqual(f.read(), expected)
+            vsfs.copyin_many(pairs[:2], dedup = True)
+            with vsfs.open("dir1/note3", "rb") as f:
+                self.assertEqual(f.read(), b"a\nb")
+
+            # Nothing is copied in if any IF is not valid
+            with self.assertRaises(Library.InvalidPathError):
+                vsfs.copyin_many([pairs[0], [pairs[1][0], "dir9/note4"]])
+            with self.assertRaises(Library.ExternalFileError):
+                vsfs.copyin_many([[pairs[0][0], "note4"], ["tests/dummy", "note5"]])
+            with open(file_systems[1], "rb") as f:
+                contents = f.read()
+            self.assertNotIn(b"note4", contents)
+
+            object = Commands.VSFSCommands()
+            command = ["./VSFS.py", "copyin", file_systems[1],
+                       pairs[2][0], "note6", pairs[3][0], "dir1/note7"]
+            self.assertTrue(object.check_command(command, len(command)))
+            object.execute(command)
+            self.assertTrue(vsfs.isfile("note6") and vsfs.isfile("dir1/note7"))
+            remote = Client.get_remote_command(["./VSFS.py", "copyin", "a.notes",
+                                                "ef1", "note1", "ef2", "note2"])
+            self.assertEqual(remote[3::2], [os.path.abspath("ef1"), os.path.abspath("ef2")])
+            self.assertEqual(remote[4::2], ["note1", "note2"])
+
+
+    def test_copy_tree(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tree = os.path.join(directory, "tree")
+            os.makedirs(os.path.join(tree, "dir5", "dir6"))
+            os.makedirs(os.path.join(tree, "dir7"))
+            for name, contents in [["note1", b"a\nb"], ["dir5/note2", b""],
+                                   ["dir5/dir6/note3", b"c\n" * 40000 + b"c"]]:
+                with open(os.path.join(tree, name), "wb") as f:
+                    f.write(contents)
+            os.symlink(tree, os.path.join(tree, "dir5", "link"))
+            file_system = os.path.join(directory, "tree.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+
+            for version in ["V1.0", "V2.0"]:
+                vsfs = Library.VSFS(file_system)
+                vsfs.convert(version)
+                vsfs.copyin_tree(tree, "dir1/tree")
+                self.assertEqual(sorted(vsfs.listdir("dir1/tree")), ["dir5", "dir7", "note1"])
+                self.assertEqual(sorted(vsfs.listdir("dir1/tree/dir5")), ["dir6", "note2"])
+                with vsfs.open("dir1/tree/dir5/dir6/note3", "rb") as f:
+                    self.assertEqual(f.read(), b"c\n" * 40000 + b"c")
+
+                # Replacing the files that were copied in before
+                with open(os.path.join(tree, "note1"), "wb") as f:
+                    f.write(version.encode())
+                vsfs.copyin_tree(tree, "dir1/tree", "zlib", True)
+                output = os.path.join(directory, "output" + version)
+                vsfs.copyout_tree("dir1/tree", output)
+                self.assertTrue(os.path.isdir(os.path.join(output, "dir7")))
+                for name, contents in [["note1", version.encode()], ["dir5/note2", b""],
+                                       ["dir5/dir6/note3", b"c\n" * 40000 + b"c"]]:
+                    with open(os.path.join(output, name), "rb") as f:
+                        self.assertEqual(f.read(), contents)
+                vsfs.rmtree("dir1/tree")
+
+            with self.assertRaises(Library.InvalidPathError):
+                vsfs.copyin_tree(tree, "dir9/tree")
+            with self.assertRaises(Library.ExternalFileError):
+                vsfs.copyin_tree(os.path.join(directory, "dummy"), "tree")
+            with self.assertRaises(Library.NotFoundError):
+                vsfs.copyout_tree("dir9", output)
+
+            object = Commands.VSFSCommands()
+            command = ["./VSFS.py", "copyin", file_system, "-r", tree, "tree"]
+            self.assertTrue(object.check_command(command, len(command)))
+            object.execute(command)
+            self.assertTrue(vsfs.isfile("tree/dir5/dir6/note3"))
+            remote = Client.get_remote_command(["./VSFS.py", "copyout", "a.notes",
+                                                "-r", "tree", "output"])
+            self.assertEqual(remote[3:], ["-r", "tree", os.path.abspath("output")])
+
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_system = os.path.join(directory, "segments.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+            external_file = os.path.join(directory, "ef")
+            with open(external_file, "wb") as f:
+                f.write(b"Bob\n" * 500 + b"Bob")
+
+            # Splitting the FS into segments of about 6000 bytes,
+            # which are valid FSs holding two files each
+            with Library.VSFS(file_system) as vsfs:
+                Segments.split(vsfs, 6000)
+            self.assertTrue(Segments.is_segmented(file_system))
+            vsfs = Segments.SegmentedVSFS(file_system)
+            for i in range(6):
+                vsfs.copyin(external_file, "dir1/note" + str(i))
+            names = Segments.read_manifest(file_system)[1]
+            self.assertEqual(len(names), 3)
+            for name in names:
+                with Library.VSFS(os.path.join(directory, name)) as segment:
+                    self.assertTrue(segment.isdir("dir1/dir2"))
+                    self.assertTrue(os.path.getsize(segment.file_system) < 6000)
+
+            # Deleting a file only changes the segment holding it
+            first = os.path.join(directory, names[0])
+            signature = os.stat(first).st_mtime_ns
+            vsfs.remove("dir1/note5")
+            self.assertEqual(os.stat(first).st_mtime_ns, signature)
+            # Replacing a file of an older segment
+            vsfs.copyin("tests/valid_ef", "dir1/note0")
+            with vsfs.open("dir1/note0", "rb") as f, open("tests/valid_ef", "rb") as g:
+                self.assertEqual(f.read(), g.read())
+            self.assertEqual(vsfs.listdir("dir1"),
+                             ["dir2", "note0", "note1", "note2", "note3", "note4"])
+            self.assertEqual(vsfs.search("Bob"), ["dir1/note1", "dir1/note2",
+                                                  "dir1/note3", "dir1/note4", "note1"])
+            vsfs.mkdir("dir3")
+            with self.assertRaises(Library.ExistsError) as cm:
+                vsfs.mkdir("dir3")
+            self.assertEqual(str(cm.exception), "Internal Directory Already Exists")
+            with self.assertRaises(Library.InvalidPathError):
+                vsfs.copyin(external_file, "dir4/note1")
+            with self.assertRaises(Library.FileSystemError):
+                vsfs.transaction()
+
+            # Listing the newest copy of every file once
+            object = Commands.VSFSCommands()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                object.execute(["VSFS.py", "list", file_system, "dir1"])
+            lines = output.getvalue().splitlines()
+            self.assertEqual([line.split(" ")[-1] for line in lines],
+                             ["dir1/dir2/", "dir1/dir2/note1", "dir1/note0", "dir1/note1",
+                              "dir1/note2", "dir1/note3", "dir1/note4"])
+            for path in ["dir1/note1", "dir1/note4"]:
+                with self.assertRaises(Library.InvalidPathError):
+                    vsfs.entries(path)
+            with self.assertRaises(Library.NotFoundError):
+                vsfs.listdir("dir1/note5")
+
+            # Removing the segments left with no file
+            vsfs.rmtree("dir1")
+            vsfs.defrag()
+            self.assertEqual(Segments.read_manifest(file_system)[1], [names[0], names[2]])
+            self.assertFalse(os.path.exists(os.path.join(directory, names[1])))
+            vsfs.close()
+
+            # Merging the segments back into a single FS
+            with contextlib.redirect_stdout(io.StringIO()):
+                object.execute(["VSFS.py", "convert", file_system, "V1.0"])
+            self.assertFalse(Segments.is_segmented(file_system))
+            with Library.VSFS(file_system) as vsfs:
+                self.assertEqual(vsfs.listdir(""), ["dir3", "note1"])
+            self.assertFalse(os.path.exists(first))
+
+            # Splitting contents ending with new-line characters
+            # and merging them back without changing them
+            contents = [b"z\n", b"z\n\n\n", b"\n", b"\n\n", b"z"]
+            with Library.VSFS(file_system) as vsfs:
+                vsfs.convert("V2.0")
+                for i, data in enumerate(contents):
+                    with open(external_file, "wb") as f:
+                        f.write(data)
+                    vsfs.copyin(external_file, "dir3/note" + str(i))
+                Segments.split(vsfs, 100)
+            for version in [Segments.VERSION, "V2.0"]:
+                if (version == "V2.0"):
+                    with Segments.SegmentedVSFS(file_system) as vsfs:
+                        vsfs.convert(version)
+                    vsfs = Library.VSFS(file_system)
+                else:
+                    vsfs = Segments.SegmentedVSFS(file_system)
+                for i, data in enumerate(contents):
+                    output = os.path.join(directory, "output" + str(i))
+                    vsfs.copyout("dir3/note" + str(i), output)
+                    with open(output, "rb") as f:
+                        self.assertEqual(f.read(), data)
+                vsfs.close()
+
+
+    def test_search(self):
+        tokenizer = Search.Tokenizer()
+        for chunk in [b"hello wo", b"rld\n" + b"a" * 70, b" x_1"]:
+            tokenizer.update(chunk)
+        self.assertEqual(tokenizer.finish(), set(["hello", "world", "", "x_1"]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_system = os.path.join(directory, "search.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+            external_file = os.path.join(directory, "ef")
+            with open(external_file, "wb") as f:
+                f.write(b"first line\nsecond line")
+            vsfs = Library.VSFS(file_system)
+            vsfs.copyin(external_file, "note2", "zlib")
+            vsfs.copyin(external_file, "dir1/note3")
+
+            # Searching with and without the search index, which is
+            # kept up to date once it was built
+            for built in [False, True]:
+                self.assertEqual(vsfs.search("line\nsec"), ["dir1/note3", "note2"])
+                self.assertEqual(vsfs.search("st li"), ["dir1/note3", "note2"])
+                self.assertEqual(vsfs.search(" second"), [])
+                self.assertEqual(vsfs.search("dummy"), [])
+                vsfs.rebuild_search()
+            with open(external_file, "wb") as f:
+                f.write(b"third line")
+            vsfs.copyin(external_file, "note2")
+            vsfs.rmtree("dir1")
+            self.assertEqual(vsfs.search("line"), ["note2"])
+            search = Search.SearchIndex(file_system)
+            self.assertTrue(search.load())
+            self.assertEqual(search.get_candidates("third"), set(["note2"]))
+            self.assertEqual(search.get_candidates("hir"), set(["note2"]))
+            self.assertEqual(search.get_candidates("first"), set())
+
+            # The changes of a batch are only saved once it is committed
+            with self.assertRaises(ValueError):
+                with vsfs.transaction():
+                    vsfs.remove("note2")
+                    raise ValueError()
+            self.assertEqual(vsfs.search("third"), ["note2"])
+            with vsfs.transaction():
+                vsfs.remove("note2")
+            search = Search.SearchIndex(file_system)
+            self.assertTrue(search.load())
+            self.assertEqual(search.get_candidates("third"), set())
+
+            object = Commands.VSFSCommands()
+            command = ["./VSFS.py", "search", file_system, "Bob"]
+            self.assertTrue(object.check_command(command, len(command)))
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                object.execute(command)
+            self.assertEqual(stdout.getvalue(), "note1\n")
+
+
+    def test_benchmark(self):
+        parameters = Benchmark.Parameters(40, 2, 3, 100, 0.2)
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark = Benchmark.Benchmark(parameters, directory)
+            benchmark.prepare()
+            # Checking the generated FS has the dirs, live files
+            # and deleted files of the parameters
+            image = Notes.load_image(benchmark.base)
+            self.assertEqual(len(benchmark.directories), 3 + 9)
+            self.assertEqual(len([record for record in image.records.values()
+                                  if (record.kind == "@" and record.live == True)]), 40)
+            self.assertEqual(image.index.dead_records, 10 * 3)
+            with Library.VSFS(benchmark.base) as vsfs:
+                self.assertEqual(vsfs.stat(benchmark.files[0]).st_size, 100)
+
+            results = {}
+            with open(benchmark.base, "rb") as f:
+                self.assertIn(benchmark.pattern.encode(), f.read())
+            # Every operation of VSFS.py but serve, which is run by
+            # itself, is run on the copy of the FS
+            for operation in Commands._OPERATIONS:
+                if (operation != "serve"):
+                    self.assertNotEqual(benchmark.get_arguments(operation), None)
+            for operation in ["list", "rm", "rmdir", "serve", "search"]:
+                results[operation] = benchmark.run(operation, 1)
+                self.assertGreater(results[operation]["peak_rss_kb"], 0)
+            report = Benchmark.make_report(benchmark, results)
+            self.assertEqual(report["records"], 52)
+
+        # Reporting the operations that got slower than the threshold
+        previous = {"results": {"list": {"seconds": 1.0}, "rm": {"seconds": 1.0}}}
+        report = {"results": {"list": {"seconds": 1.1}, "rm": {"seconds": 2.0}}}
+        self.assertEqual(Benchmark.compare(previous, report), [["rm", 1.0, 2.0]])
+
+
+    def test_stats(self):
+        arguments = ["./VSFS.py", "list", "--stats", "tests/valid.notes"]
+        self.assertTrue(Stats.parse_flag(arguments))
+        self.assertEqual(arguments, ["./VSFS.py", "list", "tests/valid.notes"])
+
+        # Nothing is collected until a command starts
+        Stats.count("full_reads")
+        with Stats.phase("load"):
+            pass
+        Stats.start(arguments)
+        with Stats.phase("load"):
+            with Stats.phase("parse"):
+                Stats.count("records_scanned", 3)
+        with Stats.phase("load"):
+            pass
+        report = Stats._current.report()
+        Stats._current = None
+        self.assertEqual(report["phases"]["load"]["calls"], 2)
+        self.assertEqual(report["phases"]["parse"]["calls"], 1)
+        self.assertGreaterEqual(report["phases"]["load"]["seconds"],
+                                report["phases"]["parse"]["seconds"])
+        self.assertEqual(report["records_scanned"], 3)
+        self.assertEqual(report["full_reads"], 0)
+        self.assertGreater(report["peak_rss_kb"], 0)
+
+        # Appending the stats of a command to the file named by VSFS_STATS
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stats.jsonl")
+            file_system = os.path.join(directory, "stats.notes")
+            shutil.copyfile("tests/valid.notes", file_system)
+            environment = dict(os.environ, VSFS_STATS = path)
+            for i in range(2):
+                subprocess.run([os.path.join(_DIRECTORY, "VSFS.py"), "defrag", file_system],
+                               env = environment, stdout = subprocess.DEVNULL, check = True)
+            with open(path, "r") as f:
+                reports = [json.loads(line) for line in f]
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]["command"][1:], ["defrag", file_system])
+        self.assertEqual(reports[0]["full_writes"], 1)
+        self.assertIn("rewrite", reports[0]["phases"])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,9 +1,30 @@
 #!/usr/bin/python3
 import sys
-import Commands
+import Client
+import Stats
 
 def main():
 
+    # Reporting the stats of the command with --stats or VSFS_STATS,
+    # and saving its profile if VSFS_PROFILE is set
+    if (Stats.parse_flag(sys.argv) == True):
+        Stats.start(sys.argv)
+    try:
+        Stats.run_profiled(run)
+    finally:
+        Stats.finish()
+
+
+def run():
+
+    # Running the command on the server of the FS if one is running,
+    # which saves loading the commands and parsing the FS
+    with Stats.phase("remote"):
+        code = Client.run(sys.argv)
+    if (code != None):
+        exit(code)
+
+    import Commands
     object = Commands.VSFSCommands()
 
     arg_length = len(sys.argv)
@@ -13,9 +34,12 @@ def main():
         exit(1)
     else:
         # Checking if entered command is valid and executing it
-        if (object.check_command(sys.argv, arg_length) == True):
-            object.execute(sys.argv)
+        with Stats.phase("check"):
+            valid = object.check_command(sys.argv, arg_length)
+        if (valid == True):
+            with Stats.phase("execute"):
+                object.execute(sys.argv)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()